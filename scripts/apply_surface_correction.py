@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Apply a BAG's gridded surface corrections (vertical_datum_corrections) to its
+elevation layer, e.g. to shift an Ellipsoid-referenced survey to MLLW.
+
+The correction grid is bilinearly interpolated onto the elevation lattice once and
+cached next to the bag as a float32 .npy memmap; the elevation layer is then
+corrected one chunk-aligned tile at a time by reading the matching window of the
+cache, so no full-grid array is ever held in memory and repeat runs (other
+correctors aside) skip the interpolation entirely.
+
+    corrected elevation = elevation + correction
+
+The correction grid is placed from its sw_corner_x/y and node_spacing_x/y
+attributes, or, where those are missing, from its x/y fields, which must then form
+a regular, axis-aligned grid. It must cover the whole elevation lattice; with
+extrapolate=True it only has to overlap it, and the nearest edge value of the grid
+is used beyond it. A bag is corrected only once: the corrector applied is recorded
+on the elevation layer (APPLIED_CORRECTOR_ATTR) and a second run is refused.
+
+usage: python apply_surface_correction.py <bag> [-o output.bag] [--corrector N] [--extrapolate]
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import numpy as np
+import h5py
+from bag_utils import (read_bag_xml, get_grid_georef, iter_chunk_windows, chunk_aligned_tile, tracking_entries,
+                       TrackingListWriter, BAG_NO_DATA, ELEVATION_PATH, UNCERTAINTY_PATH, TRACK_CODE_SURFACE_CORRECTION)
+from bag_metadata_editor import BagMetadataSession
+
+SURFACE_CORRECTIONS_PATH = '/BAG_root/vertical_datum_corrections'
+SURFACE_TYPE_GRIDDED = 2
+APPLIED_CORRECTOR_ATTR = 'Applied Surface Corrector'
+_AXIS_TOLERANCE = 1e-6  # relative to the node spacing
+DEFAULT_TILE_SIZE = (1024, 1024)
+
+
+def _axis_weights(positions, axis):
+    """Lower node index and interpolation weight of each position along a monotonic correction axis."""
+    if len(axis) == 1:
+        return np.zeros(len(positions), dtype=np.intp), np.zeros(len(positions)), np.ones(len(positions), dtype=bool)
+    fraction = np.interp(positions, axis, np.arange(len(axis)))
+    lower = np.minimum(fraction.astype(np.intp), len(axis) - 2)
+    tolerance = _AXIS_TOLERANCE * (axis[-1] - axis[0]) / (len(axis) - 1)
+    inside = (positions >= axis[0] - tolerance) & (positions <= axis[-1] + tolerance)
+    return lower, fraction - lower, inside
+
+
+def _regular_axis(coordinates, along):
+    """1-D axis of a coordinate grid that must vary along `along` only, with uniform increasing spacing."""
+    axis = coordinates[0, :] if along == 1 else coordinates[:, 0]
+    spacing = np.diff(axis)
+    scale = abs(spacing).max() if spacing.size else 1.0
+    if np.any(np.abs(coordinates - (axis[np.newaxis, :] if along == 1 else axis[:, np.newaxis])) > _AXIS_TOLERANCE * scale):
+        raise ValueError("Correction grid is not axis-aligned (coordinates vary along both grid axes).")
+    if spacing.size and (np.any(spacing <= 0) or np.any(np.abs(spacing - spacing[0]) > _AXIS_TOLERANCE * scale)):
+        raise ValueError("Correction grid spacing is not uniform and increasing.")
+    return axis
+
+
+def read_correction_grid(bag_file, corrector=0):
+    """
+    (y axis, x axis, values) of one corrector of a gridded vertical_datum_corrections
+    dataset, with the axes in the projected coordinates of the elevation lattice.
+    """
+    if SURFACE_CORRECTIONS_PATH not in bag_file:
+        raise ValueError("Bag has no surface corrections layer.")
+    corrections = bag_file[SURFACE_CORRECTIONS_PATH]
+    if corrections.attrs.get('surface_type') != SURFACE_TYPE_GRIDDED:
+        raise ValueError("Only gridded surface corrections are supported.")
+    grid = corrections[()]
+    if not 0 <= corrector < grid['z'].shape[-1]:
+        raise ValueError(f"Corrector {corrector} out of range (bag has {grid['z'].shape[-1]}).")
+    # rows of the correction grid run south to north, like the elevation layer
+    attrs = corrections.attrs
+    if all(name in attrs for name in ('sw_corner_x', 'sw_corner_y', 'node_spacing_x', 'node_spacing_y')):
+        y_axis = float(attrs['sw_corner_y']) + np.arange(grid.shape[0]) * float(attrs['node_spacing_y'])
+        x_axis = float(attrs['sw_corner_x']) + np.arange(grid.shape[1]) * float(attrs['node_spacing_x'])
+    elif 'x' in grid.dtype.names and 'y' in grid.dtype.names:
+        y_axis = _regular_axis(grid['y'].astype(np.float64), along=0)
+        x_axis = _regular_axis(grid['x'].astype(np.float64), along=1)
+    else:
+        raise ValueError("Correction grid has no georeferencing (sw_corner/node_spacing attributes or x/y fields).")
+    return y_axis, x_axis, grid['z'].reshape(grid.shape + (-1,))[..., corrector].astype(np.float64)
+
+
+def check_coverage(georef, shape, y_axis, x_axis, extrapolate=False):
+    """
+    Raise ValueError unless the correction grid covers the elevation lattice (with
+    extrapolate=True: overlaps it).
+    """
+    lattice = (georef['sw_x'], georef['sw_x'] + (shape[1] - 1) * georef['x_res'],
+               georef['sw_y'], georef['sw_y'] + (shape[0] - 1) * georef['y_res'])
+    tolerance = _AXIS_TOLERANCE * max(georef['x_res'], georef['y_res'])
+    grid = (x_axis[0] - tolerance, x_axis[-1] + tolerance, y_axis[0] - tolerance, y_axis[-1] + tolerance)
+    extent = (f"correction grid x {grid[0]:.3f}..{grid[1]:.3f}, y {grid[2]:.3f}..{grid[3]:.3f}; elevation lattice "
+              f"x {lattice[0]:.3f}..{lattice[1]:.3f}, y {lattice[2]:.3f}..{lattice[3]:.3f}")
+    if grid[1] < lattice[0] or grid[0] > lattice[1] or grid[3] < lattice[2] or grid[2] > lattice[3]:
+        raise ValueError(f"Correction grid does not overlap the elevation lattice ({extent}).")
+    if not extrapolate and (grid[0] > lattice[0] or grid[1] < lattice[1] or grid[2] > lattice[2]
+                            or grid[3] < lattice[3]):
+        raise ValueError(f"Correction grid does not cover the elevation lattice ({extent}); "
+                         f"use extrapolate to take edge values beyond it.")
+
+
+def interpolate_correction(georef, y_axis, x_axis, values, rows, cols, extrapolate=False):
+    """Bilinear correction for an elevation window; NaN outside the grid unless extrapolating."""
+    y = georef['sw_y'] + np.arange(rows.start, rows.stop) * georef['y_res']
+    x = georef['sw_x'] + np.arange(cols.start, cols.stop) * georef['x_res']
+    r0, wy, y_inside = _axis_weights(y, y_axis)
+    c0, wx, x_inside = _axis_weights(x, x_axis)
+    r1 = np.minimum(r0 + 1, len(y_axis) - 1)
+    c1 = np.minimum(c0 + 1, len(x_axis) - 1)
+    wy, wx = wy[:, np.newaxis], wx[np.newaxis, :]
+    correction = ((1 - wy) * ((1 - wx) * values[np.ix_(r0, c0)] + wx * values[np.ix_(r0, c1)])
+                  + wy * ((1 - wx) * values[np.ix_(r1, c0)] + wx * values[np.ix_(r1, c1)]))
+    if not extrapolate:
+        correction[~(y_inside[:, np.newaxis] & x_inside[np.newaxis, :])] = np.nan
+    return correction.astype(np.float32)
+
+
+def correction_cache(bag_path, corrector=0, cache_path=None, extrapolate=False, tile_size=DEFAULT_TILE_SIZE):
+    """
+    Correction grid interpolated onto the elevation lattice, as a read-only float32
+    memmap. Built tile by tile on first use and reused while it is newer than the bag.
+    """
+    suffix = '_extrapolated' if extrapolate else ''
+    cache_path = cache_path or f"{os.path.splitext(bag_path)[0]}.correction{corrector}{suffix}.npy"
+    with h5py.File(bag_path, 'r') as f:
+        shape = f[ELEVATION_PATH].shape
+        if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(bag_path):
+            cached = np.load(cache_path, mmap_mode='r')
+            if cached.shape == shape:
+                return cached
+        georef = get_grid_georef(read_bag_xml(f))
+        y_axis, x_axis, values = read_correction_grid(f, corrector)
+        check_coverage(georef, shape, y_axis, x_axis, extrapolate)
+        tile = chunk_aligned_tile(f[ELEVATION_PATH], tile_size)
+    cache = np.lib.format.open_memmap(cache_path, mode='w+', dtype=np.float32, shape=shape)
+    for rows, cols in iter_chunk_windows(shape, tile):
+        cache[rows, cols] = interpolate_correction(georef, y_axis, x_axis, values, rows, cols, extrapolate)
+    cache.flush()
+    del cache
+    print(f"Cached interpolated corrections in '{cache_path}'")
+    return np.load(cache_path, mmap_mode='r')
+
+
+def apply_surface_correction(bag_path, output_path=None, corrector=0, cache_path=None, extrapolate=False,
+                             tile_size=DEFAULT_TILE_SIZE, track=False):
+    """
+    Add the interpolated surface correction to every elevation node of `bag_path`,
+    writing to `output_path` (a copy of the input) or in place when it is None.
+    Returns the number of data nodes corrected. Raises ValueError if the bag was
+    already corrected or the correction grid does not cover it (see the module
+    docstring). With track=True the value every changed node held before is
+    appended to the tracking list (TRACK_CODE_SURFACE_CORRECTION).
+    """
+    with h5py.File(bag_path, 'r') as f:
+        if APPLIED_CORRECTOR_ATTR in f[ELEVATION_PATH].attrs:
+            raise ValueError(f"'{os.path.basename(bag_path)}' was already corrected with surface corrector "
+                             f"{int(f[ELEVATION_PATH].attrs[APPLIED_CORRECTOR_ATTR])}.")
+    correction = correction_cache(bag_path, corrector, cache_path, extrapolate, tile_size)
+    if output_path and os.path.abspath(output_path) != os.path.abspath(bag_path):
+        shutil.copyfile(bag_path, output_path)
+    else:
+        output_path = bag_path
+
+    corrected = 0
+    with h5py.File(output_path, 'r+') as f:
+        elevation, uncertainty = f[ELEVATION_PATH], f[UNCERTAINTY_PATH]
+        elev_range = [np.inf, -np.inf]
+        tracking = TrackingListWriter(f) if track else None
+        for rows, cols in iter_chunk_windows(elevation.shape, chunk_aligned_tile(elevation, tile_size)):
+            block = elevation[rows, cols]
+            has_data = block != BAG_NO_DATA
+            if not has_data.any():
+                continue
+            shift = correction[rows, cols]
+            if tracking is not None:
+                changed = has_data & (shift != 0)
+                node_rows, node_cols = np.nonzero(changed)
+                tracking.add(tracking_entries(node_rows + rows.start, node_cols + cols.start, block[changed],
+                                              uncertainty[rows, cols][changed], TRACK_CODE_SURFACE_CORRECTION, corrector))
+            block[has_data] += shift[has_data]
+            elevation[rows, cols] = block
+            corrected += int(has_data.sum())
+            elev_range = [min(elev_range[0], block[has_data].min()), max(elev_range[1], block[has_data].max())]
+        if tracking is not None:
+            tracking.close()
+        if elev_range[0] <= elev_range[1]:
+            elevation.attrs['Minimum Elevation Value'] = np.float32(elev_range[0])
+            elevation.attrs['Maximum Elevation Value'] = np.float32(elev_range[1])
+        elevation.attrs[APPLIED_CORRECTOR_ATTR] = np.uint32(corrector)
+
+        description = (f"Elevation corrected with surface corrector {corrector} of the vertical datum corrections "
+                       f"layer (bilinear interpolation{', edge extrapolation' if extrapolate else ''}).")
+        with BagMetadataSession(f) as session:
+            if not session.add_process_step(description):
+                print("  Warning: Could not find <gmd:LI_Lineage> element. Skipping process step.")
+    print(f"done. {corrected} node(s) corrected, written to: {output_path}")
+    return corrected
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply gridded surface corrections to a BAG's elevation layer.")
+    parser.add_argument('bag', help="bag with a vertical_datum_corrections layer")
+    parser.add_argument('-o', '--output', help="write the corrected bag here instead of updating in place")
+    parser.add_argument('--corrector', type=int, default=0, help="corrector index (default: 0)")
+    parser.add_argument('--cache', help="path of the interpolated correction cache (.npy)")
+    parser.add_argument('--extrapolate', action='store_true', help="allow a correction grid that only partly covers the bag, using its edge values beyond it")
+    parser.add_argument('--track', action='store_true', help="record the original values in the tracking list")
+    args = parser.parse_args(argv)
+    try:
+        apply_surface_correction(args.bag, args.output, args.corrector, args.cache, args.extrapolate, track=args.track)
+    except (ValueError, OSError) as e:
+        print(f"Error: {e}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+BAG inventory scanner with a persistent SQLite catalog.
+
+Pulls the HDF5 header information (version, layer names, grid shape) and the
+georeferencing fields of the embedded XML from many bags in parallel, without
+reading any raster data and without going through bagPy (which can't open most
+1.x files - see the notes in open_bag_file.py). Results are kept in a local SQLite
+catalog keyed by path, size and mtime, so a rescan only opens new or changed files.
+
+usage:
+    python bag_catalog.py scan <folder or bag> [...] [--catalog bags.sqlite] [--workers N] [--prune]
+    python bag_catalog.py query "SELECT path, rows, cols FROM bags WHERE bag_version LIKE '1.%'" [--catalog bags.sqlite]
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import h5py
+from bag_utils import (read_bag_xml, get_grid_georef, find_bag_files, namespaces, METADATA_PATH, ELEVATION_PATH,
+                       GEOREF_METADATA_PATH)
+
+DEFAULT_CATALOG = 'bag_catalog.sqlite'
+
+COLUMNS = (
+    ('path', 'TEXT PRIMARY KEY'), ('size', 'INTEGER'), ('mtime', 'REAL'), ('scanned_at', 'REAL'),
+    ('bag_version', 'TEXT'), ('rows', 'INTEGER'), ('cols', 'INTEGER'),
+    ('x_res', 'REAL'), ('y_res', 'REAL'), ('sw_x', 'REAL'), ('sw_y', 'REAL'), ('ne_x', 'REAL'), ('ne_y', 'REAL'),
+    ('west', 'REAL'), ('east', 'REAL'), ('south', 'REAL'), ('north', 'REAL'),
+    ('horizontal_crs', 'TEXT'), ('vertical_crs', 'TEXT'), ('layers', 'TEXT'), ('georef_layers', 'TEXT'),
+    ('error', 'TEXT'),
+)
+COLUMN_NAMES = [name for name, _ in COLUMNS]
+
+
+def open_catalog(catalog_path=DEFAULT_CATALOG):
+    connection = sqlite3.connect(catalog_path)
+    connection.execute(f"CREATE TABLE IF NOT EXISTS bags ({', '.join(f'{n} {t}' for n, t in COLUMNS)})")
+    return connection
+
+
+# BAG 1.x headers use the older smXML schema: unqualified ISO element names and pre-3.2 GML
+SMXML_NAMESPACES = {'smXML': 'http://metadata.dgiwg.org/smXML', 'gml': 'http://www.opengis.net/gml'}
+GEOREF_COLUMNS = ('x_res', 'y_res', 'sw_x', 'sw_y', 'west', 'east', 'south', 'north', 'horizontal_crs', 'vertical_crs')
+
+
+def _smxml_georef(metadata):
+    """get_grid_georef for an smXML header, or None when its grid elements are missing."""
+    sizes = metadata.findall(".//axisDimensionProperties//dimensionSize")
+    resolutions = metadata.findall(".//axisDimensionProperties//resolution//smXML:value", SMXML_NAMESPACES)
+    coordinates_element = metadata.find(".//gml:coordinates", SMXML_NAMESPACES)
+    if len(sizes) < 2 or len(resolutions) < 2 or coordinates_element is None or not coordinates_element.text:
+        return None
+    sw_x, sw_y = (float(c) for c in coordinates_element.text.strip().split()[0].split(','))
+    return {
+        'rows': int(sizes[0].text), 'cols': int(sizes[1].text),
+        'x_res': float(resolutions[0].text), 'y_res': float(resolutions[1].text),
+        'sw_x': sw_x, 'sw_y': sw_y,
+    }
+
+
+def _xml_fields(metadata):
+    fields = {}
+    try:
+        georef = get_grid_georef(metadata)
+    except ValueError:
+        georef = _smxml_georef(metadata)
+    if georef:
+        fields.update(x_res=georef['x_res'], y_res=georef['y_res'], sw_x=georef['sw_x'], sw_y=georef['sw_y'])
+        # north-east from the grid itself - the stored corner is unreliable in caris-derived bags
+        fields['ne_x'] = georef['sw_x'] + (georef['cols'] - 1) * georef['x_res']
+        fields['ne_y'] = georef['sw_y'] + (georef['rows'] - 1) * georef['y_res']
+    for name, tag in (('west', 'westBoundLongitude'), ('east', 'eastBoundLongitude'),
+                      ('south', 'southBoundLatitude'), ('north', 'northBoundLatitude')):
+        element = metadata.find(f".//gmd:{tag}/gco:Decimal", namespaces)
+        if element is None:
+            element = metadata.find(f".//{tag}")
+        if element is not None and element.text:
+            fields[name] = float(element.text)
+    crs = [c.text for c in metadata.findall(".//gmd:referenceSystemInfo//gmd:code/gco:CharacterString", namespaces)]
+    if not crs:
+        # smXML spreads each reference system over several codes (projection, ellipsoid, datum)
+        crs = ['; '.join(c.text for c in system.iter('code') if c.text)
+               for system in metadata.findall(".//referenceSystemInfo")]
+    if crs:
+        fields['horizontal_crs'] = crs[0]
+    if len(crs) > 1:
+        fields['vertical_crs'] = crs[1]
+    if not any(fields.get(name) is not None for name in GEOREF_COLUMNS):
+        fields['error'] = "no georeferencing found in the XML metadata"
+    return fields
+
+
+def scan_bag(bag_path):
+    """Header and XML fields for one bag, as a dict of catalog columns. Never reads raster data."""
+    row = dict.fromkeys(COLUMN_NAMES)
+    row.update(path=bag_path, scanned_at=time.time())
+    try:
+        stat = os.stat(bag_path)
+    except OSError as e:
+        row['error'] = str(e)
+        return row
+    row.update(size=stat.st_size, mtime=stat.st_mtime)
+    try:
+        with h5py.File(bag_path, 'r') as f:
+            version = f['/BAG_root'].attrs.get('Bag Version', b'')
+            row['bag_version'] = version.decode() if isinstance(version, bytes) else str(version)
+            row['layers'] = ','.join(name for name, obj in f['/BAG_root'].items() if isinstance(obj, h5py.Dataset))
+            if GEOREF_METADATA_PATH in f:
+                row['georef_layers'] = ','.join(f[GEOREF_METADATA_PATH].keys())
+            if ELEVATION_PATH in f:
+                row['rows'], row['cols'] = f[ELEVATION_PATH].shape
+            if METADATA_PATH in f:
+                row.update(_xml_fields(read_bag_xml(f)))
+    except Exception as e:
+        row['error'] = str(e)
+    return row
+
+
+def scan(paths, catalog_path=DEFAULT_CATALOG, workers=None, prune=False):
+    """
+    Bring the catalog up to date for every bag under `paths`. Only files whose size
+    or mtime differs from the catalog entry are opened. With prune=True, catalog
+    entries for files that no longer exist are dropped.
+    Returns (scanned, unchanged, pruned) counts.
+    """
+    connection = open_catalog(catalog_path)
+    known = {path: (size, mtime) for path, size, mtime in connection.execute("SELECT path, size, mtime FROM bags")}
+    found = sorted({os.path.abspath(p) for p in find_bag_files(paths)})
+    changed = []
+    for bag_path in found:
+        try:
+            stat = os.stat(bag_path)
+        except OSError:
+            changed.append(bag_path)  # scan_bag records the error
+            continue
+        if known.get(bag_path) != (stat.st_size, stat.st_mtime):
+            changed.append(bag_path)
+
+    if len(changed) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            rows = list(pool.map(scan_bag, changed, chunksize=16))
+    else:
+        rows = [scan_bag(p) for p in changed]
+
+    pruned = 0
+    with connection:
+        connection.executemany(
+            f"INSERT OR REPLACE INTO bags ({', '.join(COLUMN_NAMES)}) VALUES ({', '.join('?' * len(COLUMN_NAMES))})",
+            [tuple(row[n] for n in COLUMN_NAMES) for row in rows])
+        if prune:
+            gone = [(p,) for p in known if not os.path.exists(p)]
+            connection.executemany("DELETE FROM bags WHERE path = ?", gone)
+            pruned = len(gone)
+    connection.close()
+    return len(rows), len(found) - len(changed), pruned
+
+
+def query(sql, catalog_path=DEFAULT_CATALOG, parameters=()):
+    connection = open_catalog(catalog_path)
+    try:
+        cursor = connection.execute(sql, parameters)
+        header = [d[0] for d in cursor.description or ()]
+        return header, cursor.fetchall()
+    finally:
+        connection.close()
+
+
+def main(argv=None):
+    catalog_option = argparse.ArgumentParser(add_help=False)
+    catalog_option.add_argument('--catalog', default=DEFAULT_CATALOG, help="catalog database path")
+    parser = argparse.ArgumentParser(description="Scan BAG files into a SQLite catalog.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    scan_parser = commands.add_parser('scan', parents=[catalog_option],
+                                      help="scan new or changed bags into the catalog")
+    scan_parser.add_argument('paths', nargs='+', help="bag files, glob patterns or folders to search for *.bag")
+    scan_parser.add_argument('--workers', type=int, default=None, help="worker processes (default: cpu count)")
+    scan_parser.add_argument('--prune', action='store_true', help="drop entries for files that no longer exist")
+    query_parser = commands.add_parser('query', parents=[catalog_option],
+                                       help="run a SQL query against the 'bags' table")
+    query_parser.add_argument('sql')
+    args = parser.parse_args(argv)
+
+    if args.command == 'scan':
+        scanned, unchanged, pruned = scan(args.paths, args.catalog, args.workers, args.prune)
+        print(f"scanned {scanned} file(s), {unchanged} unchanged, {pruned} pruned -> {args.catalog}")
+    else:
+        header, rows = query(args.sql, args.catalog)
+        print('\t'.join(header))
+        for row in rows:
+            print('\t'.join('' if v is None else str(v) for v in row))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
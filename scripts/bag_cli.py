@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+One command line for the BAG 2.X tools.
+
+Only the standard library is imported at start-up; each subcommand imports what it
+needs when it runs (inspect and validate: h5py; convert: bagPy and lxml), so
+calling `inspect` from a shell loop over thousands of files does not pay for
+bagPy, GDAL or the metadata sample strings every time.
+
+usage:
+    python bag_cli.py convert                      run create_bag_v2x with the settings in the converter script
+    python bag_cli.py composite <output.bag> <input.bag>[=record] [...] [--rule R] [--workers N]
+                                [--shard-folder job_folder [--shards N]] [--live]
+    python bag_cli.py progress <output.bag>         progress of a composite written with --live
+    python bag_cli.py plan <input.bag> [...] [--workers N] [--compact] [--json]
+    python bag_cli.py fix-corners <bag> [...] [-o output.bag]
+    python bag_cli.py inspect <bag or folder> [...] [--json]
+    python bag_cli.py validate <bag or folder> [...] [--workers N] [--json report.json]
+"""
+
+import os
+import sys
+import argparse
+
+SCRIPTS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+CONVERTER_SCRIPT = os.path.join(SCRIPTS_FOLDER, 'bag2.x_converter_13June2025_working.py')
+
+
+def load_converter():
+    """The converter script as a module (its file name is not importable)."""
+    import importlib.util
+    spec = importlib.util.spec_from_file_location('bag2x_converter', CONVERTER_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_convert(args):
+    load_converter().create_bag_v2x()
+    return 0
+
+
+def _input_layers(specs):
+    """'path[=record]' arguments -> (layers, record_indices) for open_inputs; records default to 1, 2, ..."""
+    layers, record_indices = [], {}
+    for position, spec in enumerate(specs, start=1):
+        path, _, record = spec.rpartition('=')
+        if not record.isdigit():
+            path, record = spec, ''
+        layers.append({'name': os.path.basename(path), 'data_path': path, 'key': position})
+        record_indices[position] = int(record) if record else position
+    return layers, record_indices
+
+
+def run_composite(args):
+    from bag_compositor import open_inputs, composite_bag
+    from bag_utils import parse_memory_size
+    layers, record_indices = _input_layers(args.inputs)
+    missing = [layer['data_path'] for layer in layers if not os.path.exists(layer['data_path'])]
+    if missing:
+        print(f"Error: input(s) not found: {', '.join(missing)}")
+        return 1
+    if args.live and (args.workers or args.shard_folder):
+        print("Error: --live needs single-process compositing (no --workers or --shard-folder)")
+        return 1
+    inputs = []
+    try:
+        inputs = open_inputs(args.output, layers, record_indices, args.downsample, args.upsample)
+        if args.shard_folder:
+            from shard_composite import plan_shards
+            plan_shards(args.output, inputs, args.shard_folder, args.rule, args.shards,
+                        track_superseded=args.track_superseded)
+            print(f"Run 'python shard_composite.py work {args.shard_folder}' on the worker nodes, then "
+                  f"'python shard_composite.py assemble {args.shard_folder}'")
+            return 0
+        if args.workers:
+            from parallel_composite import composite_bag_parallel
+            composite_bag_parallel(args.output, inputs, args.rule, workers=args.workers,
+                                   track_superseded=args.track_superseded)
+        else:
+            composite_bag(args.output, inputs, args.rule,
+                          max_memory=parse_memory_size(args.max_memory) if args.max_memory else None,
+                          track_superseded=args.track_superseded, live=args.live)
+    finally:
+        for source in inputs:
+            source.close()
+    print(f"Composited {len(inputs)} input(s) into '{args.output}'")
+    return 0
+
+
+def run_progress(args):
+    from bag_utils import open_live_bag, live_progress
+    with open_live_bag(args.bag) as f:
+        progress = live_progress(f)
+        rows = f['/BAG_root/elevation'].shape[0]
+    if progress is None:
+        print(f"'{args.bag}' has no live composite in progress")
+        return 1
+    print(f"{progress[0]:.1%} of tiles written; rows 0-{progress[1]} of {rows} (from the south edge) are final")
+    return 0
+
+
+def run_fix_corners(args):
+    import shutil
+    from bag_metadata_editor import BagMetadataSession
+    if args.output and len(args.bags) > 1:
+        print("Error: -o/--output needs a single input bag")
+        return 1
+    for bag_path in args.bags:
+        target = args.output or bag_path
+        if target != bag_path:
+            shutil.copyfile(bag_path, target)
+        with BagMetadataSession(target) as session:
+            session.fix_corner_points()
+        print(f"Corner points fixed for '{os.path.basename(target)}'")
+    return 0
+
+
+def run_inspect(args):
+    import json
+    from bag_catalog import scan_bag
+    from bag_utils import find_bag_files
+    fields = ('bag_version', 'rows', 'cols', 'x_res', 'y_res', 'sw_x', 'sw_y', 'layers', 'georef_layers')
+    status = 0
+    for bag_path in find_bag_files(args.paths):
+        row = scan_bag(bag_path)
+        status = 1 if row['error'] else status
+        if args.json:
+            print(json.dumps({name: row[name] for name in ('path',) + fields + ('error',)}))
+        elif row['error']:
+            print(f"{bag_path}\terror: {row['error']}")
+        else:
+            print('\t'.join([bag_path] + ['' if row[name] is None else str(row[name]) for name in fields]))
+    return status
+
+
+def run_validate(args):
+    import validate_bag_v2x
+    argv = list(args.paths) + (['--workers', str(args.workers)] if args.workers else []) \
+        + (['--json', args.json_path] if args.json_path else [])
+    return validate_bag_v2x.main(argv)
+
+
+def run_plan(args):
+    import plan_conversion
+    argv = list(args.inputs) + [flag for flag, on in (('--compact', args.compact),
+                                                      ('--track-superseded', args.track_superseded),
+                                                      ('--json', args.json)) if on]
+    for flag, value in (('--workers', args.workers), ('--shards', args.shards), ('--max-memory', args.max_memory),
+                        ('--downsample', args.downsample), ('--upsample', args.upsample),
+                        ('--throughput', args.throughput)):
+        argv += [flag, str(value)] if value else []
+    return plan_conversion.main(argv)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='bag_cli', description="BAG 2.X conversion and inspection tools.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    convert = commands.add_parser('convert', help="run create_bag_v2x with the settings in the converter script")
+    convert.set_defaults(run=run_convert)
+
+    composite = commands.add_parser('composite', help="composite inputs into a prepared BAG 2.X output")
+    composite.add_argument('output', help="output bag with the NOAA_OCS_2022_10 layer and its records")
+    composite.add_argument('inputs', nargs='+',
+                           help="input bags in precedence order (lowest first), as path or path=record index")
+    composite.add_argument('--rule', default='last_wins', help="compositing rule (see bag_compositor.py)")
+    composite.add_argument('--workers', type=int, help="composite bands in this many worker processes")
+    composite.add_argument('--track-superseded', action='store_true',
+                           help="record every candidate value that lost to another input in the tracking list")
+    composite.add_argument('--shard-folder', help="only plan: write a shard job to this shared folder")
+    composite.add_argument('--shards', type=int, help="number of shards for --shard-folder")
+    composite.add_argument('--max-memory', help="memory budget, e.g. 4G (single-process mode)")
+    composite.add_argument('--live', action='store_true',
+                           help="write in HDF5 SWMR mode so the output can be viewed while it fills (see progress)")
+    composite.add_argument('--downsample', default='nearest', help="method for finer inputs (see bag_resample.py)")
+    composite.add_argument('--upsample', default='nearest', help="method for coarser inputs (see bag_resample.py)")
+    composite.set_defaults(run=run_composite)
+
+    progress = commands.add_parser('progress', help="progress of a composite written with --live")
+    progress.add_argument('bag', help="output bag being composited")
+    progress.set_defaults(run=run_progress)
+
+    plan = commands.add_parser('plan', help="estimate memory, disk and runtime of a conversion from the headers only")
+    plan.add_argument('inputs', nargs='+', help="input bags in precedence order (lowest first)")
+    plan.add_argument('--workers', type=int, help="plan for this many worker processes")
+    plan.add_argument('--shards', type=int, help="plan for a sharded job with this many shards")
+    plan.add_argument('--max-memory', help="memory budget, e.g. 4G (single-process mode)")
+    plan.add_argument('--compact', action='store_true', help="include the compaction step")
+    plan.add_argument('--track-superseded', action='store_true', help="include tracking list records")
+    plan.add_argument('--downsample', help="method for finer inputs (see bag_resample.py)")
+    plan.add_argument('--upsample', help="method for coarser inputs (see bag_resample.py)")
+    plan.add_argument('--throughput', help="throughput figures JSON from plan_conversion.py --calibrate")
+    plan.add_argument('--json', action='store_true', help="print the plan as JSON")
+    plan.set_defaults(run=run_plan)
+
+    fix_corners = commands.add_parser('fix-corners', help="fix the corner points of caris-derived bags")
+    fix_corners.add_argument('bags', nargs='+', help="bags to fix in place")
+    fix_corners.add_argument('-o', '--output', help="write the fixed copy here instead (single input only)")
+    fix_corners.set_defaults(run=run_fix_corners)
+
+    inspect = commands.add_parser('inspect', help="print version, grid and layers from the headers")
+    inspect.add_argument('paths', nargs='+', help="bag files, glob patterns or folders to search for *.bag")
+    inspect.add_argument('--json', action='store_true', help="one JSON object per file")
+    inspect.set_defaults(run=run_inspect)
+
+    validate = commands.add_parser('validate', help="validate BAG 2.X files (see validate_bag_v2x.py)")
+    validate.add_argument('paths', nargs='+', help="bag files, glob patterns or folders to search for *.bag")
+    validate.add_argument('--workers', type=int, help="worker processes (default: cpu count)")
+    validate.add_argument('--json', dest='json_path', help="also write the full report as JSON")
+    validate.set_defaults(run=run_validate)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        return args.run(args)
+    except (ValueError, OSError, KeyError) as e:
+        print(f"Error: {e}")
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,687 @@
+# -*- coding: utf-8 -*-
+"""
+Tile-by-tile compositor for create_bag_v2x.
+
+Every input bag is placed on the output lattice from its georeferencing, and the
+output grid is processed one tile at a time: the same window is read from all
+candidate inputs, stacked, and a compositing rule picks which input supplies each
+node. Elevation, uncertainty, keys and every optional layer shared by all inputs
+(nominal_elevation, standard_dev, num_hypotheses, ...) are then gathered from that
+one choice in the same pass, so the layers always agree and nothing larger than a
+tile stack is held in memory.
+
+Rules are plain NumPy functions over the stacked window:
+
+    rule(elevation, uncertainty, valid) -> winner
+
+elevation/uncertainty are float32 arrays of shape (n_inputs, rows, cols) in
+precedence order (lowest first, like DATA_LAYERS), valid is the matching boolean
+"has data" mask, and winner is an integer (rows, cols) array holding the index of
+the chosen input, or -1 where no input has data. Built-in rules are listed in
+RULES; a user rule can be passed as a callable or as "module:function".
+
+composite_bag(..., max_memory=<bytes>) sizes tiles, read threads and read-ahead
+from the HDF5 headers so a run stays under a fixed memory budget (plan_composite).
+
+Inputs at another resolution than the output are resampled onto the output
+lattice as each tile is read (ResampledInput, see bag_resample for the methods);
+nothing resampled is written to disk.
+
+composite_bag(..., live=True) writes in HDF5 single-writer/multiple-reader (SWMR)
+mode: every layer is created up front, then finished tiles and a small progress
+dataset (LIVE_PROGRESS_PATH) are flushed every `live_interval` seconds, so viewers
+opening the file with bag_utils.open_live_bag can watch it fill in. SWMR forbids
+attribute changes while readers are attached, so the min/max and tracking list
+length attributes are set, and the progress dataset removed, after the SWMR
+session is closed, once every viewer has closed the file (they hold a lock on it;
+composite_bag waits up to LIVE_DETACH_TIMEOUT seconds for them). SWMR needs the
+HDF5 1.10 file format, so an output in an older format is first rewritten with
+compact_bag; software built on HDF5 before 1.10 cannot read the result until it
+is compacted again without libver (the converter's COMPACT_OUTPUT step does this).
+"""
+
+import os
+import time
+import importlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import h5py
+from bag_statistics import KeyStatistics, layer_range, scan_range, record_labels
+from bag_utils import (read_bag_xml, get_grid_georef, get_grid_offset, same_resolution, iter_chunk_windows,
+                       chunk_aligned_tile, read_window, tracking_entries, TrackingListWriter, BAG_NO_DATA,
+                       ELEVATION_PATH, UNCERTAINTY_PATH, KEYS_PATH, VALUES_PATH, TRACK_CODE_COMPOSITED,
+                       LIVE_PROGRESS_PATH)
+from compact_bag import compact_bag
+import bag_resample
+
+DEFAULT_TILE_SIZE = (1024, 1024)
+MAX_PLANNED_TILE_SIZE = (4096, 4096)
+BASE_MEMORY = 256 * 1024 ** 2  # interpreter, numpy/h5py/lxml/bagPy and the file objects, before any tiles
+H5PY_CHUNK_CACHE = 1024 ** 2  # default raw data chunk cache per open dataset
+MANDATORY_LAYER_PATHS = (ELEVATION_PATH, UNCERTAINTY_PATH)
+DEFAULT_LIVE_INTERVAL = 30  # seconds between flushes of a live (SWMR) composite
+LIVE_DETACH_TIMEOUT = 600  # seconds to wait for live viewers to close the file before the final attributes
+
+
+def _no_winner(valid):
+    return ~valid.any(axis=0)
+
+
+def _last_in_precedence(choice):
+    """Index of the highest-precedence input where `choice` holds; -1 where it holds nowhere."""
+    n_inputs = choice.shape[0]
+    winner = n_inputs - 1 - np.argmax(choice[::-1], axis=0)
+    winner[~choice.any(axis=0)] = -1
+    return winner
+
+
+def last_wins(elevation, uncertainty, valid):
+    """Later (higher precedence) inputs overwrite earlier ones wherever they have data."""
+    return _last_in_precedence(valid)
+
+
+def min_uncertainty(elevation, uncertainty, valid):
+    """Input with the smallest uncertainty wins; ties go to the higher-precedence input."""
+    candidates = np.where(valid, uncertainty, np.inf)[::-1]
+    winner = valid.shape[0] - 1 - np.argmin(candidates, axis=0)
+    winner[_no_winner(valid)] = -1
+    return winner
+
+
+def shoalest(elevation, uncertainty, valid):
+    """Input with the shoalest (highest) elevation wins; ties go to the higher-precedence input."""
+    candidates = np.where(valid, elevation, -np.inf)[::-1]
+    winner = valid.shape[0] - 1 - np.argmax(candidates, axis=0)
+    winner[_no_winner(valid)] = -1
+    return winner
+
+
+def precedence_threshold(max_uncertainty):
+    """
+    Rule factory: the highest-precedence input whose uncertainty is within
+    `max_uncertainty` wins. Where no input meets the threshold, the input with the
+    smallest uncertainty is used instead.
+    """
+    def rule(elevation, uncertainty, valid):
+        winner = _last_in_precedence(valid & (uncertainty <= max_uncertainty))
+        fallback = winner < 0
+        if fallback.any():
+            winner[fallback] = min_uncertainty(elevation, uncertainty, valid)[fallback]
+        return winner
+    rule.__name__ = f"precedence_threshold({max_uncertainty})"
+    return rule
+
+
+RULES = {
+    'last_wins': last_wins,
+    'min_uncertainty': min_uncertainty,
+    'shoalest': shoalest,
+}
+
+
+def get_rule(rule):
+    """Resolve a rule given as a callable, a RULES name, 'precedence_threshold:<value>' or 'module:function'."""
+    if callable(rule):
+        return rule
+    if rule in RULES:
+        return RULES[rule]
+    name, _, argument = rule.partition(':')
+    if name == 'precedence_threshold' and argument:
+        return precedence_threshold(float(argument))
+    if argument:
+        return getattr(importlib.import_module(name), argument)
+    raise ValueError(f"Unknown compositing rule '{rule}'. Built-in rules: {', '.join(RULES)}, precedence_threshold:<value>")
+
+
+def _is_optional_layer(obj, shape):
+    """2D numeric /BAG_root dataset on the elevation lattice, other than elevation and uncertainty."""
+    return (isinstance(obj, h5py.Dataset) and obj.name not in MANDATORY_LAYER_PATHS and obj.shape == shape
+            and obj.dtype.kind in 'fiu')
+
+
+def shared_optional_layers(inputs):
+    """Paths of the optional layers every input carries, in a stable order."""
+    if not inputs:
+        return []
+    return sorted(set.intersection(*(source.optional_layers for source in inputs)))
+
+
+class CompositeInput:
+    """One source bag opened for windowed reads, placed on the output lattice."""
+
+    def __init__(self, name, data_path, record_index, row_offset, col_offset):
+        self.name = name
+        self.data_path = data_path
+        self.record_index = record_index
+        self.row_offset, self.col_offset = row_offset, col_offset
+        self.bag_file = h5py.File(data_path, 'r')
+        self.shape = self.bag_file[ELEVATION_PATH].shape
+        self.optional_layers = {dataset.name for dataset in self.bag_file['/BAG_root'].values()
+                                if _is_optional_layer(dataset, self.shape)}
+
+    def window(self, rows, cols):
+        """Overlap of an output window with this input: (output slices, input slices), or None."""
+        r0, r1 = max(rows.start, self.row_offset), min(rows.stop, self.row_offset + self.shape[0])
+        c0, c1 = max(cols.start, self.col_offset), min(cols.stop, self.col_offset + self.shape[1])
+        if r0 >= r1 or c0 >= c1:
+            return None
+        return ((slice(r0 - rows.start, r1 - rows.start), slice(c0 - cols.start, c1 - cols.start)),
+                (slice(r0 - self.row_offset, r1 - self.row_offset), slice(c0 - self.col_offset, c1 - self.col_offset)))
+
+    def read(self, path, rows, cols, out):
+        """Read this input's part of an output window of `path` into `out` (left untouched outside coverage)."""
+        overlap = self.window(rows, cols)
+        if overlap is not None:
+            dst, src = overlap
+            read_window(self.bag_file[path], *src, out[dst])
+
+    def read_bytes(self, nodes):
+        """Extra bytes held while reading an output window of `nodes` nodes (none: reads go straight into the stack)."""
+        return 0
+
+    def spec(self):
+        """(class, arguments) re-creating this input, e.g. in a worker process."""
+        return type(self), (self.name, self.data_path, self.record_index, self.row_offset, self.col_offset)
+
+    def close(self):
+        self.bag_file.close()
+
+
+class ResampledInput(CompositeInput):
+    """
+    A source bag at another resolution, resampled onto the output lattice with
+    `method` (see bag_resample) as windows are read. row_offset/col_offset/shape
+    describe its footprint on the output lattice.
+    """
+
+    def __init__(self, name, data_path, record_index, target_georef, method):
+        super().__init__(name, data_path, record_index, 0, 0)
+        self.target_georef, self.method = target_georef, method
+        source = get_grid_georef(read_bag_xml(self.bag_file))
+        block = method in bag_resample.BLOCK_METHODS
+        self.axes = (
+            bag_resample.ResampleAxis(target_georef['sw_y'], target_georef['y_res'], source['sw_y'], source['y_res'],
+                                      self.shape[0], block),
+            bag_resample.ResampleAxis(target_georef['sw_x'], target_georef['x_res'], source['sw_x'], source['x_res'],
+                                      self.shape[1], block),
+        )
+        self.source_shape = self.shape
+        self.row_offset, self.col_offset = self.axes[0].first, self.axes[1].first
+        self.shape = (max(self.axes[0].stop - self.axes[0].first, 0), max(self.axes[1].stop - self.axes[1].first, 0))
+        # source nodes per output node, for memory estimates
+        self.scale = max(target_georef['x_res'] * target_georef['y_res'] / (source['x_res'] * source['y_res']), 1.0)
+        self._selection = None
+
+    def _source(self, path, rows, cols):
+        block = np.empty((rows[1] - rows[0], cols[1] - cols[0]), dtype=self.bag_file[path].dtype)
+        return read_window(self.bag_file[path], slice(*rows), slice(*cols), block)
+
+    def _resample(self, path, rows, cols):
+        """Values of `path` at output nodes rows x cols (global (start, stop) pairs inside the footprint)."""
+        row_axis, col_axis = self.axes
+        if self.method == 'nearest':
+            row_index, col_index = row_axis.nearest(*rows), col_axis.nearest(*cols)
+            r0, c0 = row_index.min(), col_index.min()
+            block = self._source(path, (r0, row_index.max() + 1), (c0, col_index.max() + 1))
+            return bag_resample.nearest(block, row_index - r0, col_index - c0)
+        if self.method == 'bilinear':
+            row_weights, col_weights = row_axis.bilinear(*rows), col_axis.bilinear(*cols)
+            r0, c0 = row_weights[0].min(), col_weights[0].min()
+            block = self._source(path, (r0, row_weights[1].max() + 1), (c0, col_weights[1].max() + 1))
+            return bag_resample.bilinear(block, (row_weights[0] - r0, row_weights[1] - r0, row_weights[2]),
+                                         (col_weights[0] - c0, col_weights[1] - c0, col_weights[2]))
+        r_lo, r_hi, row_cells = row_axis.cells(*rows)
+        c_lo, c_hi, col_cells = col_axis.cells(*cols)
+        shape = (rows[1] - rows[0], cols[1] - cols[0])
+        cells = bag_resample.cell_ids(row_cells, col_cells, shape[1])
+        block = self._source(path, (r_lo, r_hi), (c_lo, c_hi))
+        if self.method == 'block_mean' and block.dtype.kind == 'f':
+            return bag_resample.block_mean(block, cells, shape[0] * shape[1]).reshape(shape)
+        # one node per cell, picked from the elevation; cached so every layer of a window takes the same nodes
+        key = (rows, cols)
+        if self._selection is None or self._selection[0] != key:
+            elevation = block if path == ELEVATION_PATH else self._source(ELEVATION_PATH, (r_lo, r_hi), (c_lo, c_hi))
+            self._selection = (key, bag_resample.block_selection(elevation, cells, self.method == 'block_min'))
+        occupied, chosen = self._selection[1]
+        result = np.full(shape[0] * shape[1], BAG_NO_DATA, dtype=block.dtype)
+        result[occupied] = block.ravel()[chosen]
+        return result.reshape(shape)
+
+    def read(self, path, rows, cols, out):
+        overlap = self.window(rows, cols)
+        if overlap is not None:
+            dst, src = overlap
+            out[dst] = self._resample(path, (src[0].start + self.row_offset, src[0].stop + self.row_offset),
+                                      (src[1].start + self.col_offset, src[1].stop + self.col_offset))
+
+    def read_bytes(self, nodes):
+        # source window plus a cell id per source node for the block methods
+        return int(nodes * self.scale * (np.dtype(np.float32).itemsize + 8))
+
+    def spec(self):
+        return type(self), (self.name, self.data_path, self.record_index, self.target_georef, self.method)
+
+
+def open_inputs(output_path, layers, record_indices, downsample='nearest', upsample='nearest'):
+    """
+    CompositeInputs for every layer with a record, in precedence order (lowest
+    first). Inputs at another resolution become ResampledInputs using `downsample`
+    (finer inputs) or `upsample` (coarser inputs).
+    """
+    with h5py.File(output_path, 'r') as f:
+        target_georef = get_grid_georef(read_bag_xml(f))
+    inputs = []
+    try:
+        for layer in layers:
+            real_index = record_indices.get(layer['key'])
+            if real_index is None or not os.path.exists(layer['data_path']):
+                continue
+            with h5py.File(layer['data_path'], 'r') as f:
+                source_georef = get_grid_georef(read_bag_xml(f))
+            if same_resolution(target_georef, source_georef):
+                row_offset, col_offset = get_grid_offset(target_georef, source_georef)
+                inputs.append(CompositeInput(layer['name'], layer['data_path'], real_index, row_offset, col_offset))
+            else:
+                method = bag_resample.resampling_method(target_georef, source_georef, downsample, upsample)
+                print(f"  '{layer['name']}' is at {source_georef['x_res']:g} x {source_georef['y_res']:g}, "
+                      f"resampled ({method}) to {target_georef['x_res']:g} x {target_georef['y_res']:g}")
+                inputs.append(ResampledInput(layer['name'], layer['data_path'], real_index, target_georef, method))
+    except Exception:
+        for source in inputs:
+            source.close()
+        raise
+    return inputs
+
+
+def read_tile_stack(inputs, rows, cols, optional_layers=None, executor=None):
+    """
+    Read one output window from every input into (elevation, uncertainty, stacks),
+    each of shape (n_inputs, rows, cols); stacks maps each path in `optional_layers`
+    (dataset path -> dtype) to its stack. With a thread pool `executor` the inputs
+    are read concurrently.
+    """
+    optional_layers = optional_layers or {}
+    shape = (len(inputs), rows.stop - rows.start, cols.stop - cols.start)
+    elevation = np.full(shape, BAG_NO_DATA, dtype=np.float32)
+    uncertainty = np.full(shape, BAG_NO_DATA, dtype=np.float32)
+    stacks = {path: np.full(shape, BAG_NO_DATA, dtype=dtype) for path, dtype in optional_layers.items()}
+
+    def read_input(i):
+        source = inputs[i]
+        source.read(ELEVATION_PATH, rows, cols, elevation[i])
+        source.read(UNCERTAINTY_PATH, rows, cols, uncertainty[i])
+        for path, stack in stacks.items():
+            source.read(path, rows, cols, stack[i])
+
+    if executor is not None and len(inputs) > 1:
+        list(executor.map(read_input, range(len(inputs))))
+    else:
+        for i in range(len(inputs)):
+            read_input(i)
+    return elevation, uncertainty, stacks
+
+
+def choose_winner(elevation, uncertainty, rule):
+    """Winner index per node (-1 where no input has data) for a tile stack from read_tile_stack."""
+    return np.asarray(rule(elevation, uncertainty, elevation != BAG_NO_DATA))
+
+
+def gather_stack(inputs, elevation, uncertainty, stacks, winner):
+    """Gather every layer of a tile stack from the winners. Returns (elevation, uncertainty, keys, optional)."""
+    empty = winner < 0
+    pick = np.where(empty, 0, winner)[np.newaxis]
+    out_elevation = np.take_along_axis(elevation, pick, axis=0)[0]
+    out_uncertainty = np.take_along_axis(uncertainty, pick, axis=0)[0]
+    record_keys = np.array([source.record_index for source in inputs], dtype=np.uint16)
+    out_keys = record_keys[pick[0]]
+    out_elevation[empty] = BAG_NO_DATA
+    out_uncertainty[empty] = BAG_NO_DATA
+    out_keys[empty] = 0
+    optional = {}
+    for path, stack in stacks.items():
+        optional[path] = np.take_along_axis(stack, pick, axis=0)[0]
+        optional[path][empty] = BAG_NO_DATA
+    return out_elevation, out_uncertainty, out_keys, optional
+
+
+def composite_stack(inputs, elevation, uncertainty, stacks, rule):
+    """Apply `rule` to a tile stack from read_tile_stack. Returns (elevation, uncertainty, keys, optional)."""
+    return gather_stack(inputs, elevation, uncertainty, stacks, choose_winner(elevation, uncertainty, rule))
+
+
+def superseded_entries(inputs, elevation, uncertainty, winner, row_start, col_start):
+    """
+    Tracking list records for every candidate that had data at a node but lost it to
+    another input: its depth and uncertainty, TRACK_CODE_COMPOSITED and its record
+    index as list_series. One np.nonzero over the stack, no per-node loop.
+    """
+    lost = (elevation != BAG_NO_DATA) & (np.arange(len(inputs))[:, np.newaxis, np.newaxis] != winner[np.newaxis])
+    index, rows, cols = np.nonzero(lost)
+    record_keys = np.array([source.record_index for source in inputs], dtype=np.int16)
+    return tracking_entries(rows + row_start, cols + col_start, elevation[index, rows, cols],
+                            uncertainty[index, rows, cols], TRACK_CODE_COMPOSITED, record_keys[index])
+
+
+def composite_tile(inputs, rows, cols, rule, optional_layers=None, executor=None):
+    """
+    Composite one output window. Returns (elevation, uncertainty, keys, optional)
+    for the window, where optional maps each path in `optional_layers` (dataset path
+    -> dtype) to its composited values.
+    """
+    return composite_stack(inputs, *read_tile_stack(inputs, rows, cols, optional_layers, executor), rule)
+
+
+def _optional_dtypes(inputs):
+    return {path: inputs[0].bag_file[path].dtype for path in shared_optional_layers(inputs)}
+
+
+def estimate_composite_memory(inputs, tile_shape, prefetch, read_workers, optional_layers=None):
+    """
+    Peak bytes composite_bag is expected to use for a tile shape: the tile stacks in
+    flight (the one being composited plus `prefetch` read ahead), the rule and
+    gather temporaries, h5py chunk caches, per-thread chunk buffers and BASE_MEMORY.
+    """
+    optional_layers = _optional_dtypes(inputs) if optional_layers is None else optional_layers
+    nodes = tile_shape[0] * tile_shape[1]
+    n_inputs = max(len(inputs), 1)
+    optional_bytes = sum(np.dtype(dtype).itemsize for dtype in optional_layers.values())
+    stack_bytes = n_inputs * nodes * (4 + 4 + optional_bytes)
+    # valid mask, rule candidates and argmax per input; winner, pick and outputs per node
+    work_bytes = n_inputs * nodes * (1 + 4 + 8) + nodes * (8 + 8 + 1 + 4 + 4 + 2 + optional_bytes)
+    open_datasets = n_inputs * (2 + len(optional_layers)) + 3 + len(optional_layers)
+    chunk_bytes = max((np.prod(source.bag_file[ELEVATION_PATH].chunks or source.shape) * 4 for source in inputs),
+                      default=0)
+    read_bytes = max((source.read_bytes(nodes) for source in inputs), default=0)
+    return int((1 + prefetch) * stack_bytes + work_bytes + open_datasets * H5PY_CHUNK_CACHE
+               + read_workers * (2 * chunk_bytes + read_bytes) + BASE_MEMORY)
+
+
+def plan_composite(output_path, inputs, max_memory):
+    """
+    Tile shape, read threads and prefetch depth for compositing `inputs` into
+    `output_path` within `max_memory` bytes, worked out from the HDF5 headers only.
+    Prefers tiles of at least DEFAULT_TILE_SIZE (up to MAX_PLANNED_TILE_SIZE) with
+    the deepest prefetch that fits, then the largest tile without prefetch. Raises
+    ValueError if even a single-chunk tile does not fit.
+    """
+    with h5py.File(output_path, 'r') as f:
+        shape, chunks = f[ELEVATION_PATH].shape, f[ELEVATION_PATH].chunks or f[ELEVATION_PATH].shape
+    optional_layers = _optional_dtypes(inputs)
+    # tiles past MAX_PLANNED_TILE_SIZE gain little throughput, so leftover budget goes to prefetch instead
+    max_steps = max(-(-min(shape[0], MAX_PLANNED_TILE_SIZE[0]) // chunks[0]),
+                    -(-min(shape[1], MAX_PLANNED_TILE_SIZE[1]) // chunks[1]))
+    target_nodes = min(DEFAULT_TILE_SIZE[0] * DEFAULT_TILE_SIZE[1], shape[0] * shape[1])
+
+    def clipped(steps):
+        return (min(steps * chunks[0], shape[0]), min(steps * chunks[1], shape[1]))
+
+    def largest_tile(prefetch, read_workers):
+        for steps in range(max_steps, 0, -1):
+            estimate = estimate_composite_memory(inputs, clipped(steps), prefetch, read_workers, optional_layers)
+            if estimate <= max_memory:
+                return clipped(steps), estimate
+        return None, None
+
+    read_workers = max(1, min(len(inputs), os.cpu_count() or 1))
+    for workers in sorted({read_workers, 1}, reverse=True):
+        for prefetch in (2, 1, 0):
+            tile, estimate = largest_tile(prefetch, workers)
+            if tile is not None and (tile[0] * tile[1] >= target_nodes or prefetch == 0):
+                return {'tile_size': tile, 'read_workers': workers, 'prefetch': prefetch, 'estimated_bytes': estimate}
+    raise ValueError(f"Memory budget of {max_memory} bytes is too small to composite {len(inputs)} input(s) "
+                     f"even one chunk {tuple(chunks)} at a time.")
+
+
+def _prepare_keys(f, shape):
+    """Keys dataset for the composite, re-created (keeping its attributes) if the bagPy one doesn't fit."""
+    keys = f.get(KEYS_PATH)
+    if keys is not None and keys.shape == shape and keys.dtype == np.uint16:
+        return keys
+    attrs = dict(keys.attrs) if keys is not None else {}
+    if keys is not None:
+        del f[KEYS_PATH]
+    keys = f.create_dataset(KEYS_PATH, shape=shape, dtype=np.uint16, chunks=(100, 100), compression=6)
+    for name, value in attrs.items():
+        keys.attrs[name] = value
+    return keys
+
+
+def _prepare_optional_layer(f, path, template, like):
+    """Output dataset for an optional layer: kept if it fits, otherwise created on the layout of `like`."""
+    dataset = f.get(path)
+    if dataset is not None and dataset.shape == like.shape and dataset.dtype == template.dtype:
+        return dataset
+    if dataset is not None:
+        del f[path]
+    dataset = f.create_dataset(path, shape=like.shape, dtype=template.dtype, chunks=like.chunks,
+                               compression=like.compression, compression_opts=like.compression_opts,
+                               fillvalue=BAG_NO_DATA)
+    for name, value in template.attrs.items():
+        dataset.attrs[name] = value
+    return dataset
+
+
+def extend_range(value_range, values):
+    """[min, max] widened to cover `values` (unchanged when it is empty)."""
+    if not values.size:
+        return value_range
+    return [min(value_range[0], values.min()), max(value_range[1], values.max())]
+
+
+def _set_min_max(dataset, min_name, max_name, min_value, max_value):
+    if min_value <= max_value:
+        dataset.attrs[min_name] = np.float32(min_value)
+        dataset.attrs[max_name] = np.float32(max_value)
+
+
+def _composite_statistics(f, inputs):
+    """KeyStatistics for a composite, binned over the inputs' min/max attribute ranges."""
+    ranges = []
+    for path, min_name, max_name in ((ELEVATION_PATH, 'Minimum Elevation Value', 'Maximum Elevation Value'),
+                                     (UNCERTAINTY_PATH, 'Minimum Uncertainty Value', 'Maximum Uncertainty Value')):
+        datasets = [source.bag_file[path] for source in inputs]
+        value_range = layer_range(datasets, min_name, max_name)
+        if value_range is None:
+            scanned = [scan_range(dataset) for dataset in datasets]
+            value_range = (min(r[0] for r in scanned), max(r[1] for r in scanned))
+        ranges.append(value_range)
+    return KeyStatistics(f[VALUES_PATH].shape[0], *ranges)
+
+
+def _prepare_live(output_path, inputs):
+    """
+    Get `output_path` ready for SWMR writing: HDF5 1.10 file format, and every
+    dataset composite_bag writes created, since SWMR mode allows neither new
+    datasets nor opening old-format objects when it starts.
+    """
+    with h5py.File(output_path, 'r') as f:
+        superblock = f.id.get_create_plist().get_version()[0]
+    if superblock < 3:
+        print("Rewriting the output in the HDF5 1.10 file format for live (SWMR) writing")
+        compact_bag(output_path, libver='latest')
+    with h5py.File(output_path, 'r+', libver='latest') as f:
+        elevation = f[ELEVATION_PATH]
+        _prepare_keys(f, elevation.shape)
+        for path in shared_optional_layers(inputs):
+            _prepare_optional_layer(f, path, inputs[0].bag_file[path], elevation)
+        if LIVE_PROGRESS_PATH in f:
+            del f[LIVE_PROGRESS_PATH]
+        f.create_dataset(LIVE_PROGRESS_PATH, data=np.zeros(3, dtype=np.int64))
+
+
+class LiveProgress:
+    """Tiles written to a file in SWMR mode, published in LIVE_PROGRESS_PATH and flushed every `interval` seconds."""
+
+    def __init__(self, f, tile, interval):
+        self.f, self.dataset, self.interval = f, f[LIVE_PROGRESS_PATH], interval
+        self.shape = f[ELEVATION_PATH].shape
+        self.total = -(-self.shape[0] // tile[0]) * -(-self.shape[1] // tile[1])
+        self.done, self.rows_complete, self.last_flush = 0, 0, time.monotonic()
+
+    def update(self, rows, cols):
+        """Count a written tile; True when a flush is due. Tiles arrive row band by row band, south first."""
+        self.done += 1
+        if cols.stop == self.shape[1]:
+            self.rows_complete = rows.stop
+        return time.monotonic() - self.last_flush >= self.interval
+
+    def flush(self):
+        self.dataset[...] = (self.done, self.total, self.rows_complete)
+        self.f.flush()
+        self.last_flush = time.monotonic()
+
+
+def _open_detached(path, timeout=LIVE_DETACH_TIMEOUT, interval=2):
+    """Open `path` for writing once no reader holds its lock any more; OSError after `timeout` seconds."""
+    deadline = time.monotonic() + timeout
+    waiting = False
+    while True:
+        try:
+            return h5py.File(path, 'r+')
+        except OSError as e:
+            if 'lock' not in str(e).lower():
+                raise
+            if time.monotonic() >= deadline:
+                raise OSError(f"Live viewers still have '{path}' open after {timeout} s; close them and set its "
+                              f"min/max attributes (e.g. by compositing again without live).") from e
+            if not waiting:
+                print(f"  Waiting for live viewers to close '{os.path.basename(path)}' (up to {timeout} s)")
+                waiting = True
+            time.sleep(interval)
+
+
+def _finish_composite(f, elev_range, uncert_range, optional_ranges, tracked):
+    """Min/max attributes of the composited layers and, if tracked, the tracking list length."""
+    _set_min_max(f[ELEVATION_PATH], 'Minimum Elevation Value', 'Maximum Elevation Value', *elev_range)
+    _set_min_max(f[UNCERTAINTY_PATH], 'Minimum Uncertainty Value', 'Maximum Uncertainty Value', *uncert_range)
+    for path, value_range in optional_ranges.items():
+        _set_min_max(f[path], 'min_value', 'max_value', *value_range)
+    if tracked:
+        TrackingListWriter(f).close()
+
+
+def composite_bag(output_path, inputs, rule='last_wins', tile_size=DEFAULT_TILE_SIZE, read_workers=None, prefetch=0,
+                  max_memory=None, collect_statistics=False, track_superseded=False, live=False,
+                  live_interval=DEFAULT_LIVE_INTERVAL):
+    """
+    Composite `inputs` (see open_inputs) into the elevation, uncertainty,
+    NOAA_OCS_2022_10 keys and shared optional layers of `output_path`, one tile at
+    a time. Optional layers not carried by every input are left as they are.
+    Each tile window is read from all inputs at once by `read_workers` threads
+    (default: one per input, 1 reads sequentially), and up to `prefetch` further
+    tiles are read ahead while the current one is composited and written.
+    With `max_memory` (bytes) tile_size, read_workers and prefetch are chosen by
+    plan_composite instead. With collect_statistics=True the per-record statistics
+    of the composite (see bag_statistics) are gathered in the same pass and returned.
+    With track_superseded=True every candidate value that lost to another input is
+    appended to the tracking list (see superseded_entries). With live=True the
+    output is written in SWMR mode and flushed every `live_interval` seconds (see
+    the module docstring).
+    """
+    rule = get_rule(rule)
+    if max_memory:
+        plan = plan_composite(output_path, inputs, max_memory)
+        tile_size, read_workers, prefetch = plan['tile_size'], plan['read_workers'], plan['prefetch']
+        print(f"Memory plan for {max_memory} bytes: tiles {tile_size[0]}x{tile_size[1]}, {read_workers} read "
+              f"thread(s), prefetch {prefetch} (estimated peak {plan['estimated_bytes']} bytes)")
+    read_workers = read_workers or max(len(inputs), 1)
+    if live:
+        _prepare_live(output_path, inputs)
+    with h5py.File(output_path, 'r+', libver='latest' if live else None) as f, \
+            ThreadPoolExecutor(max_workers=read_workers) as executor, ThreadPoolExecutor(max_workers=1) as prefetcher:
+        if live:
+            f.swmr_mode = True  # before any object is opened
+        elevation, uncertainty = f[ELEVATION_PATH], f[UNCERTAINTY_PATH]
+        keys = _prepare_keys(f, elevation.shape)
+        optional_paths = shared_optional_layers(inputs)
+        optional = {path: _prepare_optional_layer(f, path, inputs[0].bag_file[path], elevation)
+                    for path in optional_paths}
+        if optional_paths:
+            print(f"Compositing optional layers: {', '.join(os.path.basename(p) for p in optional_paths)}")
+        optional_dtypes = {path: dataset.dtype for path, dataset in optional.items()}
+        elev_range = [np.inf, -np.inf]
+        uncert_range = [np.inf, -np.inf]
+        optional_ranges = {path: [np.inf, -np.inf] for path in optional}
+        statistics = _composite_statistics(f, inputs) if collect_statistics else None
+        tracking = TrackingListWriter(f) if track_superseded else None
+        tile_size = chunk_aligned_tile(elevation, tile_size)
+        progress = LiveProgress(f, tile_size, live_interval) if live else None
+        if live:
+            print(f"Writing live (SWMR): progress in '{LIVE_PROGRESS_PATH}' every {live_interval} s")
+
+        def write_tile(rows, cols, stack):
+            nonlocal elev_range, uncert_range
+            winner = choose_winner(stack[0], stack[1], rule)
+            tile_elevation, tile_uncertainty, tile_keys, tile_optional = gather_stack(inputs, *stack, winner)
+            if tracking is not None:
+                tracking.add(superseded_entries(inputs, stack[0], stack[1], winner, rows.start, cols.start))
+            elevation[rows, cols] = tile_elevation
+            uncertainty[rows, cols] = tile_uncertainty
+            keys[rows, cols] = tile_keys
+            for path, values in tile_optional.items():
+                optional[path][rows, cols] = values
+            if statistics is not None:
+                statistics.update(tile_keys, tile_elevation, tile_uncertainty)
+            has_data = tile_keys != 0
+            elev_range = extend_range(elev_range, tile_elevation[has_data])
+            uncert_range = extend_range(uncert_range, tile_uncertainty[has_data])
+            for path, values in tile_optional.items():
+                optional_ranges[path] = extend_range(optional_ranges[path], values[values != values.dtype.type(BAG_NO_DATA)])
+            if progress is not None and progress.update(rows, cols):
+                if tracking is not None:
+                    tracking.flush()
+                progress.flush()
+
+        # reads for the next `prefetch` tiles run on the prefetcher while this one is composited and written
+        pending = deque()
+        for rows, cols in iter_chunk_windows(elevation.shape, tile_size):
+            pending.append((rows, cols, prefetcher.submit(read_tile_stack, inputs, rows, cols, optional_dtypes, executor)))
+            if len(pending) > prefetch:
+                rows, cols, stack = pending.popleft()
+                write_tile(rows, cols, stack.result())
+        while pending:
+            rows, cols, stack = pending.popleft()
+            write_tile(rows, cols, stack.result())
+        if tracking is not None:
+            tracking.flush()
+            print(f"Tracking list: {tracking.written} superseded candidate value(s) recorded")
+        result = None
+        if statistics is not None:
+            georef = get_grid_georef(read_bag_xml(f))
+            result = statistics.result(georef['x_res'] * georef['y_res'], record_labels(f))
+        if progress is None:
+            _finish_composite(f, elev_range, uncert_range, optional_ranges, track_superseded)
+        else:
+            progress.flush()
+    if live:
+        # viewers were told every tile is flushed; attributes can only change once they have let go of the file
+        with _open_detached(output_path) as f:
+            _finish_composite(f, elev_range, uncert_range, optional_ranges, track_superseded)
+            del f[LIVE_PROGRESS_PATH]
+    return result
+
+
+def write_single_source_keys(f, record_index, chunks=(100, 100), compression=6):
+    """
+    Keys layer for a bag built from a single source. The dataset is created with
+    the record index as its fill value, and only chunks that contain nodata nodes are
+    written explicitly; fully covered chunks stay unallocated and read back as the
+    record index. Returns the number of chunks written.
+    """
+    elevation = f[ELEVATION_PATH]
+    attrs = dict(f[KEYS_PATH].attrs) if KEYS_PATH in f else {}
+    if KEYS_PATH in f:
+        del f[KEYS_PATH]
+    chunks = (min(chunks[0], elevation.shape[0]), min(chunks[1], elevation.shape[1]))
+    keys = f.create_dataset(KEYS_PATH, shape=elevation.shape, dtype=np.uint16, chunks=chunks,
+                            compression=compression, fillvalue=record_index)
+    for name, value in attrs.items():
+        keys.attrs[name] = value
+    chunks_written = 0
+    for rows, cols in iter_chunk_windows(keys.shape, keys.chunks):
+        empty = elevation[rows, cols] == BAG_NO_DATA
+        if empty.any():
+            keys[rows, cols] = np.where(empty, 0, record_index).astype(np.uint16)
+            chunks_written += 1
+    return chunks_written
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Fast diff between two versions of a BAG 2.X composite.
+
+Elevation, uncertainty and keys are compared chunk by chunk through hashes of the
+raw (still compressed) chunk bytes read with read_direct_chunk, so unchanged chunks
+are never decompressed. Only chunks whose hashes differ - or every chunk, when the
+two files use different chunking/filters - are decoded and compared node by node.
+Reported per layer: changed node count, changed chunks, the bounding box of the
+change (grid and map coordinates) and, for float layers, the largest difference.
+The NOAA_OCS_2022_10 value table is compared record by record and the embedded
+XML as text.
+
+usage: python bag_diff.py <old.bag> <new.bag> [--json diff.json]
+"""
+
+import sys
+import json
+import difflib
+import hashlib
+import argparse
+import numpy as np
+import h5py
+import xml.etree.ElementTree as StdET
+from bag_utils import (read_bag_xml, get_grid_georef, decode_value_field, allocated_chunks, direct_chunk_filters,
+                       read_window, iter_chunk_windows, ELEVATION_PATH, UNCERTAINTY_PATH, KEYS_PATH, VALUES_PATH)
+
+DIFF_LAYERS = {'elevation': ELEVATION_PATH, 'uncertainty': UNCERTAINTY_PATH, 'keys': KEYS_PATH}
+MAX_XML_DIFF_LINES = 200
+
+
+def chunk_digests(dataset):
+    """{chunk origin: (filter mask, blake2b digest of the raw stored chunk)} for every allocated chunk."""
+    digests = {}
+    for origin in allocated_chunks(dataset.id):
+        filter_mask, raw = dataset.id.read_direct_chunk(origin)
+        digests[tuple(origin)] = (filter_mask, hashlib.blake2b(raw, digest_size=16).digest())
+    return digests
+
+
+def _same_storage(old, new):
+    """True when raw chunk bytes of the two datasets are directly comparable."""
+    return (old.chunks is not None and old.chunks == new.chunks and old.dtype == new.dtype
+            and direct_chunk_filters(old) is not None and direct_chunk_filters(old) == direct_chunk_filters(new)
+            and old.fillvalue == new.fillvalue)
+
+
+def _changed_nodes(old_block, new_block):
+    if old_block.dtype.kind == 'f':
+        return (old_block != new_block) & ~(np.isnan(old_block) & np.isnan(new_block))
+    return old_block != new_block
+
+
+def diff_layer(old, new, georef=None):
+    """Compare two 2D layers; only chunks whose hashes differ are decoded."""
+    if old.shape != new.shape:
+        return {'shape_changed': [list(old.shape), list(new.shape)]}
+    hashed = bool(_same_storage(old, new))
+    if hashed:
+        old_digests, new_digests = chunk_digests(old), chunk_digests(new)
+    chunks = new.chunks or (min(256, new.shape[0]), min(256, new.shape[1]))
+
+    changed_nodes = changed_chunks = decoded_chunks = 0
+    bbox = [np.inf, np.inf, -np.inf, -np.inf]  # row min, col min, row max, col max
+    max_difference = 0.0
+    for rows, cols in iter_chunk_windows(new.shape, chunks):
+        if hashed and old_digests.get((rows.start, cols.start)) == new_digests.get((rows.start, cols.start)):
+            continue
+        decoded_chunks += 1
+        shape = (rows.stop - rows.start, cols.stop - cols.start)
+        old_block = read_window(old, rows, cols, np.empty(shape, dtype=old.dtype))
+        new_block = read_window(new, rows, cols, np.empty(shape, dtype=new.dtype))
+        changed = _changed_nodes(old_block, new_block)
+        if not changed.any():
+            continue
+        changed_chunks += 1
+        changed_nodes += int(changed.sum())
+        node_rows, node_cols = np.nonzero(changed)
+        bbox = [min(bbox[0], rows.start + node_rows.min()), min(bbox[1], cols.start + node_cols.min()),
+                max(bbox[2], rows.start + node_rows.max()), max(bbox[3], cols.start + node_cols.max())]
+        if new.dtype.kind == 'f':
+            max_difference = max(max_difference, float(np.nanmax(np.abs(
+                new_block[changed].astype(np.float64) - old_block[changed].astype(np.float64)))))
+
+    result = {'changed_nodes': changed_nodes, 'changed_chunks': changed_chunks, 'decoded_chunks': decoded_chunks,
+              'hashed': hashed}
+    if changed_nodes:
+        result['bbox_rows_cols'] = [int(v) for v in bbox]
+        if georef:
+            result['bbox_map'] = [georef['sw_x'] + bbox[1] * georef['x_res'], georef['sw_y'] + bbox[0] * georef['y_res'],
+                                  georef['sw_x'] + bbox[3] * georef['x_res'], georef['sw_y'] + bbox[2] * georef['y_res']]
+        if new.dtype.kind == 'f':
+            result['max_abs_difference'] = max_difference
+    return result
+
+
+def _records(values):
+    columns = {field: decode_value_field(values[field]).tolist() for field in values.dtype.names}
+    return [{field: columns[field][i] for field in values.dtype.names} for i in range(len(values))]
+
+
+def diff_value_tables(old_values, new_values):
+    """Records added/removed (by index) and fields changed in records present in both."""
+    old_records, new_records = _records(old_values), _records(new_values)
+    changed = {}
+    for index, (old_record, new_record) in enumerate(zip(old_records, new_records)):
+        fields = {field: [old_record.get(field), value] for field, value in new_record.items()
+                  if old_record.get(field) != value}
+        if fields:
+            changed[index] = fields
+    return {
+        'added': list(range(len(old_records), len(new_records))),
+        'removed': list(range(len(new_records), len(old_records))),
+        'changed': changed,
+    }
+
+
+def diff_xml(old_metadata, new_metadata):
+    """Unified diff of the indented XML, capped at MAX_XML_DIFF_LINES lines."""
+    def lines(metadata):
+        StdET.indent(metadata)
+        return StdET.tostring(metadata, encoding='unicode').splitlines()
+    diff = list(difflib.unified_diff(lines(old_metadata), lines(new_metadata), 'old', 'new', lineterm='', n=1))
+    return diff[:MAX_XML_DIFF_LINES] + (['...'] if len(diff) > MAX_XML_DIFF_LINES else [])
+
+
+def diff_bags(old_path, new_path):
+    """Diff two bags; returns {'layers': {...}, 'records': {...}, 'xml': [...], 'attributes': {...}}."""
+    with h5py.File(old_path, 'r') as old, h5py.File(new_path, 'r') as new:
+        old_metadata, new_metadata = read_bag_xml(old), read_bag_xml(new)
+        try:
+            georef = get_grid_georef(new_metadata)
+        except ValueError:
+            georef = None
+        result = {'old': old_path, 'new': new_path, 'layers': {}, 'attributes': {}}
+        for name, path in DIFF_LAYERS.items():
+            if path in old and path in new:
+                result['layers'][name] = diff_layer(old[path], new[path], georef)
+            elif path in old or path in new:
+                result['layers'][name] = {'only_in': 'old' if path in old else 'new'}
+        for path in ('/BAG_root',) + tuple(DIFF_LAYERS.values()):
+            if path in old and path in new:
+                for attr in sorted(set(old[path].attrs) | set(new[path].attrs)):
+                    old_value, new_value = old[path].attrs.get(attr), new[path].attrs.get(attr)
+                    if np.asarray(old_value).tolist() != np.asarray(new_value).tolist():
+                        result['attributes'][f"{path}:{attr}"] = [str(old_value), str(new_value)]
+        if VALUES_PATH in old and VALUES_PATH in new:
+            result['records'] = diff_value_tables(old[VALUES_PATH][()], new[VALUES_PATH][()])
+        result['xml'] = diff_xml(old_metadata, new_metadata)
+    return result
+
+
+def print_diff(result):
+    for name, layer in result['layers'].items():
+        if 'changed_nodes' not in layer:
+            print(f"{name}: {layer}")
+        elif layer['changed_nodes']:
+            where = f" in rows {layer['bbox_rows_cols'][0]}-{layer['bbox_rows_cols'][2]}, " \
+                    f"cols {layer['bbox_rows_cols'][1]}-{layer['bbox_rows_cols'][3]}"
+            print(f"{name}: {layer['changed_nodes']} node(s) changed in {layer['changed_chunks']} chunk(s){where}")
+        else:
+            print(f"{name}: unchanged ({layer['decoded_chunks']} chunk(s) decoded)")
+    records = result.get('records')
+    if records:
+        print(f"records: {len(records['added'])} added, {len(records['removed'])} removed, "
+              f"{len(records['changed'])} changed")
+    for attr, (old_value, new_value) in result['attributes'].items():
+        print(f"attribute {attr}: {old_value} -> {new_value}")
+    if result['xml']:
+        print(f"xml: {sum(1 for line in result['xml'] if line[:1] in '+-' and line[:3] not in ('---', '+++'))} "
+              f"line(s) changed")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Diff two versions of a BAG 2.X file.")
+    parser.add_argument('old', help="previous bag")
+    parser.add_argument('new', help="re-issued bag")
+    parser.add_argument('--json', dest='json_path', help="also write the full diff as JSON")
+    args = parser.parse_args(argv)
+    try:
+        result = diff_bags(args.old, args.new)
+    except (OSError, KeyError) as e:
+        print(f"Error: {e}")
+        return 2
+    print_diff(result)
+    if args.json_path:
+        with open(args.json_path, 'w') as out:
+            json.dump(result, out, indent=1, default=str)
+    changed = (any(layer.get('changed_nodes') or 'changed_nodes' not in layer for layer in result['layers'].values())
+               or result['attributes'] or result['xml']
+               or any(result.get('records', {}).values()))
+    return 1 if changed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Transactional editor for the metadata embedded in a BAG file.
+
+All edits (corner points, bag version, lineage process steps, arbitrary text
+fields) are made against one parsed XML tree and written back once, when the
+session commits:
+
+    with BagMetadataSession(bag_path) as session:
+        session.fix_corner_points()
+        session.set_version()
+        session.add_process_step("Composite BAG created ...")
+
+Leaving the `with` block through an exception discards every staged change.
+"""
+
+import h5py
+import numpy as np
+from bag_utils import read_bag_xml, write_bag_xml, update_corner_points, add_lineage_step, namespaces, BAG_VERSION
+
+
+class BagMetadataSession:
+    def __init__(self, bag, timestamp=None):
+        """`bag` is a file path (opened r+ for the session) or an already open, writable h5py.File."""
+        self._owns_file = not isinstance(bag, h5py.File)
+        self.bag_file = h5py.File(bag, 'r+') if self._owns_file else bag
+        self.metadata = read_bag_xml(self.bag_file)
+        self.timestamp = timestamp
+        self.version = None
+        self.xml_changed = False
+
+    def fix_corner_points(self):
+        """Recompute the north-east corner point from the grid dimensions (caris bug)."""
+        if update_corner_points(self.metadata) is None:
+            raise ValueError("Failed to update corner points.")
+        self.xml_changed = True
+
+    def set_version(self, version=BAG_VERSION):
+        """Stage the 'Bag Version' attribute of BAG_root."""
+        self.version = version
+
+    def add_process_step(self, description_text):
+        """Stage a lineage process step. Returns False if the document has no LI_Lineage."""
+        added = add_lineage_step(self.metadata, description_text, self.timestamp)
+        self.xml_changed = self.xml_changed or added
+        return added
+
+    def set_text(self, path, text):
+        """Stage new text for the first element matching `path` (ElementPath with gmd/gco/... prefixes)."""
+        element = self.metadata.find(path, namespaces)
+        if element is None:
+            raise ValueError(f"No element matches '{path}'.")
+        element.text = text
+        self.xml_changed = True
+
+    def commit(self):
+        if self.xml_changed:
+            write_bag_xml(self.bag_file, self.metadata)
+            self.xml_changed = False
+        if self.version is not None:
+            self.bag_file['/BAG_root'].attrs['Bag Version'] = np.bytes_(self.version)
+            self.version = None
+
+    def close(self):
+        if self._owns_file:
+            self.bag_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.commit()
+        finally:
+            self.close()
+        return False
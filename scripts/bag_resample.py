@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Resampling of a grid at another resolution onto the output lattice, one window at a time.
+
+Both grids are node-based (values at cell centres, row 0 at the south edge), so
+each axis maps independently:
+
+    nearest     the source node whose cell holds the output node (up- or downsampling)
+    bilinear    weighted from the four surrounding source nodes; where one of them
+                has no data the nearest value is used, so coverage matches nearest
+    block_mean  mean of the source nodes inside the output node's cell (downsampling)
+    block_min   the source node with the lowest elevation inside the cell; the other
+                layers take that same node so elevation and uncertainty stay paired
+
+Nodes are reduced per cell with np.bincount over a cell id per source node, as in
+bag_statistics, so no loop runs per output node.
+"""
+
+import math
+import numpy as np
+from bag_utils import BAG_NO_DATA
+
+UPSAMPLING_METHODS = ('nearest', 'bilinear')
+DOWNSAMPLING_METHODS = ('nearest', 'block_mean', 'block_min')
+BLOCK_METHODS = ('block_mean', 'block_min')
+_EPS = 1e-6  # in node units, absorbs float noise in georeferencing
+
+
+def _floor(value):
+    return math.floor(value + _EPS)
+
+
+def _ceil(value):
+    return math.ceil(value - _EPS)
+
+
+def resampling_method(target_georef, source_georef, downsample='nearest', upsample='nearest'):
+    """The method for a source grid: `downsample` if it is finer on both axes, otherwise `upsample`."""
+    if downsample not in DOWNSAMPLING_METHODS:
+        raise ValueError(f"Unknown downsampling method '{downsample}'. Use one of: {', '.join(DOWNSAMPLING_METHODS)}")
+    if upsample not in UPSAMPLING_METHODS:
+        raise ValueError(f"Unknown upsampling method '{upsample}'. Use one of: {', '.join(UPSAMPLING_METHODS)}")
+    finer = (source_georef['x_res'] <= target_georef['x_res'] and source_georef['y_res'] <= target_georef['y_res'])
+    return downsample if finer else upsample
+
+
+class ResampleAxis:
+    """One axis of a source grid (n nodes from s0, spacing s_res) seen from the output lattice (t0, t_res)."""
+
+    def __init__(self, t0, t_res, s0, s_res, n, block):
+        self.t0, self.t_res, self.s0, self.s_res, self.n = t0, t_res, s0, s_res, n
+        if block:
+            # output cells [p - t_res/2, p + t_res/2) holding at least one source node
+            self.first = _floor((s0 - t0) / t_res + 0.5)
+            self.stop = _floor((s0 + (n - 1) * s_res - t0) / t_res + 0.5) + 1
+        else:
+            # output nodes inside the source cells
+            self.first = _ceil((s0 - 0.5 * s_res - t0) / t_res)
+            self.stop = _ceil((s0 + (n - 0.5) * s_res - t0) / t_res)
+
+    def position(self, start, stop):
+        """Fractional source index of output nodes start..stop."""
+        return (self.t0 + np.arange(start, stop) * self.t_res - self.s0) / self.s_res
+
+    def nearest(self, start, stop):
+        return np.clip(np.floor(self.position(start, stop) + 0.5 + _EPS).astype(np.intp), 0, self.n - 1)
+
+    def bilinear(self, start, stop):
+        """(lower index, upper index, weight of the upper one) for output nodes start..stop."""
+        position = self.position(start, stop)
+        lower = np.clip(np.floor(position + _EPS).astype(np.intp), 0, max(self.n - 2, 0))
+        return lower, np.minimum(lower + 1, self.n - 1), np.clip(position - lower, 0.0, 1.0)
+
+    def cells(self, start, stop):
+        """Source span [lo, hi) under the cells of output nodes start..stop, and each source node's cell (0-based)."""
+        lo = max(_ceil((self.t0 + (start - 0.5) * self.t_res - self.s0) / self.s_res), 0)
+        hi = min(_ceil((self.t0 + (stop - 0.5) * self.t_res - self.s0) / self.s_res), self.n)
+        cell = np.floor((self.s0 + np.arange(lo, hi) * self.s_res - self.t0) / self.t_res + 0.5 + _EPS).astype(np.intp)
+        return lo, hi, np.clip(cell - start, 0, stop - start - 1)
+
+
+def nearest(block, row_index, col_index):
+    """Gather from a source window; indices are relative to the window."""
+    return block[np.ix_(row_index, col_index)]
+
+
+def bilinear(block, rows, cols):
+    """
+    Bilinear interpolation from a source window; rows/cols are ResampleAxis.bilinear
+    results relative to the window. Nodes with a no-data corner take the nearest value.
+    """
+    (r0, r1, wr), (c0, c1, wc) = rows, cols
+    nearest_value = block[np.ix_(np.where(wr >= 0.5, r1, r0), np.where(wc >= 0.5, c1, c0))]
+    if block.dtype.kind != 'f':
+        return nearest_value
+    corners = [block[np.ix_(r, c)].astype(np.float64) for r in (r0, r1) for c in (c0, c1)]
+    wr, wc = wr[:, np.newaxis], wc[np.newaxis, :]
+    value = ((1 - wr) * ((1 - wc) * corners[0] + wc * corners[1]) + wr * ((1 - wc) * corners[2] + wc * corners[3]))
+    complete = np.logical_and.reduce([corner != BAG_NO_DATA for corner in corners])
+    return np.where(complete, value, nearest_value).astype(block.dtype)
+
+
+def cell_ids(row_cells, col_cells, n_cols):
+    """Flat output cell id of every node of a source window."""
+    return (row_cells[:, np.newaxis] * n_cols + col_cells[np.newaxis, :]).ravel()
+
+
+def block_selection(elevation, cells, lowest):
+    """
+    (cells, flat source indices) choosing one data node per occupied cell: the lowest
+    elevation with lowest=True, otherwise the first node in storage order.
+    """
+    data = np.flatnonzero(elevation.ravel() != BAG_NO_DATA)
+    if lowest:
+        order = np.lexsort((elevation.ravel()[data], cells[data]))
+    else:
+        order = np.argsort(cells[data], kind='stable')
+    chosen = data[order]
+    occupied, first = np.unique(cells[chosen], return_index=True)
+    return occupied, chosen[first]
+
+
+def block_mean(block, cells, n_cells):
+    """Mean of the data nodes of a float source window per output cell (no-data where a cell has none)."""
+    values = block.ravel()
+    data = values != BAG_NO_DATA
+    counts = np.bincount(cells[data], minlength=n_cells)
+    sums = np.bincount(cells[data], weights=values[data], minlength=n_cells)
+    result = np.full(n_cells, BAG_NO_DATA, dtype=block.dtype)
+    result[counts > 0] = sums[counts > 0] / counts[counts > 0]
+    return result
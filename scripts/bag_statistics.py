@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Per-record coverage and depth statistics for a BAG 2.X composite.
+
+For every NOAA_OCS_2022_10 key: node count, area, and elevation/uncertainty
+min/max/mean/std and percentiles. Everything is accumulated tile by tile with
+bincount-style reductions, so one pass covers all keys:
+    - count / sum / sum of squares with np.bincount weighted by the values
+    - min / max with np.minimum/maximum.reduceat over the tile sorted by key
+    - percentiles from fixed-bin histograms per key (one bincount over key * bins + bin),
+      binned over the layer's min/max attribute range, so they are exact to within
+      one bin width ((max - min) / bins); if a tile holds values outside that range
+      (stale attributes) the range is doubled by merging neighbouring bins until it fits
+
+Run standalone on an existing BAG, or let composite_bag collect the same numbers
+while it writes the composite (collect_statistics=True).
+
+usage: python bag_statistics.py <bag> [--json stats.json] [--lineage]
+"""
+
+import sys
+import json
+import argparse
+import numpy as np
+import h5py
+from bag_utils import (read_bag_xml, get_grid_georef, decode_value_field, iter_chunk_windows, chunk_aligned_tile,
+                       BAG_NO_DATA, ELEVATION_PATH, UNCERTAINTY_PATH, KEYS_PATH, VALUES_PATH)
+from bag_metadata_editor import BagMetadataSession
+
+DEFAULT_BINS = 4096
+DEFAULT_PERCENTILES = (5, 25, 50, 75, 95)
+DEFAULT_TILE_SIZE = (1024, 1024)
+
+
+class _LayerStatistics:
+    """Per-key accumulators for one layer (elevation or uncertainty)."""
+
+    def __init__(self, n_keys, value_range, bins):
+        self.n_keys, self.bins = n_keys, bins + bins % 2
+        self.low, self.high = float(value_range[0]), float(value_range[1])
+        if not self.high > self.low:
+            self.high = self.low + 1.0
+        self.sum = np.zeros(n_keys)
+        self.sum_sq = np.zeros(n_keys)
+        self.min = np.full(n_keys, np.inf)
+        self.max = np.full(n_keys, -np.inf)
+        self.histogram = np.zeros(n_keys * self.bins, dtype=np.int64)
+
+    def _double_range(self, below):
+        """Merge bin pairs and extend the range by its own width, downwards or upwards."""
+        half = self.bins // 2
+        merged = self.histogram.reshape(self.n_keys, half, 2).sum(axis=2)
+        histogram = np.zeros((self.n_keys, self.bins), dtype=np.int64)
+        width = self.high - self.low
+        if below:
+            histogram[:, half:] = merged
+            self.low -= width
+        else:
+            histogram[:, :half] = merged
+            self.high += width
+        self.histogram = histogram.ravel()
+
+    def update(self, keys, values, sorted_keys, order, starts):
+        values = values.astype(np.float64)
+        while values.min() < self.low or values.max() > self.high:
+            self._double_range(below=values.min() < self.low)
+        self.sum += np.bincount(keys, weights=values, minlength=self.n_keys)
+        self.sum_sq += np.bincount(keys, weights=values * values, minlength=self.n_keys)
+        sorted_values = values[order]
+        tile_keys = sorted_keys[starts]
+        self.min[tile_keys] = np.minimum(self.min[tile_keys], np.minimum.reduceat(sorted_values, starts))
+        self.max[tile_keys] = np.maximum(self.max[tile_keys], np.maximum.reduceat(sorted_values, starts))
+        width = self.high - self.low
+        bin_index = np.clip(((values - self.low) / width * self.bins).astype(np.int64), 0, self.bins - 1)
+        self.histogram += np.bincount(keys.astype(np.int64) * self.bins + bin_index, minlength=self.histogram.size)
+
+    def percentiles(self, key, count, percentiles):
+        """Percentiles for one key from its histogram, interpolated linearly inside the bin."""
+        histogram = self.histogram[key * self.bins:(key + 1) * self.bins]
+        cumulative = np.cumsum(histogram)
+        width = (self.high - self.low) / self.bins
+        result = {}
+        for p in percentiles:
+            target = p / 100.0 * count
+            b = int(np.searchsorted(cumulative, max(target, 1), side='left'))
+            below = cumulative[b - 1] if b else 0
+            fraction = (target - below) / histogram[b] if histogram[b] else 0.0
+            value = self.low + (b + min(max(fraction, 0.0), 1.0)) * width
+            result[f'p{p:g}'] = float(np.clip(value, self.min[key], self.max[key]))
+        return result
+
+    def summary(self, key, count, percentiles):
+        mean = self.sum[key] / count
+        return {
+            'min': float(self.min[key]), 'max': float(self.max[key]), 'mean': float(mean),
+            'std': float(np.sqrt(max(self.sum_sq[key] / count - mean * mean, 0.0))),
+            **self.percentiles(key, count, percentiles),
+        }
+
+
+class KeyStatistics:
+    """
+    Streaming per-key statistics. `elevation_range` / `uncertainty_range` set the
+    initial histogram bins; they grow (at half the resolution per doubling) if the
+    data turns out to reach past them.
+    """
+
+    def __init__(self, n_keys, elevation_range, uncertainty_range, bins=DEFAULT_BINS):
+        self.n_keys = n_keys
+        self.count = np.zeros(n_keys, dtype=np.int64)
+        self.elevation = _LayerStatistics(n_keys, elevation_range, bins)
+        self.uncertainty = _LayerStatistics(n_keys, uncertainty_range, bins)
+
+    def update(self, keys, elevation, uncertainty):
+        """Add one tile; arrays of any shape, nodes with key 0 (no data) are ignored."""
+        has_data = keys != 0
+        keys, elevation, uncertainty = keys[has_data].astype(np.intp), elevation[has_data], uncertainty[has_data]
+        if not keys.size:
+            return
+        self.count += np.bincount(keys, minlength=self.n_keys)
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        self.elevation.update(keys, elevation, sorted_keys, order, starts)
+        self.uncertainty.update(keys, uncertainty, sorted_keys, order, starts)
+
+    def result(self, node_area, records=None, percentiles=DEFAULT_PERCENTILES):
+        """{key: statistics} for every key with data; `records` maps key -> survey id for labelling."""
+        stats = {}
+        for key in np.flatnonzero(self.count):
+            count = int(self.count[key])
+            stats[int(key)] = {
+                'survey': (records or {}).get(int(key)),
+                'node_count': count,
+                'area': count * node_area,
+                'elevation': self.elevation.summary(key, count, percentiles),
+                'uncertainty': self.uncertainty.summary(key, count, percentiles),
+            }
+        return stats
+
+
+def _attr_range(dataset, min_name, max_name):
+    if min_name in dataset.attrs and max_name in dataset.attrs:
+        return float(dataset.attrs[min_name]), float(dataset.attrs[max_name])
+    return None
+
+
+def layer_range(datasets, min_name, max_name):
+    """Union of the min/max attribute ranges of `datasets`, or None if any lacks them."""
+    ranges = [_attr_range(dataset, min_name, max_name) for dataset in datasets]
+    if not ranges or None in ranges:
+        return None
+    return min(r[0] for r in ranges), max(r[1] for r in ranges)
+
+
+def record_labels(bag_file):
+    """key -> source survey id from the value table (empty when the bag has none)."""
+    if VALUES_PATH not in bag_file:
+        return {}
+    values = bag_file[VALUES_PATH][()]
+    if 'source_survey_id' not in values.dtype.names:
+        return {}
+    return dict(enumerate(decode_value_field(values['source_survey_id']).tolist()))
+
+
+def scan_range(dataset, tile_size=DEFAULT_TILE_SIZE):
+    """(min, max) of the data nodes of a layer, for files without min/max attributes."""
+    low, high = np.inf, -np.inf
+    for rows, cols in iter_chunk_windows(dataset.shape, chunk_aligned_tile(dataset, tile_size)):
+        block = dataset[rows, cols]
+        block = block[block != BAG_NO_DATA]
+        if block.size:
+            low, high = min(low, block.min()), max(high, block.max())
+    return (low, high) if low <= high else (0.0, 0.0)
+
+
+def statistics_lineage_text(stats):
+    """One-paragraph description of the statistics for a lineage process step."""
+    parts = []
+    for key, s in stats.items():
+        e = s['elevation']
+        parts.append(f"record {key} ({s['survey'] or 'unnamed'}): {s['node_count']} nodes, {s['area']:.1f} m2, "
+                     f"elevation {e['min']:.2f} to {e['max']:.2f} (mean {e['mean']:.2f}), "
+                     f"mean uncertainty {s['uncertainty']['mean']:.2f}")
+    return "Per-record coverage and depth statistics: " + "; ".join(parts) + "."
+
+
+def bag_statistics(bag_path, bins=DEFAULT_BINS, percentiles=DEFAULT_PERCENTILES, tile_size=DEFAULT_TILE_SIZE,
+                   add_lineage=False):
+    """
+    One streaming pass over `bag_path`; returns {key: statistics}. Histogram ranges
+    come from the min/max attributes, with an extra scan only if those are missing.
+    With add_lineage=True the summary is also added as a lineage process step.
+    """
+    with h5py.File(bag_path, 'r+' if add_lineage else 'r') as f:
+        georef = get_grid_georef(read_bag_xml(f))
+        elevation, uncertainty, keys = f[ELEVATION_PATH], f[UNCERTAINTY_PATH], f[KEYS_PATH]
+        n_keys = f[VALUES_PATH].shape[0]
+        elevation_range = (layer_range([elevation], 'Minimum Elevation Value', 'Maximum Elevation Value')
+                           or scan_range(elevation, tile_size))
+        uncertainty_range = (layer_range([uncertainty], 'Minimum Uncertainty Value', 'Maximum Uncertainty Value')
+                             or scan_range(uncertainty, tile_size))
+        accumulator = KeyStatistics(n_keys, elevation_range, uncertainty_range, bins)
+        for rows, cols in iter_chunk_windows(elevation.shape, chunk_aligned_tile(elevation, tile_size)):
+            tile_keys = keys[rows, cols]
+            if tile_keys.any():
+                accumulator.update(tile_keys, elevation[rows, cols], uncertainty[rows, cols])
+        stats = accumulator.result(georef['x_res'] * georef['y_res'], record_labels(f), percentiles)
+        if add_lineage and stats:
+            with BagMetadataSession(f) as session:
+                if not session.add_process_step(statistics_lineage_text(stats)):
+                    print("  Warning: Could not find <gmd:LI_Lineage> element. Skipping process step.")
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-record coverage and depth statistics for a BAG 2.X file.")
+    parser.add_argument('bag', help="BAG 2.X file with a NOAA_OCS_2022_10 keys layer")
+    parser.add_argument('--json', dest='json_path', help="write the statistics here (default: print them)")
+    parser.add_argument('--lineage', action='store_true', help="also add the summary as a lineage process step")
+    parser.add_argument('--bins', type=int, default=DEFAULT_BINS, help="histogram bins for percentiles")
+    args = parser.parse_args(argv)
+    try:
+        stats = bag_statistics(args.bag, args.bins, add_lineage=args.lineage)
+    except (ValueError, OSError, KeyError) as e:
+        print(f"Error: {e}")
+        return 1
+    if args.json_path:
+        with open(args.json_path, 'w') as out:
+            json.dump(stats, out, indent=1)
+        print(f"Statistics for {len(stats)} record(s) written to '{args.json_path}'")
+    else:
+        print(json.dumps(stats, indent=1))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
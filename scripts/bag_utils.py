@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+"""
+Shared helpers for the BAG 2.X scripts - XML metadata access, survey metadata
+parsing and the HDF5 paths/constants used by the converter and the tools built
+around its output.
+"""
+
+import re
+import os
+import glob
+import zlib
+from datetime import datetime, timezone
+import numpy as np
+import h5py
+import xml.etree.ElementTree as StdET
+
+namespaces = {
+    'gmd': 'http://www.isotc211.org/2005/gmd', 'gco': 'http://www.isotc211.org/2005/gco',
+    'gmi': 'http://www.isotc211.org/2005/gmi', 'gml': 'http://www.opengis.net/gml/3.2',
+    'bag': 'http://www.opennavsurf.org/schema/bag', 'xsi': 'http://www.w3.org/2001/XMLSchema-instance'
+}
+StdET.register_namespace("gmd", namespaces['gmd'])
+StdET.register_namespace("gco", namespaces['gco'])
+StdET.register_namespace("gmi", namespaces['gmi'])
+StdET.register_namespace("gml", namespaces['gml'])
+StdET.register_namespace("bag", namespaces['bag'])
+StdET.register_namespace("xsi", namespaces['xsi'])
+
+BAG_VERSION = "2.1.0"  # keep in step with the bagPy version used to build the georef metadata layer
+BAG_NO_DATA = 1000000.0
+
+METADATA_PATH = '/BAG_root/metadata'
+ELEVATION_PATH = '/BAG_root/elevation'
+UNCERTAINTY_PATH = '/BAG_root/uncertainty'
+TRACKING_LIST_PATH = '/BAG_root/tracking_list'
+GEOREF_METADATA_PATH = '/BAG_root/georef_metadata'
+NOAA_LAYER_NAME = 'NOAA_OCS_2022_10'
+KEYS_PATH = f'{GEOREF_METADATA_PATH}/{NOAA_LAYER_NAME}/keys'
+VALUES_PATH = f'{GEOREF_METADATA_PATH}/{NOAA_LAYER_NAME}/values'
+
+# BAG tracking list records (row/col on the grid, the depth and uncertainty a node held before it was changed)
+TRACKING_LIST_DTYPE = np.dtype([('row', '<u4'), ('col', '<u4'), ('depth', '<f4'), ('uncertainty', '<f4'),
+                                ('track_code', 'u1'), ('list_series', '<i2')])
+TRACK_CODE_COMPOSITED = 1  # a candidate's value superseded while compositing; list_series = its record index
+TRACK_CODE_SURFACE_CORRECTION = 2  # value before a surface correction; list_series = the corrector index
+
+# progress of a live (SWMR) composite: [tiles written, tiles in total, rows final from the south edge]; a dataset,
+# since attributes cannot be changed safely while SWMR readers are attached. Removed once the composite is finished.
+LIVE_PROGRESS_PATH = '/BAG_root/composite_progress'
+
+PROCESS_STEP_DESCRIPTION = "Composite BAG created using custom Python script developed by NOAA Office of Coast Survey. Georeferenced metadata layer added via the bagPy library. Elevation, uncertainty, and keys layers composited from source files."
+
+
+def read_bag_xml(bag_file):
+    """Parse the embedded XML of an open h5py BAG file."""
+    xml_metadata = bag_file[METADATA_PATH][()]
+    xml_metadata_str = b''.join(xml_metadata).decode('utf-8')
+    return StdET.fromstring(xml_metadata_str)
+
+
+def write_bag_xml(bag_file, metadata):
+    """
+    Replace the embedded XML of an open (writable) h5py BAG file. The serialized
+    bytes are viewed as an S1 array (no per-character conversion) and written in one
+    call, resizing the existing extendible dataset in place when possible.
+    """
+    xml_bytes = StdET.tostring(metadata, encoding="utf-8", xml_declaration=False)
+    metadata_array = np.frombuffer(xml_bytes, dtype='S1')
+    existing = bag_file.get(METADATA_PATH)
+    if existing is not None and existing.maxshape == (None,) and existing.dtype == metadata_array.dtype:
+        existing.resize(metadata_array.shape)
+        # write with the file's own string type so the bytes go straight through - bags
+        # store null-terminated 1-byte strings, which a numpy S1 conversion would blank out
+        existing.id.write(h5py.h5s.ALL, h5py.h5s.ALL, metadata_array, mtype=existing.id.get_type())
+        return
+    if existing is not None:
+        del bag_file[METADATA_PATH]
+    bag_file.create_dataset(METADATA_PATH, data=metadata_array, maxshape=(None,))
+
+
+#how to actually read the bag metadata xml
+def get_bag_metadata_for_fix(file_path):
+    with h5py.File(file_path, 'r') as bag_file:
+        return read_bag_xml(bag_file)
+
+
+#helper func to fix the erroneous cornerPoints in the bag xml metadata from caris-derived bags
+def update_corner_points(metadata):
+    try:
+        row_element = metadata.findall(".//gmd:dimensionSize/gco:Integer", namespaces)[0]
+        col_element = metadata.findall(".//gmd:dimensionSize/gco:Integer", namespaces)[1]
+        x_res_element = metadata.findall(".//gmd:resolution/gco:Measure", namespaces)[0]
+        y_res_element = metadata.findall(".//gmd:resolution/gco:Measure", namespaces)[1]
+        coordinates_element = metadata.find(".//gml:coordinates", namespaces)
+        if None in (row_element, col_element, x_res_element, y_res_element, coordinates_element):
+            raise ValueError("Missing metadata elements for grid parameters.")
+        rows, cols = int(row_element.text), int(col_element.text)
+        x_res, y_res = float(x_res_element.text), float(y_res_element.text)
+        coords = [float(c) for coord_pair in coordinates_element.text.strip().split() for c in coord_pair.split(',')]
+        if len(coords) != 4: raise ValueError("Unexpected coordinate format.")
+        sw_x, sw_y, ne_x, ne_y = coords
+        corrected_ne_x = sw_x + (cols - 1) * x_res
+        corrected_ne_y = sw_y + (rows - 1) * y_res
+        coordinates_element.text = f"{sw_x},{sw_y} {corrected_ne_x},{corrected_ne_y}"
+        return metadata
+    except Exception as e:
+        print(f"Error updating corner points: {str(e)}"); return None
+
+
+def get_grid_georef(metadata):
+    """
+    Grid dimensions, resolution and south-west node position from the BAG XML.
+    Only the south-west corner point is trusted - the north-east one is wrong in
+    caris-derived bags (see update_corner_points).
+    """
+    sizes = metadata.findall(".//gmd:dimensionSize/gco:Integer", namespaces)
+    resolutions = metadata.findall(".//gmd:resolution/gco:Measure", namespaces)
+    coordinates_element = metadata.find(".//gml:coordinates", namespaces)
+    if len(sizes) < 2 or len(resolutions) < 2 or coordinates_element is None:
+        raise ValueError("Missing metadata elements for grid parameters.")
+    sw_x, sw_y = (float(c) for c in coordinates_element.text.strip().split()[0].split(','))
+    return {
+        'rows': int(sizes[0].text), 'cols': int(sizes[1].text),
+        'x_res': float(resolutions[0].text), 'y_res': float(resolutions[1].text),
+        'sw_x': sw_x, 'sw_y': sw_y,
+    }
+
+
+def get_crs_wkt(metadata):
+    """(horizontal, vertical) reference system WKT from the BAG XML; None for any that is missing."""
+    codes = [c.text for c in metadata.findall(".//gmd:referenceSystemInfo//gmd:code/gco:CharacterString", namespaces)]
+    codes += [None, None]
+    return codes[0], codes[1]
+
+
+def decode_value_field(column):
+    """A value-table field as a NumPy column, with variable-length strings decoded to str."""
+    if column.dtype.kind == 'O':
+        return np.array([v.decode() if isinstance(v, bytes) else str(v) for v in column], dtype=object)
+    return column
+
+
+def same_resolution(target_georef, source_georef):
+    return (abs(target_georef['x_res'] - source_georef['x_res']) <= 1e-6
+            and abs(target_georef['y_res'] - source_georef['y_res']) <= 1e-6)
+
+
+def get_grid_offset(target_georef, source_georef):
+    """
+    Row/column of the source grid's south-west node on the target lattice. Both
+    grids must share resolution and be node-aligned.
+    """
+    if not same_resolution(target_georef, source_georef):
+        raise ValueError("Grid resolutions differ.")
+    col_offset = (source_georef['sw_x'] - target_georef['sw_x']) / target_georef['x_res']
+    row_offset = (source_georef['sw_y'] - target_georef['sw_y']) / target_georef['y_res']
+    if abs(col_offset - round(col_offset)) > 1e-3 or abs(row_offset - round(row_offset)) > 1e-3:
+        raise ValueError("Grids are not aligned at the node level.")
+    return int(round(row_offset)), int(round(col_offset))
+
+
+def iter_chunk_windows(shape, chunks, row_start=0, row_stop=None, col_start=0, col_stop=None):
+    """Yield (row_slice, col_slice) windows aligned to the dataset chunk grid, clipped to the given range."""
+    row_stop = shape[0] if row_stop is None else row_stop
+    col_stop = shape[1] if col_stop is None else col_stop
+    chunk_rows, chunk_cols = chunks or shape
+    for r0 in range(row_start - row_start % chunk_rows, row_stop, chunk_rows):
+        for c0 in range(col_start - col_start % chunk_cols, col_stop, chunk_cols):
+            yield (slice(max(r0, row_start), min(r0 + chunk_rows, row_stop)),
+                   slice(max(c0, col_start), min(c0 + chunk_cols, col_stop)))
+
+
+def chunk_aligned_tile(dataset, tile_size):
+    """Tile size rounded up to whole chunks of `dataset`, for tile-by-tile processing."""
+    chunk_rows, chunk_cols = dataset.chunks or (1, 1)
+    return (-(-tile_size[0] // chunk_rows) * chunk_rows, -(-tile_size[1] // chunk_cols) * chunk_cols)
+
+
+def parse_memory_size(size):
+    """Bytes for a memory size given as a number or a string like '512M', '4G' or '1.5GiB'."""
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.fullmatch(r"\s*([\d.]+)\s*([kmgt]?)i?b?\s*", str(size), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid memory size '{size}'.")
+    return int(float(match.group(1)) * 1024 ** ' kmgt'.index(match.group(2).lower() or ' '))
+
+
+def find_bag_files(paths):
+    """Bag files for command-line paths: folders are searched recursively, other paths are glob patterns."""
+    bag_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            bag_files.extend(sorted(glob.glob(os.path.join(path, '**', '*.bag'), recursive=True)))
+        else:
+            bag_files.extend(sorted(glob.glob(path)) or [path])
+    return bag_files
+
+
+def allocated_chunks(dsid):
+    """Origins of the allocated chunks; chunk_iter visits them in one pass where HDF5 supports it."""
+    origins = []
+    try:
+        dsid.chunk_iter(lambda info: origins.append(info.chunk_offset))
+    except (AttributeError, NotImplementedError, RuntimeError):
+        # per-index lookups walk the chunk index each time, so this fallback is quadratic
+        origins = [dsid.get_chunk_info(index).chunk_offset for index in range(dsid.get_num_chunks())]
+    return origins
+
+
+def direct_chunk_filters(dataset):
+    """
+    Filter pipeline of a chunked dataset when every filter is one read_window can
+    undo itself (deflate, shuffle), otherwise None.
+    """
+    if dataset.chunks is None:
+        return None
+    plist = dataset.id.get_create_plist()
+    filters = tuple(plist.get_filter(i)[0] for i in range(plist.get_nfilters()))
+    if not set(filters) <= {h5py.h5z.FILTER_DEFLATE, h5py.h5z.FILTER_SHUFFLE}:
+        return None
+    return filters
+
+
+def decode_chunk(dataset, filters, filter_mask, raw):
+    """Undo the filter pipeline on one raw chunk read with read_direct_chunk."""
+    for position in reversed(range(len(filters))):
+        if filter_mask & (1 << position):
+            continue
+        if filters[position] == h5py.h5z.FILTER_DEFLATE:
+            raw = zlib.decompress(raw)
+        else:
+            raw = np.frombuffer(raw, dtype=np.uint8).reshape(dataset.dtype.itemsize, -1).T.tobytes()
+    return np.frombuffer(raw, dtype=dataset.dtype).reshape(dataset.chunks)
+
+
+def read_window(dataset, rows, cols, out):
+    """
+    Read dataset[rows, cols] into `out`. Deflate/shuffle chunked datasets are read
+    as raw chunks and decompressed with zlib, which releases the GIL, so several
+    threads reading different files overlap their decompression; any other layout
+    falls back to a normal h5py read.
+    """
+    filters = direct_chunk_filters(dataset)
+    if filters is None:
+        out[...] = dataset[rows, cols]
+        return out
+    chunk_rows, chunk_cols = dataset.chunks
+    for rows_win, cols_win in iter_chunk_windows(dataset.shape, dataset.chunks, rows.start, rows.stop,
+                                                 cols.start, cols.stop):
+        origin = (rows_win.start - rows_win.start % chunk_rows, cols_win.start - cols_win.start % chunk_cols)
+        dst = (slice(rows_win.start - rows.start, rows_win.stop - rows.start),
+               slice(cols_win.start - cols.start, cols_win.stop - cols.start))
+        try:
+            filter_mask, raw = dataset.id.read_direct_chunk(origin)
+        except RuntimeError:
+            # chunk never written
+            out[dst] = dataset.fillvalue
+            continue
+        chunk = decode_chunk(dataset, filters, filter_mask, raw)
+        out[dst] = chunk[rows_win.start - origin[0]:rows_win.stop - origin[0],
+                         cols_win.start - origin[1]:cols_win.stop - origin[1]]
+    return out
+
+
+def tracking_entries(rows, cols, depth, uncertainty, track_code, list_series):
+    """Tracking list records from equal-length arrays (scalars broadcast), as one structured array."""
+    entries = np.empty(len(rows), dtype=TRACKING_LIST_DTYPE)
+    entries['row'], entries['col'] = rows, cols
+    entries['depth'], entries['uncertainty'] = depth, uncertainty
+    entries['track_code'], entries['list_series'] = track_code, list_series
+    return entries
+
+
+class TrackingListWriter:
+    """
+    Appends tracking list records to a BAG in bulk: entries are buffered and written
+    with one resize per `flush_size` records, and 'Tracking List Length' is updated
+    on close.
+    """
+
+    def __init__(self, bag_file, flush_size=1024 * 1024):
+        self.dataset = bag_file[TRACKING_LIST_PATH]
+        self.flush_size = flush_size
+        self.pending = []
+        self.pending_count = 0
+        self.written = 0
+
+    def add(self, entries):
+        if len(entries):
+            self.pending.append(entries)
+            self.pending_count += len(entries)
+            if self.pending_count >= self.flush_size:
+                self.flush()
+
+    def flush(self):
+        if not self.pending_count:
+            return
+        start = self.dataset.shape[0]
+        self.dataset.resize((start + self.pending_count,))
+        self.dataset[start:] = np.concatenate(self.pending).astype(self.dataset.dtype, copy=False)
+        self.written += self.pending_count
+        self.pending, self.pending_count = [], 0
+
+    def close(self):
+        self.flush()
+        self.dataset.attrs['Tracking List Length'] = np.uint32(self.dataset.shape[0])
+
+
+def open_live_bag(path):
+    """
+    Open a BAG that composite_bag(live=True) is still writing, read-only. Call
+    refresh() on a dataset before reading it to see what has been flushed since,
+    and close the file once live_progress reaches 1.0: the writer then reopens it
+    to set the min/max attributes.
+    """
+    return h5py.File(path, 'r', libver='latest', swmr=True)
+
+
+def live_progress(bag_file):
+    """
+    (fraction of tiles written, rows from the south edge that are final) of a live
+    composite, or None if no live composite is in progress.
+    """
+    if LIVE_PROGRESS_PATH not in bag_file:
+        return None
+    progress = bag_file[LIVE_PROGRESS_PATH]
+    if bag_file.swmr_mode:
+        progress.refresh()
+    done, total, rows = (int(value) for value in progress[()])
+    return done / max(total, 1), rows
+
+
+def add_lineage_step(metadata, description_text, timestamp=None):
+    """Append a gmd:processStep to the lineage; returns False when the document has no lineage."""
+    lineage_element = metadata.find(".//gmd:lineage/gmd:LI_Lineage", namespaces)
+    if lineage_element is None:
+        return False
+    if timestamp is None:
+        timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    process_step = StdET.SubElement(lineage_element, "gmd:processStep")
+    li_process_step = StdET.SubElement(process_step, "gmd:LI_ProcessStep")
+    description = StdET.SubElement(li_process_step, "gmd:description")
+    char_string = StdET.SubElement(description, "gco:CharacterString")
+    char_string.text = description_text
+    datetime_element = StdET.SubElement(li_process_step, "gmd:dateTime")
+    datetime_val = StdET.SubElement(datetime_element, "gco:DateTime")
+    datetime_val.text = timestamp
+    return True
+
+
+def parse_survey_metadata(xml_path, target_grid_name):
+    if not os.path.exists(xml_path): print(f"Error: XML file not found at {xml_path}"); return None
+    from lxml import etree as ET  # only the survey metadata needs lxml (nsmap); keeps it out of quick tools
+    try:
+        parser = ET.XMLParser(remove_blank_text=True)
+        tree = ET.parse(xml_path, parser)
+        root = tree.getroot()
+        ns = root.nsmap
+    except Exception as e: print(f"Error parsing XML file '{os.path.basename(xml_path)}': {e}"); return None
+    def get_text(parent, path, default=''):
+        element = parent.find(path, ns)
+        if element is not None and element.text:
+            raw_text = element.text.strip(); sanitized_text = raw_text.replace('\u2013', '-'); return sanitized_text
+        return default
+    def get_bool(parent, path): return get_text(parent, path).lower() == 'yes'
+    def get_float(parent, path, is_percentage=False):
+        text_val = get_text(parent, path)
+        if not text_val or text_val.lower() == 'n/a': return 0.0
+        match = re.search(r'[\d\.]+', text_val)
+        if match: num = float(match.group(0)); return num / 100.0 if is_percentage else num
+        return 0.0
+    metadata_root = root.find('smd:metadata', ns)
+    if metadata_root is None: return None
+    target_grid_block = None
+    for grid_block in metadata_root.findall('smd:grid', ns):
+        grid_name = get_text(grid_block, './smd:gridName')
+        if grid_name == target_grid_name:
+            target_grid_block = grid_block; break
+    if target_grid_block is None: print(f"Error: Could not find grid block for '{target_grid_name}' in the XML file."); return None
+
+    is_interpolated = get_bool(target_grid_block, './smd:coverageAssessment/smd:interpolated')
+    bathy_coverage_value = not is_interpolated
+
+    parsed_data = {
+        'source_institution': get_text(metadata_root, './smd:poc/smd:responsibleParty'),
+        'source_survey': get_text(metadata_root, './smd:survey/smd:uniqueId'),
+        'survey_date_start': get_text(metadata_root, './smd:date/smd:start'),
+        'survey_date_end': get_text(metadata_root, './smd:date/smd:end'),
+        'licenseName': get_text(metadata_root, './smd:dataLicense/hsd:spdx/hsd:licenseIdentifier', default='Not assigned'),
+        'licenseURL': get_text(metadata_root, './smd:dataLicense/hsd:spdx/hsd:licenseDeed', default=''),
+        'significant_features_detected': get_bool(target_grid_block, './smd:detection/smd:significantFeature'),
+        'feature_least_depth_found': get_bool(target_grid_block, './smd:detection/smd:leastDepth'),
+        'coverage': get_bool(target_grid_block, './smd:coverageAssessment/smd:fullSeafloor'),
+        'bathy_coverage': bathy_coverage_value,
+        'feature_size': get_float(target_grid_block, './smd:detection/smd:size/smd:fixed'),
+        'feature_size_var': get_float(target_grid_block, './smd:detection/smd:size/smd:variable', is_percentage=True),
+        'horizontal_uncert_fixed': get_float(target_grid_block, './smd:uncertainty/smd:horizontal/smd:fixed'),
+        'horizontal_uncert_var': get_float(target_grid_block, './smd:uncertainty/smd:horizontal/smd:variable', is_percentage=True),
+    }
+    return parsed_data
+
+
+def survey_record_values(metadata):
+    """
+    NOAA_OCS_2022_10 record fields in definition order - the argument order of
+    BAG.CreateRecord_NOAA_OCS_2022_10 and the column order of the values table.
+    """
+    return (
+        metadata['significant_features_detected'],
+        metadata['feature_least_depth_found'],
+        metadata['feature_size'],
+        metadata['feature_size_var'],
+        metadata['coverage'],
+        metadata['bathy_coverage'],
+        metadata['horizontal_uncert_fixed'],
+        metadata['horizontal_uncert_var'],
+        metadata['survey_date_start'],
+        metadata['survey_date_end'],
+        metadata['source_institution'],
+        metadata['source_survey'],
+        0, #hard-coded the source_survey_index as 0 per g.rice
+        metadata['licenseName'],
+        metadata['licenseURL'],
+    )
+
+
+def survey_grid_name(data_path):
+    """Grid name used to look up a bag in its Survey_Metadata.xml (ignores the _fixed suffix)."""
+    original_filename = os.path.basename(data_path.replace('_fixed', ''))
+    return os.path.splitext(original_filename)[0]
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+xarray backend for BAG files.
+
+Exposes elevation, uncertainty, nominal elevation (when present) and the georef
+metadata keys as lazy arrays read straight from HDF5, with x/y node coordinates
+from the BAG georeferencing. Opened with chunks={} the arrays become dask arrays
+chunked like the HDF5 datasets, so statistics run out of core across many workers:
+
+    import xarray as xr
+    from bag_xarray_backend import BagBackendEntrypoint, decode_keys
+    ds = xr.open_dataset("composite.bag", engine=BagBackendEntrypoint, chunks={})
+    coverage = decode_keys(ds, 'coverage')          # lazy per-node value-table field
+    ds.elevation.where(coverage).mean().compute()
+
+The value table is attached as `record_<field>` coordinates along a `record`
+dimension (decoded to str/bool/number), and decode_keys maps a field onto the grid
+lazily through the keys layer. Nodata nodes become NaN unless mask_and_scale=False.
+
+To make engine="bag" work by name, register BagBackendEntrypoint under the
+"xarray.backends" entry point group of whichever package ships these scripts.
+"""
+
+import os
+import numpy as np
+import h5py
+import xarray as xr
+from xarray.backends import BackendArray, BackendEntrypoint, CachingFileManager
+from xarray.backends.locks import HDF5_LOCK
+from xarray.core import indexing
+from bag_utils import (read_bag_xml, get_grid_georef, get_crs_wkt, decode_value_field, BAG_NO_DATA, ELEVATION_PATH,
+                       UNCERTAINTY_PATH, GEOREF_METADATA_PATH)
+
+NOMINAL_ELEVATION_PATH = '/BAG_root/nominal_elevation'
+FLOAT_LAYERS = {'elevation': ELEVATION_PATH, 'uncertainty': UNCERTAINTY_PATH, 'nominal_elevation': NOMINAL_ELEVATION_PATH}
+
+
+class BagBackendArray(BackendArray):
+    def __init__(self, manager, path, shape, dtype):
+        self.manager = manager
+        self.path = path
+        self.shape = shape
+        self.dtype = dtype
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(key, self.shape, indexing.IndexingSupport.OUTER_1VECTOR,
+                                                  self._raw_indexing_method)
+
+    def _raw_indexing_method(self, key):
+        with HDF5_LOCK:
+            return self.manager.acquire()[self.path][key]
+
+
+def _georef_layer(f):
+    """(name, group) of the georef metadata layer, or (None, None)."""
+    if GEOREF_METADATA_PATH not in f:
+        return None, None
+    for name, group in f[GEOREF_METADATA_PATH].items():
+        if 'keys' in group and 'values' in group:
+            return name, group
+    return None, None
+
+
+def _lazy_variable(manager, dataset, attrs):
+    data = indexing.LazilyIndexedArray(BagBackendArray(manager, dataset.name, dataset.shape, dataset.dtype))
+    encoding = {'dtype': dataset.dtype, 'source_path': dataset.name}
+    if dataset.chunks:
+        encoding['chunksizes'] = dataset.chunks
+        encoding['preferred_chunks'] = dict(zip(('y', 'x'), dataset.chunks))
+    return xr.Variable(('y', 'x'), data, attrs, encoding)
+
+
+def open_bag_dataset(filename, mask_and_scale=True, drop_variables=None):
+    manager = CachingFileManager(h5py.File, filename, mode='r')
+    f = manager.acquire()
+    metadata = read_bag_xml(f)
+    georef = get_grid_georef(metadata)
+    rows, cols = f[ELEVATION_PATH].shape
+    drop_variables = set(drop_variables or ())
+
+    variables = {}
+    for name, path in FLOAT_LAYERS.items():
+        if path in f and name not in drop_variables:
+            variables[name] = _lazy_variable(manager, f[path], {'_FillValue': np.float32(BAG_NO_DATA)})
+
+    coords = {
+        # BAG rows run south to north and nodes sit at cell centres
+        'y': ('y', georef['sw_y'] + np.arange(rows) * georef['y_res'], {'units': 'm'}),
+        'x': ('x', georef['sw_x'] + np.arange(cols) * georef['x_res'], {'units': 'm'}),
+    }
+    layer_name, group = _georef_layer(f)
+    if group is not None and 'keys' not in drop_variables:
+        variables['keys'] = _lazy_variable(manager, group['keys'], {'georef_metadata_layer': layer_name})
+        values = group['values'][()]
+        for field in values.dtype.names:
+            coords[f'record_{field}'] = ('record', decode_value_field(values[field]))
+
+    crs_wkt, vertical_crs_wkt = get_crs_wkt(metadata)
+    version = f['/BAG_root'].attrs.get('Bag Version', b'')
+    attrs = {'bag_version': version.decode() if isinstance(version, bytes) else str(version)}
+    if crs_wkt:
+        attrs['crs_wkt'] = crs_wkt
+    if vertical_crs_wkt:
+        attrs['vertical_crs_wkt'] = vertical_crs_wkt
+
+    ds = xr.Dataset(variables, coords=coords, attrs=attrs)
+    ds.set_close(manager.close)
+    if mask_and_scale:
+        ds = xr.decode_cf(ds, mask_and_scale=True, decode_times=False)
+    return ds
+
+
+def decode_keys(ds, field):
+    """Value-table `field` mapped onto the grid through the keys layer (lazy when ds is chunked)."""
+    return ds[f'record_{field}'].isel(record=ds['keys'].astype(np.intp)).drop_vars(f'record_{field}')
+
+
+class BagBackendEntrypoint(BackendEntrypoint):
+    description = "Open BAG files (elevation, uncertainty, nominal elevation, georef metadata keys) lazily"
+    open_dataset_parameters = ('filename_or_obj', 'mask_and_scale', 'drop_variables')
+
+    def open_dataset(self, filename_or_obj, *, mask_and_scale=True, drop_variables=None):
+        return open_bag_dataset(os.fspath(filename_or_obj), mask_and_scale, drop_variables)
+
+    def guess_can_open(self, filename_or_obj):
+        try:
+            return os.path.splitext(os.fspath(filename_or_obj))[1].lower() == '.bag'
+        except TypeError:
+            return False
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Compaction stage for BAG files.
+
+HDF5 never gives back the space freed by `del bag_file['BAG_root/metadata']`,
+`del f[keys_path]` or by overwriting datasets in a copied template, so converter
+output carries dead bytes and scattered chunks. compact_bag streams every object
+into a freshly laid-out file and atomically swaps it in:
+    - 2D numeric layers (elevation, uncertainty, keys, ...) are re-created with the
+      requested chunking/filters and copied one chunk window at a time
+    - everything else (XML metadata, value table, tracking list, ...) is copied
+      with H5Ocopy so special string and compound types are kept byte for byte
+    - every group, dataset header and attribute is created before any raster data is
+      written, so the file metadata sits together at the front of the new file
+
+With `precision` set, elevation and uncertainty are stored through the HDF5
+scale-offset filter (decimal scaling: values rounded to `precision` decimals and
+stored as bit-packed integers before gzip). The filter is built into libhdf5, so
+bagPy, GDAL and h5py read these files unchanged. Nodes equal to the fill value
+(BAG no-data) are kept exactly. Every quantized layer is read back from the new
+file and compared with the source before it replaces the output.
+
+usage: python compact_bag.py <bag> [<bag> ...] [--precision DIGITS]
+"""
+
+import os
+import sys
+import argparse
+import h5py
+import numpy as np
+from bag_utils import iter_chunk_windows, ELEVATION_PATH, UNCERTAINTY_PATH
+
+QUANTIZED_LAYERS = (ELEVATION_PATH, UNCERTAINTY_PATH)
+
+
+def _copy_attrs(src, dst):
+    for name, value in src.attrs.items():
+        dst.attrs.create(name, value, dtype=src.attrs.get_id(name).dtype)
+
+
+def _is_raster(dataset):
+    return dataset.ndim == 2 and dataset.dtype.kind in 'fiu'
+
+
+def _raster_options(dataset, chunks, compression, compression_opts, shuffle, dataset_options):
+    options = {
+        'chunks': dataset.chunks or (min(100, dataset.shape[0]), min(100, dataset.shape[1])),
+        'compression': dataset.compression, 'compression_opts': dataset.compression_opts,
+        'shuffle': dataset.shuffle, 'scaleoffset': dataset.scaleoffset,
+    }
+    if chunks is not None:
+        options['chunks'] = (min(chunks[0], dataset.shape[0]), min(chunks[1], dataset.shape[1]))
+    if compression is not None:
+        options['compression'], options['compression_opts'] = compression, compression_opts
+    if shuffle is not None:
+        options['shuffle'] = shuffle
+    options.update(dataset_options.get(dataset.name, {}))
+    if options['compression'] is None:
+        options.pop('compression_opts')
+    return options
+
+
+def _copy_raster_data(dataset, out):
+    for rows, cols in iter_chunk_windows(out.shape, out.chunks):
+        block = dataset[rows, cols]
+        # chunks that only hold the fill value are left unallocated in the new file
+        if not np.all(block == dataset.fillvalue):
+            out[rows, cols] = block
+
+
+def quantized_options(precision):
+    """create_dataset keywords storing a float layer rounded to `precision` decimal digits."""
+    # shuffling bytes of bit-packed integers only gets in gzip's way
+    return {'scaleoffset': int(precision), 'shuffle': False}
+
+
+def quantization_tolerance(precision, max_abs):
+    """Largest round-trip error allowed: half a unit in the last kept digit plus float32 rounding."""
+    scale = 10.0 ** precision
+    return 0.5 / scale + float(np.spacing(np.float32(max_abs * scale))) / scale + float(np.spacing(np.float32(max_abs)))
+
+
+def verify_quantized(dataset, out, precision):
+    """Raise ValueError if `out` (read back from disk) strays from `dataset` by more than the tolerance."""
+    worst = 0.0
+    for rows, cols in iter_chunk_windows(out.shape, out.chunks):
+        block, stored = dataset[rows, cols], out[rows, cols]
+        nodata = block == dataset.fillvalue
+        if not np.array_equal(nodata, stored == out.fillvalue):
+            raise ValueError(f"{dataset.name}: no-data nodes changed by quantization in rows {rows.start}-{rows.stop}")
+        if nodata.all():
+            continue
+        error = np.abs(stored[~nodata].astype(np.float64) - block[~nodata])
+        tolerance = quantization_tolerance(precision, float(np.abs(block[~nodata]).max()))
+        if error.max() > tolerance:
+            raise ValueError(f"{dataset.name}: quantized values off by up to {error.max():g} in rows "
+                             f"{rows.start}-{rows.stop} (tolerance {tolerance:g})")
+        worst = max(worst, float(error.max()))
+    return worst
+
+
+def _copy_structure(src_file, src_group, dst_group, raster_args, rasters):
+    """Copy everything except raster data; (source, destination) raster pairs are collected in `rasters`."""
+    _copy_attrs(src_group, dst_group)
+    for name, obj in src_group.items():
+        if isinstance(obj, h5py.Group):
+            _copy_structure(src_file, obj, dst_group.create_group(name), raster_args, rasters)
+        elif isinstance(obj, h5py.Dataset) and _is_raster(obj):
+            out = dst_group.create_dataset(name, shape=obj.shape, dtype=obj.dtype, maxshape=obj.maxshape,
+                                           fillvalue=obj.fillvalue, **_raster_options(obj, *raster_args))
+            _copy_attrs(obj, out)
+            rasters.append((obj, out))
+        else:
+            src_file.copy(obj, dst_group, name=name)
+
+
+def compact_bag(bag_path, output_path=None, chunks=None, compression=None, compression_opts=None, shuffle=None,
+                dataset_options=None, precision=None, libver=None):
+    """
+    Rewrite `bag_path` into a freshly laid-out file and atomically replace
+    `output_path` (default: the input itself) with it.
+
+    chunks / compression / compression_opts / shuffle apply to every 2D numeric
+    layer; None keeps each layer's current setting. dataset_options maps a dataset
+    path (e.g. '/BAG_root/elevation') to extra create_dataset keywords for that
+    layer only. precision (decimal digits) stores elevation and uncertainty
+    quantized, see the module docstring; a ValueError from the read-back check
+    leaves `output_path` untouched. libver is passed to h5py.File for the new
+    file ('latest' for SWMR writing, which HDF5 before 1.10 cannot read). Returns
+    the number of bytes reclaimed (negative if the file grew).
+    """
+    output_path = output_path or bag_path
+    temp_path = output_path + '.compacting'
+    size_before = os.path.getsize(bag_path)
+    dataset_options = dict(dataset_options or {})
+    if precision is not None:
+        for path in QUANTIZED_LAYERS:
+            dataset_options[path] = {**quantized_options(precision), **dataset_options.get(path, {})}
+    raster_args = (chunks, compression, compression_opts, shuffle, dataset_options)
+    try:
+        with h5py.File(bag_path, 'r') as src:
+            with h5py.File(temp_path, 'w', libver=libver) as dst:
+                rasters = []
+                _copy_structure(src, src, dst, raster_args, rasters)
+                for dataset, out in rasters:
+                    _copy_raster_data(dataset, out)
+            if precision is not None:
+                # read back after closing: before that h5py would serve the unfiltered chunks from its cache
+                with h5py.File(temp_path, 'r') as dst:
+                    for path in QUANTIZED_LAYERS:
+                        if path in src:
+                            worst = verify_quantized(src[path], dst[path], precision)
+                            print(f"  {path}: stored to {precision} decimal(s), largest change {worst:g}")
+        os.replace(temp_path, output_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    reclaimed = size_before - os.path.getsize(output_path)
+    print(f"Compacted '{os.path.basename(output_path)}': {size_before} -> {size_before - reclaimed} bytes "
+          f"({reclaimed} reclaimed)")
+    return reclaimed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rewrite BAG files into freshly laid-out, compact files.")
+    parser.add_argument('bags', nargs='+', help="BAG files, compacted in place")
+    parser.add_argument('--precision', type=int,
+                        help="store elevation and uncertainty rounded to this many decimals (e.g. 2 for centimetres)")
+    args = parser.parse_args(argv)
+    status = 0
+    for path in args.bags:
+        try:
+            compact_bag(path, precision=args.precision)
+        except (ValueError, OSError) as e:
+            print(f"Error compacting '{path}': {e}")
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,8 +10,8 @@ import bagPy as BAG
 import numpy as np
 import h5py
 import pathlib
-from osgeo import gdal
 import json
+from bag_compositor import write_single_source_keys
 
 # Define file paths
 INPUTS = pathlib.Path(__file__).parents[1] / 'inputs'
@@ -41,21 +41,6 @@ open_options = ['MODE=LIST_SUPERGRIDS']
 #         print('item:', item.GetName())
 #         print(dir(item))
 
-ds = gdal.Open(output_bag_path, gdal.GA_ReadOnly)
-
-
-elevation_band = ds.GetRasterBand(1)
-print(elevation_band)
-elevation_data = elevation_band.ReadAsArray()
-print(elevation_data)
-
-# Create a boolean mask from the elevation data
-no_data_value = elevation_band.GetNoDataValue()
-mask = (elevation_data != no_data_value)
-
-# Close GDAL dataset for later copying
-ds = None
-
 # Open the copied BAG file
 try:
     dataset = BAG.Dataset.openDataset(output_bag_path, BAG.BAG_OPEN_READ_WRITE)
@@ -112,18 +97,10 @@ with h5py.File(output_bag_path, 'a') as f:
         print(f"Error renaming group: {e}")
 
     try:
-        # Create the keys dataset
-        numRows, numColumns = elevation_data.shape
-        if '/BAG_root/georef_metadata/NOAA_OCS_2022_10/keys' in f:
-            del f['/BAG_root/georef_metadata/NOAA_OCS_2022_10/keys']
-        keys_ds = f.create_dataset('/BAG_root/georef_metadata/NOAA_OCS_2022_10/keys', (numRows, numColumns), dtype=np.uint16)
-        
-        # Apply the mask to create the key layer and flip it vertically
-        keys = np.zeros((numRows, numColumns), dtype=np.uint16)
-        keys[mask] = 1
-        keys = np.flipud(keys)  # Flip the array vertically
-        keys_ds[...] = keys
-        print("Key layer added successfully.")
+        # Single source: create the keys dataset with the record index as its fill value and
+        # only write the chunks that contain nodata nodes - fully covered chunks are left as fill
+        chunks_written = write_single_source_keys(f, firstRecordIndex)
+        print(f"Key layer added successfully ({chunks_written} chunk(s) with nodata written).")
     except Exception as e:
         print(f"Error creating key layer: {e}")
 
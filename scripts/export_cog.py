@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming Cloud Optimized GeoTIFF export of a BAG 2.X file.
+
+Elevation, uncertainty and the NOAA_OCS_2022_10 keys are each written to their own
+COG. The BAG is read once, one chunk-aligned band of tiles at a time, and every
+window is flipped into north-up order as it is written (HDF5 row 0 is the south
+edge of the grid). Each layer is staged in a tiled GeoTIFF, gets internal
+overviews, and is then laid out as a COG by GDAL's COG driver. The metadata value
+table is set on the staged keys layer as a raster attribute table, one row per
+record with the record index in the 'Value' column, and carried into the keys COG
+by the COG driver (a RAT set on a finished, read-only COG is not saved).
+
+usage: python export_cog.py <bag> [-o output_folder] [--layers elevation uncertainty keys]
+"""
+
+import os
+import sys
+import argparse
+import h5py
+from osgeo import gdal
+from bag_utils import (read_bag_xml, get_grid_georef, get_crs_wkt, decode_value_field, iter_chunk_windows,
+                       chunk_aligned_tile, BAG_NO_DATA, ELEVATION_PATH, UNCERTAINTY_PATH, KEYS_PATH, VALUES_PATH)
+
+gdal.UseExceptions()
+
+# layer name -> (dataset path, GDAL type, nodata, overview resampling)
+EXPORT_LAYERS = {
+    'elevation': (ELEVATION_PATH, gdal.GDT_Float32, BAG_NO_DATA, 'AVERAGE'),
+    'uncertainty': (UNCERTAINTY_PATH, gdal.GDT_Float32, BAG_NO_DATA, 'AVERAGE'),
+    'keys': (KEYS_PATH, gdal.GDT_UInt16, 0, 'NEAREST'),
+}
+DEFAULT_TILE_SIZE = (1024, 1024)
+OVERVIEW_MIN_SIZE = 256
+
+
+def bag_geotransform(georef):
+    """North-up geotransform; BAG nodes sit at cell centres, so the corner is half a cell out."""
+    north_edge = georef['sw_y'] + (georef['rows'] - 0.5) * georef['y_res']
+    return (georef['sw_x'] - georef['x_res'] / 2, georef['x_res'], 0.0, north_edge, 0.0, -georef['y_res'])
+
+
+def _overview_levels(shape):
+    levels, factor = [], 2
+    while max(shape) / factor >= OVERVIEW_MIN_SIZE:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def value_table_rat(values):
+    """gdal.RasterAttributeTable for a NOAA_OCS_2022_10 value table, one row per record."""
+    rat = gdal.RasterAttributeTable()
+    rat.CreateColumn('Value', gdal.GFT_Integer, gdal.GFU_MinMax)
+    columns = []
+    for field in values.dtype.names:
+        column = decode_value_field(values[field])
+        if column.dtype.kind == 'S':
+            column = column.astype(str)  # fixed-length byte strings
+        if column.dtype.kind in 'OU':
+            field_type = gdal.GFT_String
+        elif column.dtype.kind == 'f':
+            field_type = gdal.GFT_Real
+        else:
+            field_type = gdal.GFT_Integer
+        rat.CreateColumn(field, field_type, gdal.GFU_Generic)
+        columns.append((field_type, column))
+    rat.SetRowCount(len(values))
+    for row in range(len(values)):
+        rat.SetValueAsInt(row, 0, row)
+        for col, (field_type, column) in enumerate(columns, start=1):
+            if field_type == gdal.GFT_String:
+                rat.SetValueAsString(row, col, column[row])
+            elif field_type == gdal.GFT_Real:
+                rat.SetValueAsDouble(row, col, float(column[row]))
+            else:
+                rat.SetValueAsInt(row, col, int(column[row]))
+    return rat
+
+
+def export_cog(bag_path, output_folder=None, layers=tuple(EXPORT_LAYERS), block_size=512, compression='DEFLATE',
+               tile_size=DEFAULT_TILE_SIZE):
+    """
+    Stream the requested `layers` of `bag_path` into <bag name>_<layer>.tif COGs in
+    `output_folder` (default: next to the bag). Returns the written paths.
+    """
+    output_folder = output_folder or os.path.dirname(os.path.abspath(bag_path))
+    os.makedirs(output_folder, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(bag_path))[0]
+    layers = [layer for layer in layers if layer in EXPORT_LAYERS]
+    outputs = {}
+    staged = {}
+    try:
+        with h5py.File(bag_path, 'r') as f:
+            metadata = read_bag_xml(f)
+            georef = get_grid_georef(metadata)
+            crs_wkt, _ = get_crs_wkt(metadata)
+            layers = [layer for layer in layers if EXPORT_LAYERS[layer][0] in f]
+            elevation = f[ELEVATION_PATH]
+            rows, cols = elevation.shape
+
+            gtiff = gdal.GetDriverByName('GTiff')
+            for layer in layers:
+                _, gdal_type, nodata, _ = EXPORT_LAYERS[layer]
+                outputs[layer] = os.path.join(output_folder, f"{stem}_{layer}.tif")
+                stage_path = outputs[layer] + '.staging.tif'
+                staged[layer] = [stage_path, gtiff.Create(
+                    stage_path, cols, rows, 1, gdal_type,
+                    options=['TILED=YES', f'BLOCKXSIZE={block_size}', f'BLOCKYSIZE={block_size}',
+                             f'COMPRESS={compression}', 'BIGTIFF=IF_SAFER'])]
+                staged[layer][1].SetGeoTransform(bag_geotransform(georef))
+                if crs_wkt:
+                    staged[layer][1].SetProjection(crs_wkt)
+                staged[layer][1].GetRasterBand(1).SetNoDataValue(nodata)
+
+            # one pass over the bag: every window is read once and written to all layer files
+            for rows_win, cols_win in iter_chunk_windows(elevation.shape, chunk_aligned_tile(elevation, tile_size)):
+                y_offset = rows - rows_win.stop
+                for layer in layers:
+                    window = f[EXPORT_LAYERS[layer][0]][rows_win, cols_win]
+                    staged[layer][1].GetRasterBand(1).WriteArray(window[::-1], cols_win.start, y_offset)
+            values = f[VALUES_PATH][()] if 'keys' in layers and VALUES_PATH in f else None
+
+        if values is not None:
+            staged['keys'][1].GetRasterBand(1).SetDefaultRAT(value_table_rat(values))
+        cog = gdal.GetDriverByName('COG')
+        levels = _overview_levels((rows, cols))
+        for layer in layers:
+            if levels:
+                staged[layer][1].BuildOverviews(EXPORT_LAYERS[layer][3], levels)
+            cog.CreateCopy(outputs[layer], staged[layer][1],
+                           options=[f'COMPRESS={compression}', f'BLOCKSIZE={block_size}',
+                                    'OVERVIEWS=FORCE_USE_EXISTING', 'BIGTIFF=IF_SAFER'])
+            staged[layer][1] = None  # dropping the last reference closes the staging file
+            print(f"Wrote COG '{outputs[layer]}'")
+    finally:
+        for staging in staged.values():
+            staging[1] = None
+            if os.path.exists(staging[0]):
+                gdal.GetDriverByName('GTiff').Delete(staging[0])
+    return [outputs[layer] for layer in layers]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export BAG layers to Cloud Optimized GeoTIFFs.")
+    parser.add_argument('bag', help="BAG 2.X file")
+    parser.add_argument('-o', '--output-folder', help="folder for the .tif files (default: next to the bag)")
+    parser.add_argument('--layers', nargs='+', choices=list(EXPORT_LAYERS), default=list(EXPORT_LAYERS))
+    parser.add_argument('--block-size', type=int, default=512)
+    args = parser.parse_args(argv)
+    try:
+        export_cog(args.bag, args.output_folder, args.layers, args.block_size)
+    except (ValueError, OSError, RuntimeError) as e:
+        print(f"Error: {e}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
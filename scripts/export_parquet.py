@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar export of a BAG 2.X file for analytics.
+
+Every node with data becomes one row (x, y, elevation, uncertainty) in a
+hive-partitioned Parquet dataset, where the key comes from the partition directory,
+so a query on one survey reads only that survey's files:
+
+    <output>/nodes/key=<record index>/part-0.parquet
+    <output>/records.parquet        decoded NOAA_OCS_2022_10 value table, one row per key
+
+The grid is streamed in chunk-aligned tiles; rows are buffered per key and written
+as row groups of `row_group_size` rows, so memory stays at roughly one row group
+per key whatever the grid size. Join nodes to records on `key` for attribute
+grouping, e.g. with pyarrow/duckdb/pandas:
+
+    SELECT r.feature_size, count(*) FROM 'out/nodes/**/*.parquet' n
+    JOIN 'out/records.parquet' r USING (key) GROUP BY 1
+
+usage: python export_parquet.py <bag> <output folder> [--row-group-size N]
+"""
+
+import os
+import sys
+import argparse
+import numpy as np
+import h5py
+import pyarrow as pa
+import pyarrow.parquet as pq
+from bag_utils import (read_bag_xml, get_grid_georef, decode_value_field, iter_chunk_windows, chunk_aligned_tile,
+                       BAG_NO_DATA, ELEVATION_PATH, UNCERTAINTY_PATH, KEYS_PATH, VALUES_PATH)
+
+DEFAULT_ROW_GROUP_SIZE = 1024 * 1024
+DEFAULT_TILE_SIZE = (1024, 1024)
+NODE_SCHEMA = pa.schema([
+    ('x', pa.float64()), ('y', pa.float64()),
+    ('elevation', pa.float32()), ('uncertainty', pa.float32()),
+])
+
+
+class _KeyPartition:
+    """Row buffer and Parquet writer for the nodes of one key."""
+
+    def __init__(self, path, row_group_size, compression):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.writer = pq.ParquetWriter(path, NODE_SCHEMA, compression=compression)
+        self.row_group_size = row_group_size
+        self.columns = []
+        self.rows = 0
+
+    def append(self, columns):
+        self.columns.append(columns)
+        self.rows += len(columns[0])
+        if self.rows >= self.row_group_size:
+            self.flush(whole_groups=True)
+
+    def flush(self, whole_groups=False):
+        """Write the buffered rows; with whole_groups, only full row groups and keep the remainder buffered."""
+        count = self.rows - self.rows % self.row_group_size if whole_groups else self.rows
+        if not count:
+            return
+        merged = [np.concatenate(parts) for parts in zip(*self.columns)]
+        arrays = [pa.array(column[:count]) for column in merged]
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=NODE_SCHEMA), row_group_size=self.row_group_size)
+        self.columns = [tuple(column[count:] for column in merged)] if count < self.rows else []
+        self.rows -= count
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def value_table(values):
+    """The value table as a pyarrow Table with a leading int32 `key` column (the record index)."""
+    columns = {'key': pa.array(np.arange(len(values), dtype=np.int32))}
+    for field in values.dtype.names:
+        columns[field] = pa.array(decode_value_field(values[field]))
+    return pa.table(columns)
+
+
+def export_parquet(bag_path, output_folder, row_group_size=DEFAULT_ROW_GROUP_SIZE, compression='zstd',
+                   tile_size=DEFAULT_TILE_SIZE):
+    """
+    Stream the data nodes of `bag_path` into a key-partitioned Parquet dataset in
+    `output_folder`, plus records.parquet. Returns the number of node rows written.
+    """
+    partitions = {}
+    total_rows = 0
+    try:
+        with h5py.File(bag_path, 'r') as f:
+            georef = get_grid_georef(read_bag_xml(f))
+            elevation, uncertainty = f[ELEVATION_PATH], f[UNCERTAINTY_PATH]
+            keys = f[KEYS_PATH] if KEYS_PATH in f else None
+            os.makedirs(output_folder, exist_ok=True)
+            if VALUES_PATH in f:
+                pq.write_table(value_table(f[VALUES_PATH][()]), os.path.join(output_folder, 'records.parquet'),
+                               compression=compression)
+
+            for rows, cols in iter_chunk_windows(elevation.shape, chunk_aligned_tile(elevation, tile_size)):
+                elev = elevation[rows, cols]
+                has_data = elev != BAG_NO_DATA
+                if not has_data.any():
+                    continue
+                node_rows, node_cols = np.nonzero(has_data)
+                tile_keys = keys[rows, cols][has_data] if keys is not None else np.zeros(len(node_rows), np.uint16)
+                x = georef['sw_x'] + (node_cols + cols.start) * georef['x_res']
+                y = georef['sw_y'] + (node_rows + rows.start) * georef['y_res']
+                columns = (x, y, elev[has_data], uncertainty[rows, cols][has_data])
+                # split the tile's nodes by key with one stable sort instead of a mask per key
+                order = np.argsort(tile_keys, kind='stable')
+                split_keys, starts = np.unique(tile_keys[order], return_index=True)
+                bounds = list(starts[1:]) + [len(order)]
+                for key, start, stop in zip(split_keys, starts, bounds):
+                    if key not in partitions:
+                        path = os.path.join(output_folder, 'nodes', f'key={key}', 'part-0.parquet')
+                        partitions[key] = _KeyPartition(path, row_group_size, compression)
+                    selected = order[start:stop]
+                    partitions[key].append([column[selected] for column in columns])
+                total_rows += len(node_rows)
+    finally:
+        for partition in partitions.values():
+            partition.close()
+    print(f"Exported {total_rows} node(s) in {len(partitions)} key partition(s) to '{output_folder}'")
+    return total_rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export BAG nodes and the metadata value table to Parquet.")
+    parser.add_argument('bag', help="BAG 2.X file")
+    parser.add_argument('output_folder', help="folder for the nodes/ dataset and records.parquet")
+    parser.add_argument('--row-group-size', type=int, default=DEFAULT_ROW_GROUP_SIZE, help="rows per row group")
+    parser.add_argument('--compression', default='zstd', help="Parquet compression codec (default: zstd)")
+    args = parser.parse_args(argv)
+    try:
+        export_parquet(args.bag, args.output_folder, args.row_group_size, args.compression)
+    except (ValueError, OSError) as e:
+        print(f"Error: {e}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
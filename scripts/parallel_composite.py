@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-process compositing with per-worker scratch files.
+
+h5py can only write a file from one process, so composite_bag is limited to a
+single writer. composite_bag_parallel splits the output grid into bands of whole
+chunk rows and hands each band to a worker process, which composites it tile by
+tile (same rules as bag_compositor) into its own scratch HDF5 file laid out with
+the output's chunking and filters. The bands are then stitched into the BAG:
+
+    stitch='copy'     every stored chunk of every scratch file is moved into the
+                      BAG with read_direct_chunk/write_direct_chunk - no
+                      decompression or recompression - and the scratch files are
+                      removed (default)
+    stitch='virtual'  elevation, uncertainty, keys and the shared optional layers
+                      become HDF5 virtual datasets mapping each band to its
+                      scratch file, which stay in <output>_bands/ next to the BAG.
+                      Nothing is copied, but the BAG is only readable together
+                      with that folder and by HDF5 1.10+ based software.
+
+Rules must be picklable for the worker processes: a RULES name,
+'precedence_threshold:<value>', 'module:function' or a module-level function.
+"""
+
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import h5py
+from bag_compositor import (read_tile_stack, choose_winner, gather_stack, superseded_entries, get_rule,
+                            shared_optional_layers, extend_range, _prepare_keys, _prepare_optional_layer, _set_min_max,
+                            DEFAULT_TILE_SIZE)
+from bag_utils import (iter_chunk_windows, chunk_aligned_tile, allocated_chunks, TrackingListWriter, BAG_NO_DATA,
+                       ELEVATION_PATH, UNCERTAINTY_PATH, KEYS_PATH, TRACKING_LIST_PATH, TRACKING_LIST_DTYPE)
+
+STITCH_MODES = ('copy', 'virtual')
+
+
+def _layout(dataset):
+    """create_dataset keywords reproducing the storage layout of `dataset` (chunked even if it was contiguous)."""
+    chunks = dataset.chunks or (min(100, dataset.shape[0]), min(100, dataset.shape[1]))
+    layout = {'dtype': dataset.dtype, 'chunks': chunks, 'compression': dataset.compression,
+              'shuffle': dataset.shuffle, 'fillvalue': dataset.fillvalue}
+    if dataset.compression is not None:
+        layout['compression_opts'] = dataset.compression_opts
+    return layout
+
+
+def _recreate(f, path, layout):
+    """Replace `path` with an empty dataset of the same shape and attributes, so unwritten chunks read as fill."""
+    dataset = f[path]
+    shape, attrs = dataset.shape, {name: (value, dataset.attrs.get_id(name).dtype) for name, value in dataset.attrs.items()}
+    del f[path]
+    dataset = f.create_dataset(path, shape=shape, **layout)
+    for name, (value, dtype) in attrs.items():
+        dataset.attrs.create(name, value, dtype=dtype)
+    return dataset
+
+
+def band_windows(shape, chunk_rows, n_bands):
+    """Split the rows into up to `n_bands` bands of whole chunk rows."""
+    chunk_count = -(-shape[0] // chunk_rows)
+    per_band = -(-chunk_count // max(1, min(n_bands, chunk_count)))
+    return [(r0, min(r0 + per_band * chunk_rows, shape[0])) for r0 in range(0, shape[0], per_band * chunk_rows)]
+
+
+def composite_band(task):
+    """Worker: composite rows [row_start, row_stop) into a scratch file; returns the value ranges seen."""
+    scratch_path, input_specs, (row_start, row_stop), cols, layouts, rule, tile_size, track = task
+    inputs = [cls(*args) for cls, args in input_specs]
+    rule = get_rule(rule)
+    optional_dtypes = {path: layout['dtype'] for path, layout in layouts.items()
+                       if path not in (ELEVATION_PATH, UNCERTAINTY_PATH, KEYS_PATH)}
+    ranges = {path: [np.inf, -np.inf] for path in layouts}
+    try:
+        with h5py.File(scratch_path, 'w') as scratch:
+            # unlimited maxshape lets the last, shorter band keep full-size chunks
+            band = {path: scratch.create_dataset(path, shape=(row_stop - row_start, cols), maxshape=(None, None),
+                                                 **layout)
+                    for path, layout in layouts.items()}
+            tracking = None
+            if track:
+                scratch.create_dataset(TRACKING_LIST_PATH, shape=(0,), maxshape=(None,), dtype=TRACKING_LIST_DTYPE,
+                                       chunks=(4096,))
+                tracking = TrackingListWriter(scratch)
+            tile = chunk_aligned_tile(band[ELEVATION_PATH], tile_size)
+            for rows, cols_win in iter_chunk_windows((row_stop - row_start, cols), tile):
+                global_rows = slice(rows.start + row_start, rows.stop + row_start)
+                stack = read_tile_stack(inputs, global_rows, cols_win, optional_dtypes)
+                winner = choose_winner(stack[0], stack[1], rule)
+                elevation, uncertainty, keys, optional = gather_stack(inputs, *stack, winner)
+                if tracking is not None:
+                    tracking.add(superseded_entries(inputs, stack[0], stack[1], winner, global_rows.start,
+                                                    cols_win.start))
+                if not keys.any():
+                    continue  # left to the fill value, which is what composite_bag would write
+                for path, values in ((ELEVATION_PATH, elevation), (UNCERTAINTY_PATH, uncertainty),
+                                     (KEYS_PATH, keys), *optional.items()):
+                    band[path][rows, cols_win] = values
+                    if path != KEYS_PATH:
+                        ranges[path] = extend_range(ranges[path], values[values != values.dtype.type(BAG_NO_DATA)])
+            if tracking is not None:
+                tracking.close()
+    finally:
+        for source in inputs:
+            source.close()
+    return ranges
+
+
+def _copy_chunks(scratch_dataset, dataset, row_offset):
+    """Move every stored chunk of a band into the BAG dataset, without decoding it."""
+    for origin in allocated_chunks(scratch_dataset.id):
+        filter_mask, raw = scratch_dataset.id.read_direct_chunk(origin)
+        dataset.id.write_direct_chunk((origin[0] + row_offset, origin[1]), raw, filter_mask)
+
+
+def _virtual_layer(f, path, layout, shape, bands, output_folder):
+    attrs = {name: (value, f[path].attrs.get_id(name).dtype) for name, value in f[path].attrs.items()}
+    virtual = h5py.VirtualLayout(shape=shape, dtype=layout['dtype'])
+    for scratch_path, (row_start, row_stop) in bands:
+        # relative paths: HDF5 resolves them against the folder of the BAG
+        source_file = os.path.relpath(scratch_path, output_folder)
+        virtual[row_start:row_stop, :] = h5py.VirtualSource(source_file, path, shape=(row_stop - row_start, shape[1]))
+    del f[path]
+    dataset = f.create_virtual_dataset(path, virtual, fillvalue=layout['fillvalue'])
+    for name, (value, dtype) in attrs.items():
+        dataset.attrs.create(name, value, dtype=dtype)
+    return dataset
+
+
+def prepare_bands(output_path, inputs):
+    """
+    Prepare the keys and shared optional layers of `output_path` and return
+    (paths, layouts, shape, chunk rows) for compositing it in bands: every layer
+    shares the elevation chunk rows, so bands split all of them on chunk
+    boundaries, and fills with the no-data value, so chunks a band never wrote read
+    as empty.
+    """
+    with h5py.File(output_path, 'r+') as f:
+        _prepare_keys(f, f[ELEVATION_PATH].shape)
+        optional_paths = shared_optional_layers(inputs)
+        for path in optional_paths:
+            _prepare_optional_layer(f, path, inputs[0].bag_file[path], f[ELEVATION_PATH])
+        paths = [ELEVATION_PATH, UNCERTAINTY_PATH, KEYS_PATH] + optional_paths
+        chunks = _layout(f[ELEVATION_PATH])['chunks']
+        layouts = {}
+        for path in paths:
+            layout = _layout(f[path])
+            layout.update(chunks=(chunks[0], layout['chunks'][1]),
+                          fillvalue=0 if path == KEYS_PATH else layout['dtype'].type(BAG_NO_DATA))
+            layouts[path] = layout
+        return paths, layouts, f[ELEVATION_PATH].shape, chunks[0]
+
+
+def stitch_bands(output_path, paths, layouts, shape, bands, band_ranges, stitch='copy'):
+    """
+    Stitch the band files [(scratch path, (row start, row stop)), ...] into
+    `output_path` and set the min/max attributes from the per-band `band_ranges`.
+    Tracking list records collected by the bands are appended to the BAG's.
+    """
+    output_folder = os.path.dirname(os.path.abspath(output_path))
+    with h5py.File(output_path, 'r+') as f:
+        tracking = TrackingListWriter(f)
+        for scratch_path, _ in bands:
+            with h5py.File(scratch_path, 'r') as scratch:
+                if TRACKING_LIST_PATH in scratch:
+                    entries = scratch[TRACKING_LIST_PATH]
+                    for start in range(0, entries.shape[0], tracking.flush_size):
+                        tracking.add(entries[start:start + tracking.flush_size])
+        tracking.close()
+        for path in paths:
+            if stitch == 'copy':
+                dataset = _recreate(f, path, layouts[path])
+                for scratch_path, (row_start, _) in bands:
+                    with h5py.File(scratch_path, 'r') as scratch:
+                        _copy_chunks(scratch[path], dataset, row_start)
+            else:
+                dataset = _virtual_layer(f, path, layouts[path], shape, bands, output_folder)
+            value_range = [min(r[path][0] for r in band_ranges), max(r[path][1] for r in band_ranges)]
+            if path == ELEVATION_PATH:
+                _set_min_max(dataset, 'Minimum Elevation Value', 'Maximum Elevation Value', *value_range)
+            elif path == UNCERTAINTY_PATH:
+                _set_min_max(dataset, 'Minimum Uncertainty Value', 'Maximum Uncertainty Value', *value_range)
+            elif path != KEYS_PATH:
+                _set_min_max(dataset, 'min_value', 'max_value', *value_range)
+
+
+def composite_bag_parallel(output_path, inputs, rule='last_wins', workers=None, stitch='copy',
+                           tile_size=DEFAULT_TILE_SIZE, track_superseded=False):
+    """
+    Composite `inputs` (see bag_compositor.open_inputs; their files are re-opened
+    in each worker) into `output_path` with `workers` processes writing scratch
+    files, stitched as described in the module docstring. track_superseded as for
+    composite_bag.
+    """
+    if stitch not in STITCH_MODES:
+        raise ValueError(f"Unknown stitch mode '{stitch}'. Use one of: {', '.join(STITCH_MODES)}")
+    if callable(rule) and rule.__name__ == '<lambda>':
+        raise ValueError("Lambda rules cannot be sent to worker processes; use a module-level function.")
+    workers = workers or os.cpu_count() or 1
+    scratch_folder = os.path.splitext(os.path.abspath(output_path))[0] + '_bands'
+    input_specs = [source.spec() for source in inputs]
+    paths, layouts, shape, chunk_rows = prepare_bands(output_path, inputs)
+
+    if os.path.exists(scratch_folder):
+        shutil.rmtree(scratch_folder)
+    os.makedirs(scratch_folder)
+    bands = [(os.path.join(scratch_folder, f'band_{i:04d}.h5'), window)
+             for i, window in enumerate(band_windows(shape, chunk_rows, workers * 2))]
+    print(f"Compositing {len(bands)} band(s) with {workers} worker process(es) (stitch: {stitch})")
+    tasks = [(scratch_path, input_specs, window, shape[1], layouts, rule, tile_size, track_superseded)
+             for scratch_path, window in bands]
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            band_ranges = list(pool.map(composite_band, tasks))
+        stitch_bands(output_path, paths, layouts, shape, bands, band_ranges, stitch)
+    finally:
+        if stitch == 'copy' and os.path.exists(scratch_folder):
+            shutil.rmtree(scratch_folder)
+    print("Bands stitched" + (f"; virtual layers read from '{scratch_folder}'" if stitch == 'virtual' else ""))
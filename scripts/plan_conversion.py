@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Dry run of create_bag_v2x: what a conversion will cost, from headers only.
+
+Only the HDF5 headers and the embedded XML of each input are read - no raster
+data - so a batch can be sized in seconds and scheduled onto nodes with enough
+memory and disk. plan_conversion reports:
+
+    output       dimensions and georeferencing (the last input is the template)
+    overlap      each input's footprint on the output lattice, the nodes covered by
+                 more than one input and the nodes no input covers
+    memory       estimated peak of the compositing step (estimate_composite_memory /
+                 plan_composite, or per worker process with workers or shards)
+    disk         bytes read and written per step, the temporary space in use at the
+                 peak (the _fixed.bag copies, the template copy, band scratch files,
+                 the compaction copy) and the _fixed.bag copies left behind
+    runtime      projected from throughput figures: bytes copied per second, and
+                 nodes per second of one layer decoded from an input and composited
+                 into the output. The defaults are rough; `--calibrate <bag>`
+                 measures them on this machine with a real bag and saves them for
+                 `--throughput`.
+
+Compressed output sizes are projected from the template's own compression ratio.
+
+usage:
+    python plan_conversion.py <input.bag> [...] [--workers N] [--shards N] [--max-memory 4G]
+                              [--compact] [--track-superseded] [--throughput figures.json] [--json]
+    python plan_conversion.py --calibrate <sample.bag> [--throughput figures.json]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import h5py
+from bag_compositor import (open_inputs, composite_bag, estimate_composite_memory, plan_composite, CompositeInput,
+                            shared_optional_layers, DEFAULT_TILE_SIZE, BASE_MEMORY)
+from bag_utils import (read_bag_xml, get_grid_georef, chunk_aligned_tile, parse_memory_size, ELEVATION_PATH,
+                       UNCERTAINTY_PATH, TRACKING_LIST_DTYPE)
+
+DEFAULT_THROUGHPUT = {
+    'copy_bytes_per_second': 150e6,
+    'read_nodes_per_second': 20e6,  # nodes of one input layer read, decoded and placed
+    'write_nodes_per_second': 8e6,  # nodes of one output layer composited, encoded and written
+}
+DEFAULT_THROUGHPUT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plan_throughput.json')
+
+
+def load_throughput(path=None):
+    """Throughput figures: DEFAULT_THROUGHPUT updated from `path` (default: DEFAULT_THROUGHPUT_FILE, if present)."""
+    figures = dict(DEFAULT_THROUGHPUT)
+    path = path or DEFAULT_THROUGHPUT_FILE
+    if os.path.exists(path):
+        with open(path) as f:
+            figures.update({name: float(value) for name, value in json.load(f).items() if name in figures})
+    return figures
+
+
+def _storage(dataset):
+    """(stored bytes, raw bytes) of a dataset, from its header."""
+    return dataset.id.get_storage_size(), dataset.size * dataset.dtype.itemsize
+
+
+def _input_header(source):
+    f = source.bag_file
+    layers = [ELEVATION_PATH, UNCERTAINTY_PATH] + sorted(source.optional_layers)
+    return {
+        'name': source.name,
+        'path': source.data_path,
+        'file_bytes': os.path.getsize(source.data_path),
+        'shape': list(getattr(source, 'source_shape', source.shape)),
+        'chunks': list(f[ELEVATION_PATH].chunks or f[ELEVATION_PATH].shape),
+        'resampled': getattr(source, 'method', None),
+        'layers': {path: _storage(f[path]) for path in layers},
+    }
+
+
+def _clipped_footprint(source, shape):
+    """(row start, row stop, col start, col stop) of an input on the output lattice, clipped to it."""
+    r0, c0 = max(source.row_offset, 0), max(source.col_offset, 0)
+    r1 = min(source.row_offset + source.shape[0], shape[0])
+    c1 = min(source.col_offset + source.shape[1], shape[1])
+    return (r0, max(r1, r0), c0, max(c1, c0))
+
+
+def _union_nodes(footprints):
+    """Nodes covered by at least one footprint, counted on the grid of footprint edges (no per-node work)."""
+    rows = sorted({edge for r0, r1, _, _ in footprints for edge in (r0, r1)})
+    cols = sorted({edge for _, _, c0, c1 in footprints for edge in (c0, c1)})
+    covered = 0
+    for i in range(len(rows) - 1):
+        for j in range(len(cols) - 1):
+            if any(r0 <= rows[i] and rows[i + 1] <= r1 and c0 <= cols[j] and cols[j + 1] <= c1
+                   for r0, r1, c0, c1 in footprints):
+                covered += (rows[i + 1] - rows[i]) * (cols[j + 1] - cols[j])
+    return covered
+
+
+def plan_conversion(data_paths, throughput=None, workers=None, shards=None, max_memory=None, compact=False,
+                    track_superseded=False, downsample='nearest', upsample='nearest', tile_size=DEFAULT_TILE_SIZE):
+    """
+    Cost of converting `data_paths` (precedence order, lowest first, as in
+    DATA_LAYERS) with the given converter settings; `throughput` as returned by
+    load_throughput. Reads headers and XML only. Returns a dict (see the module
+    docstring); raises ValueError if an input is missing.
+    """
+    missing = [path for path in data_paths if not os.path.exists(path)]
+    if missing:
+        raise ValueError(f"input(s) not found: {', '.join(missing)}")
+    throughput = throughput or load_throughput()
+    # the template is a copy of the last input, so its headers stand in for the output's
+    template = data_paths[-1]
+    layers = [{'name': os.path.basename(path), 'data_path': path, 'key': i} for i, path in enumerate(data_paths, 1)]
+    inputs = open_inputs(template, layers, {layer['key']: layer['key'] for layer in layers}, downsample, upsample)
+    try:
+        with h5py.File(template, 'r') as f:
+            georef = get_grid_georef(read_bag_xml(f))
+            shape = f[ELEVATION_PATH].shape
+            tile = chunk_aligned_tile(f[ELEVATION_PATH], tile_size)
+            tile = (min(tile[0], shape[0]), min(tile[1], shape[1]))
+            template_stored, template_raw = _storage(f[ELEVATION_PATH])
+            optional_paths = shared_optional_layers(inputs)
+            # layers the composite replaces; compaction drops their old copies from the template
+            replaced = sum(_storage(f[path])[0] for path in (ELEVATION_PATH, UNCERTAINTY_PATH, *optional_paths)
+                           if path in f)
+        headers = [_input_header(source) for source in inputs]
+        footprints = [_clipped_footprint(source, shape) for source in inputs]
+        optional_dtypes = {path: inputs[0].bag_file[path].dtype for path in optional_paths}
+
+        nodes = shape[0] * shape[1]
+        covered = [(r1 - r0) * (c1 - c0) for r0, r1, c0, c1 in footprints]
+        union = _union_nodes(footprints)
+        # nodes of each input decoded while compositing: its footprint, in source nodes for resampled inputs
+        input_nodes = sum(n * getattr(source, 'scale', 1.0) for n, source in zip(covered, inputs))
+        layers_read = 2 + len(optional_paths)
+        layer_bytes = [4, 4, 2] + [np.dtype(dtype).itemsize for dtype in optional_dtypes.values()]
+        ratio = template_stored / template_raw if template_raw else 1.0
+        composite_write = int(nodes * sum(layer_bytes) * ratio)
+        composite_read = int(sum(sum(h['layers'][p][0] for p in (ELEVATION_PATH, UNCERTAINTY_PATH, *optional_paths))
+                                 * (n / max(source.shape[0] * source.shape[1], 1))
+                                 for h, n, source in zip(headers, covered, inputs)))
+        if track_superseded:
+            # every candidate that loses is one record; at most one per extra covering input per node
+            composite_write += (sum(covered) - union) * TRACKING_LIST_DTYPE.itemsize
+
+        input_bytes = sum(h['file_bytes'] for h in headers)
+        template_bytes = os.path.getsize(template)
+        # rewritten chunks usually get new space in the copied template, so the file grows by about the new layers
+        output_bytes = template_bytes + composite_write
+        steps = {
+            'fix_corners': {'read': input_bytes, 'write': input_bytes},
+            'template_copy': {'read': template_bytes, 'write': template_bytes},
+            'composite': {'read': composite_read, 'write': composite_write},
+        }
+        scratch = 0
+        if workers or shards:
+            # bands/shards are written to scratch files, then their chunks copied into the bag
+            scratch = composite_write
+            steps['stitch'] = {'read': composite_write, 'write': composite_write}
+        if compact:
+            steps['compact'] = {'read': output_bytes, 'write': template_bytes - replaced + composite_write}
+
+        if shards or workers:
+            per_worker = estimate_composite_memory(inputs, tile, 0, 1, optional_dtypes)
+            memory = {'per_worker_bytes': per_worker,
+                      'peak_bytes': per_worker if shards else per_worker * workers + BASE_MEMORY}
+        elif max_memory:
+            memory_plan = plan_composite(template, inputs, max_memory)
+            memory = {'peak_bytes': memory_plan['estimated_bytes'], 'tile_size': list(memory_plan['tile_size']),
+                      'read_workers': memory_plan['read_workers'], 'prefetch': memory_plan['prefetch']}
+        else:
+            memory = {'peak_bytes': estimate_composite_memory(inputs, tile, 0, len(inputs), optional_dtypes),
+                      'tile_size': list(tile), 'read_workers': len(inputs), 'prefetch': 0}
+
+        copy_rate = throughput['copy_bytes_per_second']
+        composite_seconds = (input_nodes * layers_read / throughput['read_nodes_per_second']
+                             + nodes * len(layer_bytes) / throughput['write_nodes_per_second'])
+        parallelism = shards or min(workers or 1, os.cpu_count() or 1)
+        runtime = {
+            'fix_corners': input_bytes / copy_rate,
+            'template_copy': template_bytes / copy_rate,
+            'composite': composite_seconds / parallelism,
+        }
+        if 'stitch' in steps:
+            runtime['stitch'] = 2 * composite_write / copy_rate
+        if compact:
+            output_layers = len(layer_bytes) - 1 + len(optional_paths)  # raster layers outside the composite too
+            runtime['compact'] = (nodes * output_layers * (1 / throughput['read_nodes_per_second']
+                                                           + 1 / throughput['write_nodes_per_second']))
+
+        return {
+            'output': {'rows': shape[0], 'cols': shape[1], 'nodes': nodes, 'x_res': georef['x_res'],
+                       'y_res': georef['y_res'], 'sw_x': georef['sw_x'], 'sw_y': georef['sw_y'],
+                       'template': template, 'optional_layers': optional_paths},
+            'inputs': [{**h, 'footprint': list(fp), 'covered_nodes': n}
+                       for h, fp, n in zip(headers, footprints, covered)],
+            'overlap': {'covered_nodes': union, 'multiply_covered_nodes': sum(covered) - union,
+                        'uncovered_nodes': nodes - union},
+            'memory': memory,
+            'disk': {
+                'steps': steps,
+                'read_bytes': sum(step['read'] for step in steps.values()),
+                'write_bytes': sum(step['write'] for step in steps.values()),
+                'output_bytes': output_bytes,
+                'fixed_copies_bytes': input_bytes,
+                # fixed copies + the growing output, plus scratch files or the compaction copy at their peak
+                'peak_bytes': input_bytes + output_bytes + max(scratch, steps.get('compact', {}).get('write', 0)),
+            },
+            'runtime_seconds': {**runtime, 'total': sum(runtime.values())},
+            'throughput': throughput,
+        }
+    finally:
+        for source in inputs:
+            source.close()
+
+
+def _size(value):
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if abs(value) < 1024 or unit == 'TB':
+            return f"{value:.1f} {unit}" if unit != 'B' else f"{int(value)} B"
+        value /= 1024
+
+
+def _duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+
+def format_plan(plan):
+    """Human-readable lines for a plan_conversion result."""
+    out = plan['output']
+    lines = [f"Output: {out['rows']} x {out['cols']} nodes at {out['x_res']:g} x {out['y_res']:g} "
+             f"(SW {out['sw_x']:.3f}, {out['sw_y']:.3f}), template '{os.path.basename(out['template'])}'"]
+    if out['optional_layers']:
+        lines.append(f"  optional layers: {', '.join(os.path.basename(p) for p in out['optional_layers'])}")
+    for source in plan['inputs']:
+        r0, r1, c0, c1 = source['footprint']
+        lines.append(f"  {source['name']}: {source['shape'][0]} x {source['shape'][1]}, {_size(source['file_bytes'])}, "
+                     f"rows {r0}-{r1} cols {c0}-{c1}" + (f", resampled ({source['resampled']})"
+                                                        if source['resampled'] else ""))
+    overlap = plan['overlap']
+    lines.append(f"Overlap: {overlap['covered_nodes']} nodes covered, {overlap['multiply_covered_nodes']} by more "
+                 f"than one input, {overlap['uncovered_nodes']} by none")
+    memory = plan['memory']
+    lines.append(f"Peak memory: {_size(memory['peak_bytes'])}"
+                 + (f" ({_size(memory['per_worker_bytes'])} per worker)" if 'per_worker_bytes' in memory else
+                    f" (tiles {memory['tile_size'][0]}x{memory['tile_size'][1]}, {memory['read_workers']} read "
+                    f"thread(s), prefetch {memory['prefetch']})"))
+    disk = plan['disk']
+    for name, step in disk['steps'].items():
+        lines.append(f"  {name}: read {_size(step['read'])}, write {_size(step['write'])}, "
+                     f"~{_duration(plan['runtime_seconds'][name])}")
+    lines.append(f"Disk: read {_size(disk['read_bytes'])}, write {_size(disk['write_bytes'])}, peak in use "
+                 f"{_size(disk['peak_bytes'])} (output up to {_size(disk['output_bytes'])}, _fixed.bag copies "
+                 f"{_size(disk['fixed_copies_bytes'])} left behind)")
+    lines.append(f"Projected runtime: {_duration(plan['runtime_seconds']['total'])}")
+    return lines
+
+
+def calibrate(sample_path, path=None):
+    """
+    Measure the throughput figures on this machine by copying `sample_path` and
+    compositing it into the copy with one and then two inputs, and save them to
+    `path` (default: DEFAULT_THROUGHPUT_FILE). Returns the figures.
+    """
+    folder = tempfile.mkdtemp(prefix='plan_calibration_')
+    try:
+        target = os.path.join(folder, 'calibration.bag')
+        start = time.perf_counter()
+        shutil.copyfile(sample_path, target)
+        copy_seconds = time.perf_counter() - start
+        with h5py.File(target, 'r') as f:
+            nodes = f[ELEVATION_PATH].size
+        timings, layers = [], 2
+        for n_inputs in (1, 2):
+            inputs = [CompositeInput('calibration', sample_path, 1, 0, 0) for _ in range(n_inputs)]
+            layers = 2 + len(shared_optional_layers(inputs))
+            try:
+                start = time.perf_counter()
+                composite_bag(target, inputs, read_workers=1)
+                timings.append(time.perf_counter() - start)
+            finally:
+                for source in inputs:
+                    source.close()
+    finally:
+        shutil.rmtree(folder)
+    # one input reads and writes the grid once; the second adds one more read of every layer
+    read_seconds = max(timings[1] - timings[0], 1e-6)
+    write_seconds = max(timings[0] - read_seconds, 1e-6)
+    figures = {
+        'copy_bytes_per_second': os.path.getsize(sample_path) / max(copy_seconds, 1e-6),
+        'read_nodes_per_second': nodes * layers / read_seconds,
+        'write_nodes_per_second': nodes * (layers + 1) / write_seconds,
+    }
+    with open(path or DEFAULT_THROUGHPUT_FILE, 'w') as f:
+        json.dump(figures, f, indent=1)
+    return figures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Estimate the cost of a BAG 2.X conversion from headers only.")
+    parser.add_argument('inputs', nargs='*', help="input bags in precedence order (lowest first)")
+    parser.add_argument('--workers', type=int, help="plan for parallel_composite with this many processes")
+    parser.add_argument('--shards', type=int, help="plan for a sharded job with this many shards")
+    parser.add_argument('--max-memory', help="memory budget for single-process compositing, e.g. 4G")
+    parser.add_argument('--compact', action='store_true', help="include the compaction step")
+    parser.add_argument('--track-superseded', action='store_true', help="include tracking list records")
+    parser.add_argument('--downsample', default='nearest', help="method for finer inputs (see bag_resample.py)")
+    parser.add_argument('--upsample', default='nearest', help="method for coarser inputs (see bag_resample.py)")
+    parser.add_argument('--throughput', help=f"throughput figures JSON (default: {DEFAULT_THROUGHPUT_FILE})")
+    parser.add_argument('--calibrate', metavar='SAMPLE_BAG', help="measure throughput with this bag and save it")
+    parser.add_argument('--json', action='store_true', help="print the plan as JSON")
+    args = parser.parse_args(argv)
+    try:
+        if args.calibrate:
+            figures = calibrate(args.calibrate, args.throughput)
+            print(json.dumps(figures, indent=1))
+            return 0
+        if not args.inputs:
+            parser.error("give the input bags, or --calibrate")
+        plan = plan_conversion(args.inputs, load_throughput(args.throughput), args.workers, args.shards,
+                               parse_memory_size(args.max_memory) if args.max_memory else None, args.compact,
+                               args.track_superseded, args.downsample, args.upsample)
+    except (ValueError, OSError) as e:
+        print(f"Error: {e}")
+        return 1
+    print(json.dumps(plan, indent=1) if args.json else '\n'.join(format_plan(plan)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Compositing spread over several machines through a job folder on a shared filesystem.
+
+    plan      plan_shards (or the converter's SHARD_FOLDER setting, or
+              `bag_cli.py composite ... --shard-folder`) prepares the output BAG,
+              splits it into shards of whole chunk rows and writes the job folder:
+                  manifest.json           output, inputs, rule, layer layouts, shards
+                  queue/<shard>.todo      one marker per unclaimed shard
+    work      any number of `python shard_composite.py work <job folder>` processes,
+              on any node that sees the same paths, claim shards by renaming
+              <shard>.todo to <shard>.lease.<host>-<pid> (rename is atomic, so exactly
+              one worker wins), composite them into results/<shard>.h5 exactly like
+              parallel_composite does a band, and rename the lease to <shard>.done.
+              A lease is refreshed while its shard is being worked on; one left
+              untouched for longer than the lease timeout (crashed worker or node) is
+              taken over by the next idle worker.
+    assemble  `python shard_composite.py assemble <job folder>` stitches the results
+              into the BAG (chunk copy or virtual datasets, see parallel_composite)
+              once every shard is done.
+
+Locally, `work --processes N` runs N workers on one machine.
+
+usage:
+    python shard_composite.py work <job folder> [--processes N] [--lease-timeout SECONDS]
+    python shard_composite.py status <job folder>
+    python shard_composite.py assemble <job folder> [--stitch copy|virtual]
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import socket
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import bag_compositor
+from bag_compositor import DEFAULT_TILE_SIZE
+from parallel_composite import prepare_bands, band_windows, composite_band, stitch_bands, STITCH_MODES
+
+MANIFEST_NAME = 'manifest.json'
+DEFAULT_SHARD_NODES = 64 * 1024 ** 2  # ~256 MB of float32 elevation per shard
+DEFAULT_LEASE_TIMEOUT = 1800  # seconds without a heartbeat before a lease is taken over
+
+
+def _manifest_layout(layout):
+    return {**layout, 'dtype': np.dtype(layout['dtype']).str, 'chunks': list(layout['chunks']),
+            'fillvalue': np.asarray(layout['fillvalue']).item()}
+
+
+def _layout_from_manifest(layout):
+    dtype = np.dtype(layout['dtype'])
+    return {**layout, 'dtype': dtype, 'chunks': tuple(layout['chunks']), 'fillvalue': dtype.type(layout['fillvalue'])}
+
+
+def read_manifest(job_folder):
+    with open(os.path.join(job_folder, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+
+def plan_shards(output_path, inputs, job_folder, rule='last_wins', shards=None, tile_size=DEFAULT_TILE_SIZE,
+                lineage_text=None, track_superseded=False):
+    """
+    Prepare `output_path` and write the job folder for compositing `inputs` into it
+    as `shards` shards (default: about DEFAULT_SHARD_NODES nodes each). `rule` must
+    be given by name (see bag_compositor.get_rule) so workers can resolve it, and
+    every input path must be reachable under the same name from every node.
+    lineage_text, if given, is added as a lineage process step by the assembler;
+    track_superseded as for bag_compositor.composite_bag. Returns the manifest.
+    """
+    if callable(rule):
+        raise ValueError("Sharded compositing needs the rule by name, e.g. 'min_uncertainty' or 'module:function'.")
+    bag_compositor.get_rule(rule)
+    paths, layouts, shape, chunk_rows = prepare_bands(output_path, inputs)
+    shards = shards or max(1, -(-shape[0] * shape[1] // DEFAULT_SHARD_NODES))
+    windows = band_windows(shape, chunk_rows, shards)
+    manifest = {
+        'output': os.path.abspath(output_path),
+        'rule': rule,
+        'tile_size': list(tile_size),
+        'shape': list(shape),
+        'paths': paths,
+        'layouts': {path: _manifest_layout(layout) for path, layout in layouts.items()},
+        'inputs': [{'class': cls.__name__, 'args': list(args)} for cls, args in (source.spec() for source in inputs)],
+        'shards': [{'id': f'shard_{i:05d}', 'rows': list(window)} for i, window in enumerate(windows)],
+        'lineage_text': lineage_text,
+        'track_superseded': track_superseded,
+    }
+    if os.path.exists(job_folder):
+        shutil.rmtree(job_folder)
+    os.makedirs(os.path.join(job_folder, 'queue'))
+    os.makedirs(os.path.join(job_folder, 'results'))
+    for shard in manifest['shards']:
+        open(os.path.join(job_folder, 'queue', shard['id'] + '.todo'), 'w').close()
+    # the manifest goes last: workers treat a job folder without one as not ready yet
+    temp_path = os.path.join(job_folder, MANIFEST_NAME + '.tmp')
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(temp_path, os.path.join(job_folder, MANIFEST_NAME))
+    print(f"Planned {len(windows)} shard(s) of {shape[1]} columns in '{job_folder}'")
+    return manifest
+
+
+def _queue(job_folder, pattern):
+    return sorted(glob.glob(os.path.join(job_folder, 'queue', pattern)))
+
+
+def _claim(job_folder, owner, lease_timeout):
+    """(shard id, lease path) for a free or abandoned shard, or (None, None) when nothing is left to claim."""
+    for todo in _queue(job_folder, '*.todo'):
+        shard_id = os.path.basename(todo)[:-len('.todo')]
+        lease = os.path.join(job_folder, 'queue', f'{shard_id}.lease.{owner}')
+        try:
+            os.rename(todo, lease)
+            return shard_id, lease
+        except FileNotFoundError:
+            continue  # another worker got there first
+    for stale in _queue(job_folder, '*.lease.*'):
+        try:
+            if time.time() - os.path.getmtime(stale) < lease_timeout:
+                continue
+            shard_id = os.path.basename(stale).split('.lease.')[0]
+            lease = os.path.join(job_folder, 'queue', f'{shard_id}.lease.{owner}')
+            # refresh the mtime before the rename carries it over, so the new lease never looks abandoned
+            os.utime(stale)
+            os.rename(stale, lease)
+            print(f"[{owner}] taking over abandoned {shard_id}")
+            return shard_id, lease
+        except FileNotFoundError:
+            continue
+    return None, None
+
+
+def _heartbeat(lease, interval, stop):
+    while not stop.wait(interval):
+        try:
+            os.utime(lease)
+        except FileNotFoundError:
+            return  # taken over; the result is identical, so finishing anyway is harmless
+
+
+def work(job_folder, lease_timeout=DEFAULT_LEASE_TIMEOUT):
+    """Claim and composite shards until none is left; returns the number composited by this worker."""
+    if not os.path.exists(os.path.join(job_folder, MANIFEST_NAME)):
+        print(f"No {MANIFEST_NAME} in '{job_folder}' yet (still being planned?), nothing to do")
+        return 0
+    manifest = read_manifest(job_folder)
+    owner = f'{socket.gethostname()}-{os.getpid()}'
+    shards = {shard['id']: shard for shard in manifest['shards']}
+    input_specs = [(getattr(bag_compositor, spec['class']), tuple(spec['args'])) for spec in manifest['inputs']]
+    layouts = {path: _layout_from_manifest(layout) for path, layout in manifest['layouts'].items()}
+    done = 0
+    while True:
+        shard_id, lease = _claim(job_folder, owner, lease_timeout)
+        if shard_id is None:
+            return done
+        result = os.path.join(job_folder, 'results', shard_id)
+        stop = threading.Event()
+        threading.Thread(target=_heartbeat, args=(lease, lease_timeout / 4, stop), daemon=True).start()
+        try:
+            # written under a private name, so a shard taken over mid-write never leaves a torn file
+            ranges = composite_band((f'{result}.{owner}.h5', input_specs, tuple(shards[shard_id]['rows']),
+                                     manifest['shape'][1], layouts, manifest['rule'], tuple(manifest['tile_size']),
+                                     manifest['track_superseded']))
+            with open(f'{result}.{owner}.json', 'w') as f:
+                json.dump({path: [float(v) for v in value_range] for path, value_range in ranges.items()}, f)
+            os.replace(f'{result}.{owner}.h5', result + '.h5')
+            os.replace(f'{result}.{owner}.json', result + '.json')
+        finally:
+            stop.set()
+        try:
+            os.rename(lease, os.path.join(job_folder, 'queue', shard_id + '.done'))
+        except FileNotFoundError:
+            pass  # taken over meanwhile; the other worker marks it done
+        done += 1
+        print(f"[{owner}] {shard_id} done (rows {shards[shard_id]['rows'][0]}-{shards[shard_id]['rows'][1]})")
+
+
+def work_processes(job_folder, processes, lease_timeout=DEFAULT_LEASE_TIMEOUT):
+    """Run `processes` workers on this machine; returns the shards composited."""
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return sum(pool.map(work, [job_folder] * processes, [lease_timeout] * processes))
+
+
+def job_status(job_folder):
+    manifest = read_manifest(job_folder)
+    return {
+        'shards': len(manifest['shards']),
+        'todo': len(_queue(job_folder, '*.todo')),
+        'leased': len(_queue(job_folder, '*.lease.*')),
+        'done': len(_queue(job_folder, '*.done')),
+    }
+
+
+def assemble(job_folder, stitch='copy'):
+    """Stitch the finished shards into the output BAG; raises ValueError while shards are outstanding."""
+    if stitch not in STITCH_MODES:
+        raise ValueError(f"Unknown stitch mode '{stitch}'. Use one of: {', '.join(STITCH_MODES)}")
+    manifest = read_manifest(job_folder)
+    results = os.path.join(job_folder, 'results')
+    missing = [shard['id'] for shard in manifest['shards']
+               if not os.path.exists(os.path.join(results, shard['id'] + '.json'))]
+    if missing:
+        raise ValueError(f"{len(missing)} shard(s) not finished yet, e.g. {missing[0]}")
+    bands, band_ranges = [], []
+    for shard in manifest['shards']:
+        bands.append((os.path.join(results, shard['id'] + '.h5'), tuple(shard['rows'])))
+        with open(os.path.join(results, shard['id'] + '.json')) as f:
+            band_ranges.append(json.load(f))
+    layouts = {path: _layout_from_manifest(layout) for path, layout in manifest['layouts'].items()}
+    stitch_bands(manifest['output'], manifest['paths'], layouts, tuple(manifest['shape']), bands, band_ranges, stitch)
+    if manifest['lineage_text']:
+        from bag_metadata_editor import BagMetadataSession
+        with BagMetadataSession(manifest['output']) as session:
+            if not session.add_process_step(manifest['lineage_text']):
+                print("  Warning: Could not find <gmd:LI_Lineage> element. Skipping process step.")
+    if stitch == 'copy':
+        shutil.rmtree(job_folder)
+    print(f"Assembled {len(bands)} shard(s) into '{manifest['output']}'"
+          + (f"; virtual layers read from '{results}'" if stitch == 'virtual' else ""))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Work on or assemble a sharded compositing job.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    work_parser = commands.add_parser('work', help="claim and composite shards until none is left")
+    work_parser.add_argument('job_folder')
+    work_parser.add_argument('--processes', type=int, default=1, help="worker processes on this machine")
+    work_parser.add_argument('--lease-timeout', type=float, default=DEFAULT_LEASE_TIMEOUT,
+                             help="seconds before an unrefreshed lease is taken over")
+    status_parser = commands.add_parser('status', help="count shards by state")
+    status_parser.add_argument('job_folder')
+    assemble_parser = commands.add_parser('assemble', help="stitch the finished shards into the output bag")
+    assemble_parser.add_argument('job_folder')
+    assemble_parser.add_argument('--stitch', choices=STITCH_MODES, default='copy')
+    args = parser.parse_args(argv)
+    try:
+        if args.command == 'work':
+            if args.processes > 1:
+                done = work_processes(args.job_folder, args.processes, args.lease_timeout)
+            else:
+                done = work(args.job_folder, args.lease_timeout)
+            print(f"{done} shard(s) composited")
+        elif args.command == 'status':
+            print(json.dumps(job_status(args.job_folder)))
+        else:
+            assemble(args.job_folder, args.stitch)
+    except (ValueError, OSError) as e:
+        print(f"Error: {e}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental update of an existing BAG 2.X composite - adds one new survey on top
+of the composite without re-running create_bag_v2x over every input.
+
+The new survey gets its own NOAA_OCS_2022_10 record, and only the elevation,
+uncertainty and keys chunks it overlaps are read and rewritten, so the cost of
+an update follows the size of the new survey rather than the composite. Optional
+layers carried by both the composite and the survey (nominal_elevation, ...) are
+replaced with the same mask, as create_bag_v2x composites them.
+
+- the new survey bag must be node-aligned with the composite and share its
+resolution (same assumption create_bag_v2x makes about its inputs).
+"""
+
+import os
+import numpy as np
+import h5py
+from bag_utils import (get_bag_metadata_for_fix, update_corner_points, parse_survey_metadata, read_bag_xml,
+                       get_grid_georef, get_grid_offset, iter_chunk_windows, survey_record_values, survey_grid_name,
+                       BAG_NO_DATA, ELEVATION_PATH, UNCERTAINTY_PATH, KEYS_PATH, VALUES_PATH)
+from bag_metadata_editor import BagMetadataSession
+from bag_compositor import _is_optional_layer
+from bag_statistics import scan_range
+
+
+def append_value_record(bag_file, metadata):
+    """Append a NOAA_OCS_2022_10 record to the values table and return its index."""
+    values = bag_file[VALUES_PATH]
+    record_index = values.shape[0]
+    values.resize((record_index + 1,))
+    values[record_index] = survey_record_values(metadata)
+    return record_index
+
+
+class LayerRange:
+    """
+    Min/max attributes of a layer after some of its windows are rewritten. The old
+    range still holds for the untouched remainder unless a replaced node carried
+    the old minimum or maximum; only then is the layer rescanned.
+    """
+
+    def __init__(self, dataset, min_name, max_name):
+        self.dataset, self.min_name, self.max_name = dataset, min_name, max_name
+        self.nodata = dataset.dtype.type(BAG_NO_DATA)
+        if min_name in dataset.attrs and max_name in dataset.attrs:
+            self.old = (dataset.attrs[min_name], dataset.attrs[max_name])
+        else:
+            self.old = None
+        self.rescan = self.old is None
+        self.low, self.high = np.inf, -np.inf
+
+    def add(self, replaced, block):
+        """Old values of the overwritten nodes, and the rewritten window."""
+        if self.old is not None and np.isin(replaced, self.old).any():
+            self.rescan = True
+        data = block[block != self.nodata]
+        if data.size:
+            self.low, self.high = min(self.low, data.min()), max(self.high, data.max())
+
+    def write(self):
+        if self.rescan:
+            low, high = scan_range(self.dataset)
+        else:
+            low, high = min(self.old[0], self.low), max(self.old[1], self.high)
+        self.dataset.attrs[self.min_name] = np.float32(low)
+        self.dataset.attrs[self.max_name] = np.float32(high)
+
+
+def shared_optional_paths(bag_file, survey):
+    """Optional layers of the composite that the survey carries too, on its own lattice."""
+    shape, survey_shape = bag_file[ELEVATION_PATH].shape, survey[ELEVATION_PATH].shape
+    return sorted(dataset.name for dataset in bag_file['/BAG_root'].values()
+                  if _is_optional_layer(dataset, shape) and dataset.name in survey
+                  and _is_optional_layer(survey[dataset.name], survey_shape)
+                  and survey[dataset.name].dtype == dataset.dtype)
+
+
+def add_survey_to_bag_v2x(bag_path, layer):
+    """
+    Paste the survey described by `layer` (same dict layout as DATA_LAYERS in the
+    converter) over the composite at `bag_path`. The new survey takes precedence
+    wherever it has data. Returns the new record index, or None on failure.
+    """
+    print(f"Adding survey '{layer['name']}' to '{os.path.basename(bag_path)}'")
+    target_grid_name = survey_grid_name(layer['data_path'])
+    metadata = parse_survey_metadata(layer['metadata_path'], target_grid_name)
+    if not metadata:
+        print("Error: could not read survey metadata. Nothing updated."); return None
+    metadata['source_survey'] = target_grid_name
+
+    try:
+        survey_xml = update_corner_points(get_bag_metadata_for_fix(layer['data_path']))
+        if survey_xml is None: raise ValueError("Failed to read survey grid parameters.")
+        survey_georef = get_grid_georef(survey_xml)
+    except Exception as e:
+        print(f"Error reading survey georeferencing: {e}"); return None
+
+    try:
+        with h5py.File(bag_path, 'r+') as f, h5py.File(layer['data_path'], 'r') as survey:
+            row_offset, col_offset = get_grid_offset(get_grid_georef(read_bag_xml(f)), survey_georef)
+
+            elevation, uncertainty, keys = f[ELEVATION_PATH], f[UNCERTAINTY_PATH], f[KEYS_PATH]
+            survey_elevation, survey_uncertainty = survey[ELEVATION_PATH], survey[UNCERTAINTY_PATH]
+            rows, cols = elevation.shape
+            row_start, col_start = max(row_offset, 0), max(col_offset, 0)
+            row_stop = min(row_offset + survey_elevation.shape[0], rows)
+            col_stop = min(col_offset + survey_elevation.shape[1], cols)
+            if row_start >= row_stop or col_start >= col_stop:
+                print("Survey does not overlap the composite. Nothing updated."); return None
+
+            record_index = append_value_record(f, metadata)
+            print(f"Record added at index {record_index}, with sourceSurveyIndex=0.")
+            optional_paths = shared_optional_paths(f, survey)
+            if optional_paths:
+                print(f"Updating optional layers: {', '.join(os.path.basename(p) for p in optional_paths)}")
+
+            ranges = [LayerRange(elevation, 'Minimum Elevation Value', 'Maximum Elevation Value'),
+                      LayerRange(uncertainty, 'Minimum Uncertainty Value', 'Maximum Uncertainty Value')]
+            ranges += [LayerRange(f[path], 'min_value', 'max_value') for path in optional_paths]
+            # walk the keys chunk grid so each touched chunk is rewritten exactly once
+            chunks_written = 0
+            for rows_win, cols_win in iter_chunk_windows(keys.shape, keys.chunks, row_start, row_stop, col_start, col_stop):
+                src = (slice(rows_win.start - row_offset, rows_win.stop - row_offset),
+                       slice(cols_win.start - col_offset, cols_win.stop - col_offset))
+                new_elev = survey_elevation[src]
+                mask = new_elev != BAG_NO_DATA
+                if not mask.any():
+                    continue
+                keys_block = keys[rows_win, cols_win]
+                keys_block[mask] = record_index
+                keys[rows_win, cols_win] = keys_block
+                layers = [(elevation, new_elev), (uncertainty, survey_uncertainty[src])]
+                layers += [(f[path], survey[path][src]) for path in optional_paths]
+                for (dataset, new_values), layer_range in zip(layers, ranges):
+                    block = dataset[rows_win, cols_win]
+                    layer_range.add(block[mask], np.where(mask, new_values, block))
+                    block[mask] = new_values[mask]
+                    dataset[rows_win, cols_win] = block
+                chunks_written += 1
+            for layer_range in ranges:
+                layer_range.write()
+            print(f"Rewrote {chunks_written} chunk window(s) overlapped by the new survey.")
+
+            description = (f"Survey {target_grid_name} added to the composite BAG by incremental update. "
+                           f"Elevation, uncertainty, keys and shared optional layers replaced where the survey has data "
+                           f"(record index {record_index}).")
+            with BagMetadataSession(f) as session:
+                if not session.add_process_step(description):
+                    print("  Warning: Could not find <gmd:LI_Lineage> element. Skipping process step.")
+        print("done." f" updated bag v2.x: {bag_path}")
+        return record_index
+    except Exception as e:
+        print(f"An error occurred while updating '{os.path.basename(bag_path)}': {e}"); return None
+
+
+if __name__ == "__main__":
+    BAG_PATH = r"E:\bag 2.0 project\H12286_MB_1m_MLLW_v2.1.bag"
+    NEW_LAYER = {
+        'key': 3, 'name': "MBES",
+        'data_path': r"E:\bag 2.0 project\H12286_MB_1m_MLLW_2of2.bag",
+        'metadata_path': r"E:\bag 2.0 project\H12286_Survey_Metadata.xml"
+    }
+    add_survey_to_bag_v2x(BAG_PATH, NEW_LAYER)
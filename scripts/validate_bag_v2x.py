@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+BAG 2.X validator for bulk QA of converter output.
+
+Each file is streamed in bands of whole elevation chunk rows, so memory stays at a
+few chunk rows no matter how big the grid is. Checks:
+    - structure: required datasets present, no un-renamed georef_metadata/Elevation group
+    - attributes: 'Bag Version', elevation/uncertainty min/max attributes
+    - shapes: elevation, uncertainty, keys and the XML dimensions all agree
+    - keys: every key references an existing record, data nodes carry a non-null key
+    - nodata: elevation and uncertainty agree on which nodes are empty
+    - corner points: north-east corner matches south-west + (dimensions - 1) * resolution
+
+Many files are validated in parallel worker processes and reported as one line per
+problem file plus a summary count per issue code.
+
+usage: python validate_bag_v2x.py <bag or folder> [...] [--workers N] [--json report.json]
+"""
+
+import sys
+import json
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import h5py
+from bag_utils import (read_bag_xml, get_grid_georef, find_bag_files, namespaces, BAG_VERSION, BAG_NO_DATA,
+                       METADATA_PATH, ELEVATION_PATH, UNCERTAINTY_PATH, TRACKING_LIST_PATH, GEOREF_METADATA_PATH,
+                       KEYS_PATH, VALUES_PATH)
+
+REQUIRED_PATHS = (METADATA_PATH, ELEVATION_PATH, UNCERTAINTY_PATH, TRACKING_LIST_PATH, KEYS_PATH, VALUES_PATH)
+STALE_LAYER_PATH = f'{GEOREF_METADATA_PATH}/Elevation'
+
+
+def _check_corner_points(metadata, shape, issues):
+    try:
+        georef = get_grid_georef(metadata)
+    except ValueError as e:
+        issues.append(('xml', str(e))); return
+    if (georef['rows'], georef['cols']) != tuple(shape):
+        issues.append(('xml_dimensions', f"XML dimensions {georef['rows']}x{georef['cols']} != elevation {shape[0]}x{shape[1]}"))
+    coordinates = metadata.find(".//gml:coordinates", namespaces).text.strip().split()
+    if len(coordinates) != 2:
+        issues.append(('corner_points', "Unexpected coordinate format.")); return
+    ne_x, ne_y = (float(c) for c in coordinates[1].split(','))
+    expected_x = georef['sw_x'] + (georef['cols'] - 1) * georef['x_res']
+    expected_y = georef['sw_y'] + (georef['rows'] - 1) * georef['y_res']
+    if abs(ne_x - expected_x) > georef['x_res'] * 1e-3 or abs(ne_y - expected_y) > georef['y_res'] * 1e-3:
+        issues.append(('corner_points', f"north-east corner {ne_x},{ne_y} != expected {expected_x},{expected_y}"))
+
+
+def _check_nodes(f, issues):
+    """Stream elevation, uncertainty and keys in bands of chunk rows."""
+    elevation, uncertainty, keys = f[ELEVATION_PATH], f[UNCERTAINTY_PATH], f[KEYS_PATH]
+    record_count = f[VALUES_PATH].shape[0]
+    band_rows = (elevation.chunks or keys.chunks or (256,))[0]
+    nodata_mismatch = bad_keys = unkeyed = keyed_nodata = 0
+    for r0 in range(0, elevation.shape[0], band_rows):
+        rows = slice(r0, min(r0 + band_rows, elevation.shape[0]))
+        elev_empty = elevation[rows] == BAG_NO_DATA
+        uncert_empty = uncertainty[rows] == BAG_NO_DATA
+        band_keys = keys[rows]
+        nodata_mismatch += np.count_nonzero(elev_empty != uncert_empty)
+        bad_keys += np.count_nonzero(band_keys >= record_count)
+        unkeyed += np.count_nonzero(~elev_empty & (band_keys == 0))
+        keyed_nodata += np.count_nonzero(elev_empty & (band_keys != 0))
+    if nodata_mismatch:
+        issues.append(('nodata_mismatch', f"{nodata_mismatch} node(s) are nodata in only one of elevation/uncertainty"))
+    if bad_keys:
+        issues.append(('bad_key', f"{bad_keys} key(s) reference records beyond the {record_count}-row value table"))
+    if unkeyed:
+        issues.append(('unkeyed_node', f"{unkeyed} data node(s) have the null key 0"))
+    if keyed_nodata:
+        issues.append(('keyed_nodata', f"{keyed_nodata} nodata node(s) carry a non-null key"))
+
+
+def validate_bag(bag_path):
+    """Validate one BAG 2.X file. Returns {'path': ..., 'issues': [(code, message), ...]}."""
+    issues = []
+    try:
+        with h5py.File(bag_path, 'r') as f:
+            missing = [p for p in REQUIRED_PATHS if p not in f]
+            for p in missing:
+                issues.append(('missing', f"{p} not found"))
+            if STALE_LAYER_PATH in f:
+                issues.append(('stale_layer', f"{STALE_LAYER_PATH} was not renamed to the NOAA_OCS_2022_10 layer"))
+
+            version = f['/BAG_root'].attrs.get('Bag Version', b'')
+            version = version.decode() if isinstance(version, bytes) else str(version)
+            if version != BAG_VERSION:
+                issues.append(('bag_version', f"'Bag Version' is '{version}', expected '{BAG_VERSION}'"))
+
+            for path, name, attrs in (
+                    (ELEVATION_PATH, 'elevation', ('Minimum Elevation Value', 'Maximum Elevation Value')),
+                    (UNCERTAINTY_PATH, 'uncertainty', ('Minimum Uncertainty Value', 'Maximum Uncertainty Value'))):
+                for attr in attrs:
+                    if path in f and attr not in f[path].attrs:
+                        issues.append(('attribute', f"{name} is missing '{attr}'"))
+
+            if ELEVATION_PATH in f:
+                elevation = f[ELEVATION_PATH]
+                for path in (UNCERTAINTY_PATH, KEYS_PATH):
+                    if path in f and f[path].shape != elevation.shape:
+                        issues.append(('shape', f"{path} shape {f[path].shape} != elevation {elevation.shape}"))
+                if METADATA_PATH in f:
+                    try:
+                        _check_corner_points(read_bag_xml(f), elevation.shape, issues)
+                    except Exception as e:
+                        issues.append(('xml', f"unreadable metadata: {e}"))
+
+            if not missing and not any(code == 'shape' for code, _ in issues):
+                _check_nodes(f, issues)
+    except Exception as e:
+        issues.append(('unreadable', str(e)))
+    return {'path': bag_path, 'issues': issues}
+
+
+def validate_bags(bag_files, workers=None):
+    """Validate many files in parallel worker processes, results in input order."""
+    if len(bag_files) == 1:
+        return [validate_bag(bag_files[0])]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(validate_bag, bag_files, chunksize=8))
+
+
+def print_summary(results):
+    failed = [r for r in results if r['issues']]
+    for result in failed:
+        codes = ','.join(sorted({code for code, _ in result['issues']}))
+        print(f"FAIL {result['path']} [{codes}] {result['issues'][0][1]}")
+    counts = Counter(code for r in failed for code, _ in r['issues'])
+    print(f"{len(results) - len(failed)} of {len(results)} file(s) passed.")
+    if counts:
+        print("issues: " + ", ".join(f"{code}={n}" for code, n in counts.most_common()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Validate BAG 2.X files produced by the converter.")
+    parser.add_argument('paths', nargs='+', help="bag files, glob patterns or folders to search for *.bag")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: cpu count)")
+    parser.add_argument('--json', dest='json_path', help="also write the full report as JSON")
+    args = parser.parse_args(argv)
+
+    results = validate_bags(find_bag_files(args.paths), args.workers)
+    print_summary(results)
+    if args.json_path:
+        with open(args.json_path, 'w') as out:
+            json.dump(results, out, indent=1)
+    return 1 if any(r['issues'] for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the scripts import their siblings by module name, as when run from scripts/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
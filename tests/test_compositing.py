@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Compositing, incremental min/max and validator checks on tiny BAGs built with h5py.
+
+Two overlapping 8x8 surveys are placed on a 12x12 output lattice and composited
+serially and in worker processes; every built-in rule must match a node-by-node
+reference written with plain numpy.
+"""
+
+import numpy as np
+import h5py
+import pytest
+from bag_utils import (BAG_VERSION, BAG_NO_DATA, TRACKING_LIST_DTYPE, ELEVATION_PATH, UNCERTAINTY_PATH,
+                       TRACKING_LIST_PATH, METADATA_PATH, KEYS_PATH, VALUES_PATH, GEOREF_METADATA_PATH)
+from bag_compositor import CompositeInput, composite_bag, RULES
+from parallel_composite import composite_bag_parallel
+from update_bag_v2x import LayerRange
+from validate_bag_v2x import validate_bag
+
+NOMINAL_PATH = '/BAG_root/nominal_elevation'
+OUTPUT_SHAPE = (12, 12)
+SURVEYS = (  # (record index, row offset, col offset)
+    (1, 0, 0),
+    (2, 4, 3),
+)
+THRESHOLD = 1.0
+
+METADATA_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<gmi:MI_Metadata xmlns:gmi="http://www.isotc211.org/2005/gmi" xmlns:gmd="http://www.isotc211.org/2005/gmd"
+    xmlns:gco="http://www.isotc211.org/2005/gco" xmlns:gml="http://www.opengis.net/gml/3.2">
+  <gmd:spatialRepresentationInfo><gmd:MD_Georectified>
+    <gmd:axisDimensionProperties><gmd:MD_Dimension>
+      <gmd:dimensionSize><gco:Integer>{rows}</gco:Integer></gmd:dimensionSize>
+      <gmd:resolution><gco:Measure uom="m">1</gco:Measure></gmd:resolution>
+    </gmd:MD_Dimension></gmd:axisDimensionProperties>
+    <gmd:axisDimensionProperties><gmd:MD_Dimension>
+      <gmd:dimensionSize><gco:Integer>{cols}</gco:Integer></gmd:dimensionSize>
+      <gmd:resolution><gco:Measure uom="m">1</gco:Measure></gmd:resolution>
+    </gmd:MD_Dimension></gmd:axisDimensionProperties>
+    <gmd:cornerPoints><gml:Point gml:id="corners">
+      <gml:coordinates>1000,2000 {ne_x},{ne_y}</gml:coordinates>
+    </gml:Point></gmd:cornerPoints>
+  </gmd:MD_Georectified></gmd:spatialRepresentationInfo>
+</gmi:MI_Metadata>"""
+
+
+def write_bag(path, elevation, uncertainty, nominal, n_records=len(SURVEYS) + 1):
+    """Minimal BAG 2.X: metadata, elevation, uncertainty, an optional layer, tracking list, keys and values."""
+    rows, cols = elevation.shape
+    metadata = METADATA_TEMPLATE.format(rows=rows, cols=cols, ne_x=1000 + cols - 1, ne_y=2000 + rows - 1)
+    with h5py.File(path, 'w') as f:
+        f.create_group('/BAG_root').attrs['Bag Version'] = BAG_VERSION
+        f.create_dataset(METADATA_PATH, data=np.frombuffer(metadata.encode(), dtype='S1'), maxshape=(None,))
+        for layer_path, values in ((ELEVATION_PATH, elevation), (UNCERTAINTY_PATH, uncertainty),
+                                   (NOMINAL_PATH, nominal)):
+            f.create_dataset(layer_path, data=values.astype(np.float32), chunks=(4, 4),
+                             fillvalue=np.float32(BAG_NO_DATA))
+        f.create_dataset(TRACKING_LIST_PATH, shape=(0,), maxshape=(None,), dtype=TRACKING_LIST_DTYPE, chunks=(1024,))
+        f.create_dataset(KEYS_PATH, data=np.zeros(elevation.shape, np.uint16), chunks=(4, 4))
+        f.create_dataset(VALUES_PATH, data=np.zeros(n_records, dtype=[('survey_id', 'S16')]))
+
+
+def survey_layers(seed):
+    rng = np.random.default_rng(seed)
+    elevation = rng.uniform(-50, -1, (8, 8)).astype(np.float32)
+    uncertainty = rng.uniform(0.1, 2, (8, 8)).astype(np.float32)
+    nominal = elevation - 0.5
+    holes = rng.random((8, 8)) < 0.2
+    for values in (elevation, uncertainty, nominal):
+        values[holes] = BAG_NO_DATA
+    return elevation, uncertainty, nominal
+
+
+def reference_composite(layers, rule):
+    """Node-by-node composite of the surveys on the output lattice: (elevation, uncertainty, nominal, keys)."""
+    stack = np.full((len(SURVEYS), 3) + OUTPUT_SHAPE, BAG_NO_DATA, np.float32)
+    for i, ((_, row, col), survey) in enumerate(zip(SURVEYS, layers)):
+        for j, values in enumerate(survey):
+            stack[i, j, row:row + 8, col:col + 8] = values
+    result = np.full((3,) + OUTPUT_SHAPE, BAG_NO_DATA, np.float32)
+    keys = np.zeros(OUTPUT_SHAPE, np.uint16)
+    for r in range(OUTPUT_SHAPE[0]):
+        for c in range(OUTPUT_SHAPE[1]):
+            # candidates run from the highest precedence down; ties go to the higher-precedence survey
+            candidates = [i for i in reversed(range(len(SURVEYS))) if stack[i, 0, r, c] != BAG_NO_DATA]
+            if not candidates:
+                continue
+            elevation, uncertainty = stack[:, 0, r, c], stack[:, 1, r, c]
+            if rule == 'last_wins':
+                winner = candidates[0]
+            elif rule == 'shoalest':
+                winner = max(candidates, key=lambda i: (elevation[i], i))
+            elif rule == 'min_uncertainty' or not any(uncertainty[i] <= THRESHOLD for i in candidates):
+                winner = min(candidates, key=lambda i: (uncertainty[i], -i))
+            else:
+                winner = next(i for i in candidates if uncertainty[i] <= THRESHOLD)
+            result[:, r, c] = stack[winner, :, r, c]
+            keys[r, c] = SURVEYS[winner][0]
+    return result[0], result[1], result[2], keys
+
+
+@pytest.fixture
+def surveys(tmp_path):
+    layers = [survey_layers(seed) for seed in range(len(SURVEYS))]
+    paths = []
+    for i, survey in enumerate(layers):
+        path = str(tmp_path / f'survey_{i}.bag')
+        write_bag(path, *survey)
+        paths.append(path)
+    empty = np.full(OUTPUT_SHAPE, BAG_NO_DATA, np.float32)
+    output_path = str(tmp_path / 'composite.bag')
+    write_bag(output_path, empty, empty, empty)
+    return output_path, paths, layers
+
+
+def open_surveys(paths):
+    return [CompositeInput(f'survey_{i}', path, record, row, col)
+            for i, (path, (record, row, col)) in enumerate(zip(paths, SURVEYS))]
+
+
+def assert_matches_reference(output_path, layers, rule):
+    elevation, uncertainty, nominal, keys = reference_composite(layers, rule)
+    with h5py.File(output_path, 'r') as f:
+        np.testing.assert_array_equal(f[ELEVATION_PATH][()], elevation)
+        np.testing.assert_array_equal(f[UNCERTAINTY_PATH][()], uncertainty)
+        np.testing.assert_array_equal(f[NOMINAL_PATH][()], nominal)
+        np.testing.assert_array_equal(f[KEYS_PATH][()], keys)
+        data = keys != 0
+        assert f[ELEVATION_PATH].attrs['Minimum Elevation Value'] == elevation[data].min()
+        assert f[ELEVATION_PATH].attrs['Maximum Elevation Value'] == elevation[data].max()
+        assert f[UNCERTAINTY_PATH].attrs['Minimum Uncertainty Value'] == uncertainty[data].min()
+        assert f[UNCERTAINTY_PATH].attrs['Maximum Uncertainty Value'] == uncertainty[data].max()
+    assert validate_bag(output_path)['issues'] == []
+
+
+BUILT_IN_RULES = sorted(RULES) + [f'precedence_threshold:{THRESHOLD}']
+
+
+@pytest.mark.parametrize('rule', BUILT_IN_RULES)
+@pytest.mark.parametrize('read_workers, prefetch', [(1, 0), (2, 2)])
+def test_composite_bag_matches_reference(surveys, rule, read_workers, prefetch):
+    output_path, paths, layers = surveys
+    inputs = open_surveys(paths)
+    try:
+        composite_bag(output_path, inputs, rule, tile_size=(4, 4), read_workers=read_workers, prefetch=prefetch)
+    finally:
+        for source in inputs:
+            source.close()
+    assert_matches_reference(output_path, layers, rule.partition(':')[0])
+
+
+@pytest.mark.parametrize('rule', BUILT_IN_RULES)
+@pytest.mark.parametrize('stitch', ['copy', 'virtual'])
+def test_composite_bag_parallel_matches_reference(surveys, rule, stitch):
+    output_path, paths, layers = surveys
+    inputs = open_surveys(paths)
+    try:
+        composite_bag_parallel(output_path, inputs, rule, workers=2, stitch=stitch, tile_size=(4, 4))
+    finally:
+        for source in inputs:
+            source.close()
+    assert_matches_reference(output_path, layers, rule.partition(':')[0])
+
+
+def layer_with_range(tmp_path, values):
+    f = h5py.File(str(tmp_path / 'layer.h5'), 'w')
+    dataset = f.create_dataset('layer', data=values, chunks=(2, 2))
+    data = values[values != BAG_NO_DATA]
+    dataset.attrs['min'], dataset.attrs['max'] = np.float32(data.min()), np.float32(data.max())
+    return f, dataset
+
+
+def rewrite(layer_range, dataset, rows, cols, block):
+    layer_range.add(dataset[rows, cols], block)
+    dataset[rows, cols] = block
+
+
+@pytest.mark.parametrize('rows, block, expected, rescan', [
+    (slice(2, 4), np.array([[3, 4], [5, 6]], np.float32), (1, 9), False),  # inside the old range
+    (slice(2, 4), np.array([[-2, 4], [5, 12]], np.float32), (-2, 12), False),  # widens it
+    (slice(0, 2), np.full((2, 2), BAG_NO_DATA, np.float32), (2, 9), True),  # removes the old minimum
+])
+def test_layer_range(tmp_path, rows, block, expected, rescan):
+    values = np.arange(16, dtype=np.float32).reshape(4, 4) % 8 + 2
+    values[0, 0] = 1
+    values[3, 3] = BAG_NO_DATA
+    f, dataset = layer_with_range(tmp_path, values)
+    with f:
+        layer_range = LayerRange(dataset, 'min', 'max')
+        rewrite(layer_range, dataset, rows, slice(0, 2), block)
+        assert layer_range.rescan == rescan
+        layer_range.write()
+        assert (dataset.attrs['min'], dataset.attrs['max']) == expected
+
+
+def test_layer_range_without_attributes(tmp_path):
+    values = np.array([[5, 6], [7, BAG_NO_DATA]], np.float32)
+    f, dataset = layer_with_range(tmp_path, values)
+    with f:
+        del dataset.attrs['min'], dataset.attrs['max']
+        layer_range = LayerRange(dataset, 'min', 'max')
+        rewrite(layer_range, dataset, slice(0, 1), slice(0, 1), np.array([[8]], np.float32))
+        layer_range.write()
+        assert (dataset.attrs['min'], dataset.attrs['max']) == (6, 8)
+
+
+def _set_node(path, value):
+    """Overwrite the first data node of `path`."""
+    def damage(f):
+        row, col = np.argwhere(f[KEYS_PATH][()] != 0)[0]
+        f[path][row, col] = value
+    return damage
+
+
+def _drop_attribute(path, name):
+    def damage(f):
+        del f[path].attrs[name]
+    return damage
+
+
+def _replace_metadata(old, new):
+    def damage(f):
+        metadata = b''.join(f[METADATA_PATH][()]).replace(old, new)
+        f[METADATA_PATH].resize((len(metadata),))
+        f[METADATA_PATH][:] = np.frombuffer(metadata, dtype='S1')
+    return damage
+
+
+@pytest.mark.parametrize('code, damage', [
+    ('missing', lambda f: f.__delitem__(TRACKING_LIST_PATH)),
+    ('stale_layer', lambda f: f.create_group(f'{GEOREF_METADATA_PATH}/Elevation')),
+    ('bag_version', lambda f: f['/BAG_root'].attrs.__setitem__('Bag Version', '1.6.2')),
+    ('attribute', _drop_attribute(ELEVATION_PATH, 'Maximum Elevation Value')),
+    ('attribute', _drop_attribute(UNCERTAINTY_PATH, 'Minimum Uncertainty Value')),
+    ('corner_points', _replace_metadata(b'1011,2011', b'1012,2011')),
+    ('xml_dimensions', _replace_metadata(b'<gco:Integer>12<', b'<gco:Integer>13<')),
+    ('bad_key', _set_node(KEYS_PATH, 9)),
+    ('unkeyed_node', _set_node(KEYS_PATH, 0)),
+    ('nodata_mismatch', _set_node(UNCERTAINTY_PATH, BAG_NO_DATA)),
+])
+def test_validator_issue_codes(surveys, code, damage):
+    output_path, paths, _ = surveys
+    inputs = open_surveys(paths)
+    try:
+        composite_bag(output_path, inputs, 'last_wins', tile_size=(4, 4))
+    finally:
+        for source in inputs:
+            source.close()
+    with h5py.File(output_path, 'r+') as f:
+        damage(f)
+    assert code in {issue for issue, _ in validate_bag(output_path)['issues']}